@@ -1,8 +1,26 @@
 """
 Script untuk menganalisis model AI best.pt
 Menampilkan informasi tentang arsitektur model, input/output, dan parameter
+
+Mode benchmark (--benchmark) mengukur waktu load, warm-up, latency per gambar
+untuk beberapa imgsz, batch dan backend (torch eager, TorchScript, ONNX),
+jumlah thread, FLOPs dan memori puncak, lalu menulis tabel JSON/CSV.
+
+Contoh:
+    python analyze_model.py
+    python analyze_model.py models/best.pt --benchmark --imgsz 480,640 --batch 1,4 --output bench_model.json
 """
 
+import argparse
+import csv
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
 import torch
 import json
 from pathlib import Path
@@ -123,11 +141,236 @@ def analyze_yolo_model(model_path):
         traceback.print_exc()
         return None
 
+class PeakMemorySampler:
+    """Sample RSS in the background to catch peaks inside a single inference"""
+    
+    def __init__(self, interval: float = 0.005):
+        from utils.metrics import get_rss_bytes
+        self._get_rss = get_rss_bytes
+        self.interval = interval
+        self.peak = self._get_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._get_rss())
+            self._stop.wait(self.interval)
+    
+    def __enter__(self):
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._get_rss())
+
+
+def _synthetic_batch(batch: int, width: int = 1600, height: int = 1200) -> list:
+    """Decoded synthetic tray images (BGR) shared by every run"""
+    import cv2
+    import numpy as np
+    from benchmark_api import make_tray_image
+    
+    images = []
+    for i in range(batch):
+        encoded = make_tray_image(width, height, 120, seed=i)
+        images.append(cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_COLOR))
+    return images
+
+
+def _thread_info() -> dict:
+    """Thread pools that affect CPU inference"""
+    import cv2
+    return {
+        'torch_threads': torch.get_num_threads(),
+        'torch_interop_threads': torch.get_num_interop_threads(),
+        'opencv_threads': cv2.getNumThreads(),
+        'omp_num_threads': os.getenv('OMP_NUM_THREADS'),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def _export(model_path: str, backend: str, imgsz: int, batch: int, export_dir: str) -> str:
+    """
+    Export the model for a backend with a fixed input shape
+    
+    Returns:
+        Path of the exported model
+    """
+    from ultralytics import YOLO
+    import shutil
+    
+    fmt = {'torchscript': 'torchscript', 'onnx': 'onnx'}[backend]
+    # Ultralytics writes next to the source model, so export from a private copy;
+    # exporting in place would overwrite models/best.onnx or best.torchscript
+    with tempfile.TemporaryDirectory(prefix='qoffea-export-') as work_dir:
+        source = os.path.join(work_dir, os.path.basename(model_path))
+        shutil.copy2(model_path, source)
+        exported = YOLO(source).export(format=fmt, imgsz=imgsz, batch=batch, device='cpu', verbose=False)
+        # Keep each shape separately
+        target = os.path.join(export_dir, f"{backend}_{imgsz}_b{batch}{Path(exported).suffix}")
+        shutil.move(exported, target)
+    return target
+
+
+def benchmark_model(model_path: str, imgsz_list: list, batch_list: list, backends: list,
+                    runs: int = 10, warmup: int = 2) -> dict:
+    """
+    Benchmark model latency and footprint across settings
+    
+    Args:
+        model_path: Path to best.pt
+        imgsz_list: Inference sizes to test
+        batch_list: Batch sizes to test
+        backends: Any of 'torch', 'torchscript', 'onnx'
+        runs: Timed runs per setting
+        warmup: Untimed runs per setting
+        
+    Returns:
+        Dictionary with environment info and one row per setting
+    """
+    if runs < 1:
+        raise ValueError("runs must be at least 1")
+    from ultralytics import YOLO
+    
+    print("=" * 80)
+    print("BENCHMARK MODEL - QOFFEA COFFEE GRADING")
+    print("=" * 80)
+    
+    report = {
+        'model_path': str(model_path),
+        'model_size_mb': round(os.path.getsize(model_path) / 1048576, 2),
+        'torch_version': torch.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'threads': _thread_info(),
+        'rows': []
+    }
+    
+    # Eager load time and FLOPs per input size
+    start = time.perf_counter()
+    eager_model = YOLO(str(model_path))
+    report['load_time_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    print(f"\n⏱️  Load time: {report['load_time_ms']} ms")
+    
+    try:
+        from ultralytics.utils.torch_utils import get_flops
+        report['gflops'] = {str(size): round(get_flops(eager_model.model, size), 2) for size in imgsz_list}
+    except Exception as e:
+        report['gflops'] = {'error': str(e)}
+    print(f"🧮 GFLOPs: {report['gflops']}")
+    del eager_model
+    
+    batches = {batch: _synthetic_batch(batch) for batch in batch_list}
+    
+    with tempfile.TemporaryDirectory(prefix='qoffea_export_') as export_dir:
+        for backend in backends:
+            for imgsz in imgsz_list:
+                for batch in batch_list:
+                    row = {'backend': backend, 'imgsz': imgsz, 'batch': batch}
+                    try:
+                        if backend == 'torch':
+                            source = str(model_path)
+                            row['export_time_ms'] = 0
+                        else:
+                            start = time.perf_counter()
+                            source = _export(str(model_path), backend, imgsz, batch, export_dir)
+                            row['export_time_ms'] = round((time.perf_counter() - start) * 1000, 1)
+                        
+                        with PeakMemorySampler() as memory:
+                            start = time.perf_counter()
+                            model = YOLO(source, task='detect')
+                            row['load_time_ms'] = round((time.perf_counter() - start) * 1000, 1)
+                            
+                            images = batches[batch]
+                            start = time.perf_counter()
+                            model(images, imgsz=imgsz, verbose=False)
+                            row['warmup_time_ms'] = round((time.perf_counter() - start) * 1000, 1)
+                            for _ in range(max(0, warmup - 1)):
+                                model(images, imgsz=imgsz, verbose=False)
+                            
+                            latencies = []
+                            phases = {'preprocess': [], 'inference': [], 'postprocess': []}
+                            for _ in range(runs):
+                                start = time.perf_counter()
+                                results = model(images, imgsz=imgsz, verbose=False)
+                                latencies.append((time.perf_counter() - start) * 1000 / batch)
+                                for phase in phases:
+                                    phases[phase].append(statistics.fmean(r.speed[phase] for r in results))
+                        
+                        latencies.sort()
+                        row.update({
+                            'latency_ms_per_image_mean': round(statistics.fmean(latencies), 2),
+                            'latency_ms_per_image_p50': round(latencies[len(latencies) // 2], 2),
+                            'latency_ms_per_image_min': round(latencies[0], 2),
+                            'images_per_second': round(1000 / statistics.fmean(latencies), 2),
+                            **{f'{phase}_ms': round(statistics.fmean(values), 2) for phase, values in phases.items()},
+                            'detections': len(results[0].boxes) if results[0].boxes is not None else 0,
+                            'peak_rss_mb': round(memory.peak / 1048576, 1)
+                        })
+                        del model
+                    except Exception as e:
+                        row['error'] = f"{type(e).__name__}: {e}"
+                    
+                    report['rows'].append(row)
+                    status = row.get('error') or f"{row['latency_ms_per_image_mean']} ms/img, {row['peak_rss_mb']} MB"
+                    print(f"  {backend:<12} imgsz={imgsz:<5} batch={batch:<3} {status}")
+    
+    # Process-wide peak (ru_maxrss is KB on Linux, bytes on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report['process_peak_rss_mb'] = round((maxrss if sys.platform == 'darwin' else maxrss * 1024) / 1048576, 1)
+    return report
+
+
+def write_report(report: dict, output: str):
+    """Write benchmark rows as JSON (full report) or CSV (rows only)"""
+    if output.endswith('.csv'):
+        columns = []
+        for row in report['rows']:
+            columns.extend(key for key in row if key not in columns)
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(report['rows'])
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"\n📄 Hasil benchmark disimpan ke: {output}")
+
+
 if __name__ == "__main__":
-    model_path = Path(__file__).parent / "models" / "best.pt"
+    parser = argparse.ArgumentParser(description='Analisis dan benchmark model Qoffea')
+    parser.add_argument('model_path', nargs='?', default=str(Path(__file__).parent / "models" / "best.pt"))
+    parser.add_argument('--benchmark', action='store_true', help='Ukur latency dan footprint model')
+    parser.add_argument('--imgsz', default='480,640', help='Ukuran input, dipisah koma')
+    parser.add_argument('--batch', default='1,4', help='Ukuran batch, dipisah koma')
+    parser.add_argument('--backends', default='torch,torchscript,onnx', help='torch, torchscript, onnx')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, help='Set torch.set_num_threads sebelum benchmark')
+    parser.add_argument('--output', default='model_benchmark.json', help='File .json atau .csv')
+    args = parser.parse_args()
+    if args.runs < 1:
+        parser.error('--runs harus minimal 1')
+    
+    model_path = Path(args.model_path)
     
     if not model_path.exists():
         print(f"❌ Model tidak ditemukan di: {model_path}")
         print("   Pastikan file best.pt ada di folder models/")
+    elif args.benchmark:
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        report = benchmark_model(
+            model_path,
+            imgsz_list=[int(v) for v in args.imgsz.split(',')],
+            batch_list=[int(v) for v in args.batch.split(',')],
+            backends=args.backends.split(','),
+            runs=args.runs,
+            warmup=args.warmup
+        )
+        write_report(report, args.output)
     else:
         analyze_yolo_model(model_path)
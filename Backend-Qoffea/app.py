@@ -2,29 +2,102 @@
 Main Flask Application
 """
 
-from flask import Flask, send_from_directory, redirect, url_for
+from flask import Flask, send_from_directory, redirect, url_for, request, g, Response, abort
 from flask_cors import CORS
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+import os
+import time
+import uuid
 from config import Config
-from modules import ModelLoader
+from utils.logger import configure_logging, get_logger, set_request_id, get_request_id
+
+# Configure logging before anything else logs
+configure_logging(Config.LOG_LEVEL, Config.LOG_FORMAT, Config.LOG_LEVELS,
+                  Config.LOG_SAMPLE_RATE, Config.LOG_RATE_LIMIT)
+
+from modules import ModelLoader, ModelRegistry, ImageProcessor
+from modules.cascade import cascade
+from modules.quality_gate import quality_gate
+from modules.roi import roi_cropper
+from modules.annotated_renderer import annotated_renderer
+from modules.derivatives import derivative_store, DERIVATIVE_CACHE_CONTROL
+from utils import metrics as metrics_module
+from utils.watchdog import MemoryWatchdog
+from utils.static_assets import static_assets
+from utils.response_formats import FastJSONProvider, orjson
+from utils.upload_sessions import upload_sessions
+from utils.http_cache import (analysis_cache, file_etag, UPLOAD_CACHE_CONTROL, ANNOTATED_CACHE_CONTROL,
+                              REPORT_CACHE_CONTROL)
+from utils.admission import admission, parse_weights, Overloaded
+from utils.qos import qos
+from utils.deadline import start_deadline, clear_deadline
+
+logger = get_logger('app')
 
 # Initialize model loader globally
 model_loader = ModelLoader()
 
+# Versioned models; the active version wins over MODEL_PATH
+model_registry = ModelRegistry(os.path.join(Config.MODEL_CACHE_DIR, 'registry'))
+
+# Endpoints that run the model; a draining worker refuses new ones
+INFERENCE_ENDPOINTS = {
+    'upload.upload_image',
+    'upload.finalize_upload_session',
+    'upload.get_analysis',
+    'report.download_report',
+    'report.download_lot_report'
+}
+
+# One watchdog per worker process
+watchdog = MemoryWatchdog(
+    max_rss_mb=Config.WORKER_MAX_RSS_MB,
+    max_requests=Config.WORKER_MAX_REQUESTS,
+    interval=Config.WATCHDOG_INTERVAL,
+    drain_timeout=Config.WORKER_DRAIN_TIMEOUT,
+    retry_after=Config.WORKER_DRAIN_RETRY_AFTER
+)
+
 def create_app():
     """Create and configure Flask application"""
     app = Flask(__name__)
     app.config.from_object(Config)
     
+    # Faster, compact jsonify when orjson is installed
+    if orjson is not None:
+        app.json = FastJSONProvider(app)
+    
+    # Client addresses from the entries trusted proxies appended to X-Forwarded-For
+    if Config.TRUSTED_PROXY_HOPS > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=Config.TRUSTED_PROXY_HOPS)
+    
     # Enable CORS
-    CORS(app, origins=Config.CORS_ORIGINS)
+    # Cache preflights; resumable uploads send custom headers on every chunk
+    CORS(app, origins=Config.CORS_ORIGINS, max_age=Config.CORS_MAX_AGE,
+         expose_headers=['Upload-Offset', 'Retry-After'])
     
     # Initialize folders
     Config.init_app()
     
+    # Bound the inference queue
+    admission.configure(
+        max_queue_depth=Config.INFERENCE_QUEUE_DEPTH,
+        max_queue_time=Config.INFERENCE_QUEUE_TIMEOUT,
+        client_rate=Config.CLIENT_RATE_LIMIT,
+        client_burst=Config.CLIENT_RATE_BURST,
+        weights=parse_weights(Config.PRIORITY_WEIGHTS),
+        batch_queue_time=Config.BATCH_QUEUE_TIMEOUT
+    )
+    
     # Load AI model on startup
     try:
-        print("🚀 Initializing Qoffea Backend...")
-        print(f"📥 Loading model from local path: {Config.MODEL_PATH}")
+        active = model_registry.get(model_registry.active() or '')
+        model_path = active['path'] if active else Config.MODEL_PATH
+        logger.info("Initializing Qoffea backend", extra={
+            'model_path': model_path,
+            'model_version': active['version'] if active else None
+        })
         model_loader.load_model(
             model_repo=None,
             model_file=None,
@@ -32,17 +105,197 @@ def create_app():
             confidence=Config.CONFIDENCE_THRESHOLD,
             iou=Config.IOU_THRESHOLD,
             max_det=Config.MAX_DETECTIONS,
-            local_path=Config.MODEL_PATH
+            local_path=model_path,
+            version=active['version'] if active else None,
+            prepared_dir=Config.PREPARED_MODEL_DIR
         )
-        print("✅ Model loaded successfully!")
-    except Exception as e:
-        print(f"❌ Failed to load model: {e}")
+        logger.info("Model loaded")
+        model_loader.direct_inference = Config.DIRECT_INFERENCE
+        if Config.MODEL_CPU_OPTIMIZE:
+            model_loader.optimize_cpu(
+                use_compile=Config.MODEL_TORCH_COMPILE,
+                bf16=Config.MODEL_BF16,
+                cache_dir=os.path.join(Config.MODEL_CACHE_DIR, 'compiled'),
+                check_image=ImageProcessor.load_image(Config.MODEL_SELF_CHECK_IMAGE)
+                if Config.MODEL_SELF_CHECK_IMAGE else None,
+                predict_args={
+                    'conf': Config.CONFIDENCE_THRESHOLD,
+                    'iou': Config.IOU_THRESHOLD,
+                    'max_det': Config.MAX_DETECTIONS
+                }
+            )
+        # Warm up before gunicorn hands this worker any connections
+        if Config.MODEL_WARMUP:
+            model_loader.warmup(Config.MODEL_WARMUP_SIZE)
+    except Exception:
+        logger.exception("Failed to load model")
         raise
     
+    # A traced artifact runs every request at its own size and is not a PyTorch module
+    if model_loader.fixed_imgsz:
+        ignored = [name for name, enabled in (('QOS_ENABLED', Config.QOS_ENABLED),
+                                              ('CASCADE_ENABLED', Config.CASCADE_ENABLED),
+                                              ('MODEL_CPU_OPTIMIZE', Config.MODEL_CPU_OPTIMIZE)) if enabled]
+        if ignored:
+            logger.warning("Prepared model has a fixed input size; input-size overrides and CPU optimization "
+                           "do not apply to it (rebuild with prepare_model.py --format pt)",
+                           extra={'imgsz': model_loader.fixed_imgsz, 'settings': ignored})
+    
+    # QoS tiers; a tier whose model cannot be loaded falls back to the main model
+    tiers = [dict(tier) for tier in Config.QOS_TIERS]
+    for tier in tiers:
+        if tier.get('model_path'):
+            try:
+                model_loader.load_variant(tier['model_path'])
+            except Exception as e:
+                logger.warning("QoS tier model unavailable, using main model",
+                               extra={'tier': tier['name'], 'path': tier['model_path'], 'error': str(e)})
+                tier['model_path'] = None
+    qos.configure(tiers, Config.QOS_RECOVERY_SECONDS, Config.QOS_ENABLED)
+    
+    quality_gate.configure(
+        enabled=Config.QUALITY_GATE_ENABLED,
+        max_side=Config.QUALITY_MAX_SIDE,
+        min_brightness=Config.QUALITY_MIN_BRIGHTNESS,
+        max_brightness=Config.QUALITY_MAX_BRIGHTNESS,
+        max_clipped=Config.QUALITY_MAX_CLIPPED,
+        min_foreground=Config.QUALITY_MIN_FOREGROUND,
+        min_sharpness=Config.QUALITY_MIN_SHARPNESS
+    )
+    
+    roi_cropper.configure(
+        enabled=Config.ROI_CROP_ENABLED,
+        max_side=Config.ROI_THUMBNAIL_SIZE,
+        texture_threshold=Config.ROI_TEXTURE_THRESHOLD,
+        margin=Config.ROI_MARGIN,
+        max_area_ratio=Config.ROI_MAX_AREA_RATIO
+    )
+    
+    annotated_renderer.configure(
+        Config.UPLOAD_FOLDER,
+        Config.ANNOTATED_CACHE_DIR,
+        fmt=Config.ANNOTATED_FORMAT,
+        quality=Config.ANNOTATED_QUALITY,
+        max_side=Config.ANNOTATED_MAX_SIDE,
+        max_cache_mb=Config.ANNOTATED_CACHE_MAX_MB
+    )
+    
+    analysis_cache.configure(Config.ANALYSIS_CACHE_SIZE)
+    
+    upload_sessions.configure(
+        Config.UPLOAD_SESSION_DIR,
+        max_file_size=Config.MAX_FILE_SIZE,
+        chunk_size=Config.UPLOAD_CHUNK_SIZE,
+        ttl_seconds=Config.UPLOAD_SESSION_TTL,
+        max_sessions=Config.UPLOAD_MAX_SESSIONS
+    )
+    
+    derivative_store.configure(
+        Config.DERIVATIVE_CACHE_DIR,
+        thumbnail_size=Config.DERIVATIVE_THUMBNAIL_SIZE,
+        preview_size=Config.DERIVATIVE_PREVIEW_SIZE,
+        tile_size=Config.DERIVATIVE_TILE_SIZE,
+        quality=Config.DERIVATIVE_QUALITY,
+        max_cache_mb=Config.DERIVATIVE_CACHE_MAX_MB
+    )
+    
+    # Cascade; stays off when its models cannot be loaded
+    if Config.CASCADE_ENABLED:
+        try:
+            model_loader.load_variant(Config.CASCADE_CLASSIFIER_PATH, Config.CASCADE_CLASSIFIER_IMGSZ, task='classify')
+            if Config.CASCADE_DETECTOR_PATH:
+                model_loader.load_variant(Config.CASCADE_DETECTOR_PATH, Config.CASCADE_DETECTOR_IMGSZ)
+            cascade.configure(
+                Config.CASCADE_CLASSIFIER_PATH,
+                band=(Config.CASCADE_BAND_LOW, Config.CASCADE_BAND_HIGH),
+                detector_path=Config.CASCADE_DETECTOR_PATH,
+                detector_imgsz=Config.CASCADE_DETECTOR_IMGSZ,
+                classifier_imgsz=Config.CASCADE_CLASSIFIER_IMGSZ,
+                padding=Config.CASCADE_CROP_PADDING
+            )
+        except Exception as e:
+            logger.warning("Cascade models unavailable, using single-stage detection", extra={'error': str(e)})
+    
+    watchdog.start()
+    
+    # Follow activations made through other workers or instances
+    model_registry.watch(
+        lambda manifest: model_loader.swap_model(manifest['path'], manifest['version'], Config.MODEL_WARMUP_SIZE),
+        Config.MODEL_REGISTRY_POLL_SECONDS
+    )
+    
+    # Request instrumentation
+    @app.before_request
+    def start_request_metrics():
+        # Reuse an upstream request ID when present so logs can be correlated
+        request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+        set_request_id(request_id)
+        g.request_start = time.perf_counter()
+        metrics_module.IN_FLIGHT.inc()
+        metrics_module.start_request_timings()
+        
+        # Clients may ask for a tighter deadline than the server default
+        timeout = Config.REQUEST_TIMEOUT
+        try:
+            timeout = min(timeout, float(request.headers.get('X-Request-Timeout', timeout)))
+        except ValueError:
+            pass
+        start_deadline(timeout, request.environ)
+    
+    @app.before_request
+    def refuse_inference_while_draining():
+        # Nothing routes around a draining worker (Cloud Run ignores the health
+        # check), so stop taking model work or in-flight requests never reach zero
+        if watchdog.draining and request.endpoint in INFERENCE_ENDPOINTS:
+            return Overloaded(503, 'draining', watchdog.retry_after,
+                              'Server is restarting, please try again shortly').to_response()
+    
+    @app.after_request
+    def record_request_metrics(response):
+        elapsed = time.perf_counter() - g.request_start
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics_module.REQUEST_DURATION.observe(elapsed, method=request.method, endpoint=endpoint)
+        metrics_module.REQUESTS_TOTAL.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+        
+        # Expose per-stage timings to clients and benchmarks
+        timings = metrics_module.get_request_timings()
+        if timings:
+            # Stages can run more than once per request (e.g. receive); report totals
+            totals = {}
+            for stage, seconds in timings:
+                totals[stage] = totals.get(stage, 0.0) + seconds
+            response.headers['Server-Timing'] = ', '.join(
+                f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items()
+            )
+        response.headers['X-Request-ID'] = get_request_id()
+        return response
+    
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        if 'request_start' in g:
+            metrics_module.IN_FLIGHT.dec()
+            watchdog.request_finished()
+        clear_deadline()
+    
+    # Opt-in profiling; no hooks are installed unless enabled
+    if Config.PROFILING_ENABLED:
+        from routes.profiling import init_profiling
+        init_profiling(app)
+    
     # Register blueprints
-    from routes import upload_bp, report_bp
+    from routes import upload_bp, report_bp, models_bp
     app.register_blueprint(upload_bp, url_prefix='/api')
     app.register_blueprint(report_bp, url_prefix='/api')
+    app.register_blueprint(models_bp, url_prefix='/api')
+    
+    def send_cacheable(folder, filename, cache_control):
+        """Send a file with a content-hash ETag; werkzeug answers If-None-Match and Range"""
+        path = safe_join(folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = send_from_directory(folder, filename, etag=file_etag(path))
+        response.headers['Cache-Control'] = cache_control
+        return response
     
     # Serve uploaded files
     @app.route('/uploads/<filename>')
@@ -50,7 +303,25 @@ def create_app():
         """Serve uploaded images"""
         import os
         abs_upload_folder = os.path.abspath(Config.UPLOAD_FOLDER)
-        return send_from_directory(abs_upload_folder, filename)
+        if filename.startswith('annotated_'):
+            # Drawn from the stored detections on first request
+            rendered = annotated_renderer.resolve(filename)
+            if rendered is None:
+                abort(404)
+            return send_cacheable(os.path.dirname(rendered), os.path.basename(rendered), ANNOTATED_CACHE_CONTROL)
+        return send_cacheable(abs_upload_folder, filename, UPLOAD_CACHE_CONTROL)
+    
+    # Serve thumbnails, previews and Deep Zoom tiles (generated on first request)
+    @app.route('/derivatives/<analysis_id>/<path:name>')
+    def serve_derivative(analysis_id, name):
+        """Serve image derivatives"""
+        path = derivative_store.resolve(analysis_id, name)
+        if path is None:
+            abort(404)
+        response = send_from_directory(os.path.dirname(path), os.path.basename(path))
+        # An analysis never changes, so neither do its derivatives
+        response.headers['Cache-Control'] = DERIVATIVE_CACHE_CONTROL
+        return response
     
     # Serve report files
     @app.route('/reports/<filename>')
@@ -58,78 +329,74 @@ def create_app():
         """Serve generated reports"""
         import os
         abs_report_folder = os.path.abspath(Config.REPORT_FOLDER)
-        return send_from_directory(abs_report_folder, filename)
+        return send_cacheable(abs_report_folder, filename, REPORT_CACHE_CONTROL)
+    
+    # Serve the frontend from memory (fingerprinted, precompressed, ETag-validated)
+    static_assets.load(Config.FRONTEND_DIR)
+    
+    def serve_frontend_file():
+        found = static_assets.lookup(request.path)
+        if found is None:
+            abort(404)
+        status, headers, body = static_assets.respond(*found, request.headers.get('If-None-Match'),
+                                                      request.headers.get('Accept-Encoding'))
+        return Response(body, status=status, headers=headers)
     
-    # Serve frontend HTML pages
     @app.route('/index')
     @app.route('/index.html')
     def serve_index():
         """Serve index.html"""
-        import os
-        frontend_path = os.path.abspath(os.path.join(Config.BASE_DIR, '..', 'Frontend-Qoffea'))
-        return send_from_directory(frontend_path, 'index.html')
+        return serve_frontend_file()
     
     @app.route('/aksi')
     @app.route('/aksi.html')
     def serve_aksi():
         """Serve aksi.html"""
-        import os
-        frontend_path = os.path.abspath(os.path.join(Config.BASE_DIR, '..', 'Frontend-Qoffea'))
-        return send_from_directory(frontend_path, 'aksi.html')
+        return serve_frontend_file()
     
     @app.route('/panduan')
     @app.route('/panduan.html')
     def serve_panduan():
         """Serve panduan.html"""
-        import os
-        frontend_path = os.path.abspath(os.path.join(Config.BASE_DIR, '..', 'Frontend-Qoffea'))
-        return send_from_directory(frontend_path, 'panduan.html')
+        return serve_frontend_file()
     
     @app.route('/test-integration')
     @app.route('/test-integration.html')
     def serve_test():
         """Serve test-integration.html"""
-        import os
-        frontend_path = os.path.abspath(os.path.join(Config.BASE_DIR, '..', 'Frontend-Qoffea'))
-        return send_from_directory(frontend_path, 'test-integration.html')
+        return serve_frontend_file()
     
     @app.route('/assets/<path:filename>')
     @app.route('/Assets/<path:filename>')
-    def serve_assets(filename):
-        """Serve frontend assets (case-insensitive)"""
-        import os
-        assets_path = os.path.abspath(os.path.join(Config.BASE_DIR, '..', 'Frontend-Qoffea', 'Assets'))
-        return send_from_directory(assets_path, filename)
-    
     @app.route('/css/<path:filename>')
-    def serve_css(filename):
-        """Serve CSS files"""
-        import os
-        css_path = os.path.abspath(os.path.join(Config.BASE_DIR, '..', 'Frontend-Qoffea', 'css'))
-        return send_from_directory(css_path, filename)
-    
     @app.route('/js/<path:filename>')
-    def serve_js(filename):
-        """Serve JS files"""
-        import os
-        js_path = os.path.abspath(os.path.join(Config.BASE_DIR, '..', 'Frontend-Qoffea', 'js'))
-        return send_from_directory(js_path, filename)
-    
     @app.route('/style.css')
-    def serve_main_css():
-        """Serve main style.css"""
-        import os
-        frontend_path = os.path.abspath(os.path.join(Config.BASE_DIR, '..', 'Frontend-Qoffea'))
-        return send_from_directory(frontend_path, 'style.css')
+    @app.route('/style.<fingerprint>.css')
+    def serve_assets(filename=None, fingerprint=None):
+        """Serve frontend assets (case-insensitive Assets folder)"""
+        return serve_frontend_file()
     
     # Health check endpoint
     @app.route('/api/health', methods=['GET'])
     def health_check():
-        return {
-            'status': 'healthy',
+        body = {
+            'status': 'draining' if watchdog.draining else 'healthy',
             'model_loaded': model_loader._model is not None,
-            'classes': model_loader.get_class_names()
+            'model_version': model_loader.version,
+            'classes': model_loader.get_class_names(),
+            'worker': {'pid': os.getpid(), **watchdog.status()}
         }
+        # Fail health checks while draining so traffic moves to other workers
+        return body, 503 if watchdog.draining else 200
+    
+    # Prometheus metrics endpoint
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """Expose metrics in Prometheus text format"""
+        return Response(
+            metrics_module.metrics.render(),
+            mimetype='text/plain; version=0.0.4; charset=utf-8'
+        )
     
     # Homepage - redirect to index
     @app.route('/')
@@ -0,0 +1,375 @@
+"""
+ASGI Entry Point
+Serves the same API as app.py, but receives request bodies and sends files
+asynchronously so slow clients do not hold a worker thread
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Request bodies are streamed into a spooled temporary file on the event loop.
+Only once the body is complete does the Flask application run, on the
+inference executor, so a thread is busy for the processing time only and
+never for the upload transfer. Uploaded images, reports and image derivatives
+are streamed back from the event loop too, and frontend files are answered
+there straight from memory.
+"""
+
+import asyncio
+import mimetypes
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from werkzeug.security import safe_join
+from config import Config
+from app import app as flask_app
+from modules.annotated_renderer import annotated_renderer
+from modules.derivatives import derivative_store, DERIVATIVE_CACHE_CONTROL
+from utils import metrics as metrics_module
+from utils.static_assets import static_assets
+from utils.http_cache import (file_etag, etag_matches, UPLOAD_CACHE_CONTROL, ANNOTATED_CACHE_CONTROL,
+                              REPORT_CACHE_CONTROL)
+from utils.logger import get_logger
+
+logger = get_logger('asgi')
+
+# Bodies up to this size stay in memory; larger ones roll over to disk
+SPOOL_MAX_MEMORY = 1024 * 1024
+# Multipart framing and form fields on top of the file itself
+BODY_OVERHEAD = 64 * 1024
+# Chunk size for streaming files to the client
+FILE_CHUNK_SIZE = 256 * 1024
+
+# Runs the Flask app (and so inference) once a request body is complete
+inference_executor = ThreadPoolExecutor(max_workers=Config.ASGI_THREADS, thread_name_prefix='inference')
+
+# Folders whose files are streamed without entering Flask
+FILE_ROUTES = {
+    '/uploads/': (os.path.abspath(Config.UPLOAD_FOLDER), '/uploads/<filename>'),
+    '/reports/': (os.path.abspath(Config.REPORT_FOLDER), '/reports/<filename>'),
+    '/derivatives/': (os.path.abspath(Config.DERIVATIVE_CACHE_DIR), '/derivatives/<analysis_id>/<path:name>'),
+}
+
+
+def _build_environ(scope: dict, body, content_length: int, disconnected: threading.Event) -> dict:
+    """
+    Build a WSGI environ for an ASGI HTTP scope
+
+    Args:
+        scope: ASGI connection scope
+        body: File object holding the complete request body
+        content_length: Body size in bytes
+        disconnected: Event set when the client goes away
+
+    Returns:
+        WSGI environ
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(content_length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'qoffea.disconnected': disconnected,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'CONTENT_TYPE' if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _run_wsgi(environ: dict) -> tuple:
+    """
+    Call the Flask app and collect its response (runs on the inference executor)
+
+    Returns:
+        Tuple of (status code, headers, body chunks)
+    """
+    state = {}
+
+    def start_response(status, headers, exc_info=None):
+        state['status'] = int(status.split(' ', 1)[0])
+        state['headers'] = headers
+
+    result = flask_app(environ, start_response)
+    try:
+        chunks = [chunk for chunk in result if chunk]
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return state['status'], state['headers'], chunks
+
+
+async def _send_simple(send, status: int, body: bytes, content_type: str = 'application/json', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode()),
+                    *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _parse_range(value: str, size: int):
+    """
+    Parse a single-range Range header
+
+    Returns:
+        (start, end) inclusive, None to ignore the header (unsupported or
+        several ranges; the full file is sent), or False if unsatisfiable
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            length = int(last)
+            return (max(0, size - length), size - 1) if length > 0 and size else False
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    return (start, end) if start <= end else False
+
+
+def _cors_headers(request_headers: dict) -> list:
+    """
+    CORS headers for responses that bypass Flask, matching what flask_cors
+    sends for CORS_ORIGINS ('*' or a comma-separated list of origins)
+    """
+    origin = request_headers.get('origin')
+    if Config.CORS_ORIGINS.strip() == '*':
+        return [(b'access-control-allow-origin', b'*')]
+    allowed = [item.strip() for item in Config.CORS_ORIGINS.split(',') if item.strip()]
+    if origin and origin in allowed:
+        return [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+    return [(b'vary', b'Origin')]
+
+
+async def _serve_file(scope: dict, send, folder: str, filename: str, cache_control: str):
+    """
+    Stream a file from disk without holding an executor thread for the transfer
+
+    Answers If-None-Match with 304 (content-hash ETag) and single byte
+    ranges with 206. CORS headers are added as flask_cors would, so the
+    zoom viewer on another origin can fetch tiles.
+    """
+    request_headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                       for name, value in scope.get('headers', [])}
+    cors = _cors_headers(request_headers)
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        await _send_simple(send, 404, b'{"success": false, "error": "Not found"}', headers=cors)
+        return 404
+
+    loop = asyncio.get_running_loop()
+    stat = os.stat(path)
+    # Hashed once per file version, then remembered
+    etag = await loop.run_in_executor(None, file_etag, path)
+    headers = [
+        (b'etag', f'"{etag}"'.encode()),
+        (b'cache-control', cache_control.encode()),
+        (b'last-modified', formatdate(stat.st_mtime, usegmt=True).encode()),
+        (b'accept-ranges', b'bytes'),
+        *cors,
+    ]
+    if etag_matches(request_headers.get('if-none-match'), etag):
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return 304
+
+    status, start, end = 200, 0, stat.st_size - 1
+    byte_range = None
+    if 'range' in request_headers and request_headers.get('if-range', f'"{etag}"').strip() == f'"{etag}"':
+        byte_range = _parse_range(request_headers['range'], stat.st_size)
+    if byte_range is False:
+        headers.append((b'content-range', f'bytes */{stat.st_size}'.encode()))
+        await _send_simple(send, 416, b'', 'text/plain', headers)
+        return 416
+    if byte_range:
+        status, (start, end) = 206, byte_range
+        headers.append((b'content-range', f'bytes {start}-{end}/{stat.st_size}'.encode()))
+
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type.encode()),
+            (b'content-length', str(end - start + 1).encode()),
+            *headers,
+        ],
+    })
+    if scope['method'] == 'HEAD':
+        await send({'type': 'http.response.body', 'body': b''})
+        return status
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while True:
+            # Disk reads are short; the slow part (sending) stays on the loop
+            chunk = await loop.run_in_executor(None, f.read, min(FILE_CHUNK_SIZE, remaining))
+            remaining -= len(chunk)
+            more = remaining > 0 and len(chunk) > 0
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+            if not more:
+                break
+    return status
+
+
+async def _receive_body(receive, limit: int):
+    """
+    Stream the request body into a spooled temporary file
+
+    Returns:
+        Tuple of (file positioned at 0, size), or (None, size) if the body
+        exceeded the limit or the client disconnected
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None, size
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            body.close()
+            return None, size
+        if chunk:
+            body.write(chunk)
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body, size
+
+
+async def _watch_disconnect(receive, disconnected: threading.Event):
+    """Set the event once the client goes away, so pipeline stages can stop"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            inference_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI application"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    method = scope['method']
+
+    # Frontend files are already in memory; answer them on the loop
+    found = static_assets.lookup(path) if method in ('GET', 'HEAD') else None
+    if found is not None:
+        start = time.perf_counter()
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+        status, response_headers, body = static_assets.respond(*found, headers.get('if-none-match'),
+                                                               headers.get('accept-encoding'))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode(), value.encode()) for name, value in response_headers],
+        })
+        await send({'type': 'http.response.body', 'body': b'' if method == 'HEAD' else body})
+        metrics_module.REQUEST_DURATION.observe(time.perf_counter() - start, method=method, endpoint='frontend')
+        metrics_module.REQUESTS_TOTAL.inc(method=method, endpoint='frontend', status=status)
+        return
+
+    for prefix, (folder, endpoint) in FILE_ROUTES.items():
+        if path.startswith(prefix) and method in ('GET', 'HEAD'):
+            start = time.perf_counter()
+            filename = path[len(prefix):]
+            cache_control = REPORT_CACHE_CONTROL if prefix == '/reports/' else UPLOAD_CACHE_CONTROL
+            if prefix != '/derivatives/' and '/' in filename:
+                # Like Flask's <filename>: nothing in subfolders (e.g. .detections/) is served
+                filename = ''
+            elif prefix == '/uploads/' and filename.startswith('annotated_'):
+                # Drawn on first request; rendering is CPU work, keep it off the loop
+                rendered = await asyncio.get_running_loop().run_in_executor(
+                    inference_executor, annotated_renderer.resolve, filename)
+                if rendered is not None:
+                    folder, filename = os.path.split(rendered)
+                cache_control = ANNOTATED_CACHE_CONTROL
+            elif prefix == '/derivatives/':
+                analysis_id, _, name = filename.partition('/')
+                rendered = await asyncio.get_running_loop().run_in_executor(
+                    inference_executor, derivative_store.resolve, analysis_id, name)
+                # Only names the store knows are served from its cache
+                folder, filename = os.path.split(rendered) if rendered is not None else (folder, '')
+                cache_control = DERIVATIVE_CACHE_CONTROL
+            status = await _serve_file(scope, send, folder, filename, cache_control)
+            metrics_module.REQUEST_DURATION.observe(time.perf_counter() - start, method=method, endpoint=endpoint)
+            metrics_module.REQUESTS_TOTAL.inc(method=method, endpoint=endpoint, status=status)
+            return
+
+    body, size = await _receive_body(receive, Config.MAX_FILE_SIZE + BODY_OVERHEAD)
+    if body is None:
+        if size > Config.MAX_FILE_SIZE + BODY_OVERHEAD:
+            limit_mb = Config.MAX_FILE_SIZE / (1024 * 1024)
+            await _send_simple(send, 413, f'{{"success": false, "error": "Request larger than {limit_mb:.0f}MB"}}'.encode())
+        return
+
+    disconnected = threading.Event()
+    watcher = asyncio.ensure_future(_watch_disconnect(receive, disconnected))
+    try:
+        environ = _build_environ(scope, body, size, disconnected)
+        loop = asyncio.get_running_loop()
+        status, headers, chunks = await loop.run_in_executor(inference_executor, _run_wsgi, environ)
+    except Exception:
+        logger.exception("Error handling ASGI request", extra={'path': path})
+        await _send_simple(send, 500, b'{"success": false, "error": "Internal server error"}')
+        return
+    finally:
+        watcher.cancel()
+        body.close()
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    for index, chunk in enumerate(chunks):
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': index < len(chunks) - 1})
+    if not chunks:
+        await send({'type': 'http.response.body', 'body': b''})
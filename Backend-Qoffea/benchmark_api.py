@@ -0,0 +1,476 @@
+"""
+Load and latency benchmark for the Qoffea HTTP API
+
+Generates synthetic bean-tray images, drives /api/upload, /api/analyze and
+report downloads at several concurrency levels, and writes throughput,
+latency percentiles, per-stage timings (from Server-Timing) and peak server
+RSS to a JSON file that can be compared across commits. Every upload
+carries its own bytes, so 'analyze' times analysis cache misses and
+'analyze_cached' the same requests repeated as hits; report downloads
+come after both and reuse the cached analysis.
+
+Examples:
+    python benchmark_api.py                                  # start local server, default matrix
+    python benchmark_api.py --concurrency 1,4,8 --requests 40
+    python benchmark_api.py --base-url http://127.0.0.1:5000 # use an already running server
+    python benchmark_api.py --compare bench_old.json --output bench_new.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# ---------------------------------------------------------------------------
+# Synthetic images
+# ---------------------------------------------------------------------------
+
+def make_tray_image(width: int, height: int, beans: int, seed: int = 0) -> bytes:
+    """
+    Draw a synthetic tray of coffee beans and encode it as JPEG
+
+    Args:
+        width: Image width in pixels
+        height: Image height in pixels
+        beans: Number of beans to draw
+        seed: Random seed (same seed, same image)
+
+    Returns:
+        JPEG bytes
+    """
+    rng = np.random.default_rng(seed)
+
+    # Light tray with low-frequency shading and sensor noise
+    tray = np.full((height, width, 3), (205, 215, 222), dtype=np.float32)
+    gradient = np.linspace(-18, 18, width, dtype=np.float32)[None, :, None]
+    tray += gradient + rng.normal(0, 4, (height, width, 1)).astype(np.float32)
+    img = np.clip(tray, 0, 255).astype(np.uint8)
+
+    bean_length = max(8, int(min(width, height) / (np.sqrt(beans) * 2.2)))
+    for _ in range(beans):
+        cx = int(rng.uniform(bean_length, width - bean_length))
+        cy = int(rng.uniform(bean_length, height - bean_length))
+        axes = (bean_length // 2, int(bean_length * rng.uniform(0.3, 0.4)))
+        angle = float(rng.uniform(0, 180))
+        shade = rng.uniform(0.6, 1.1)
+        color = tuple(int(c * shade) for c in (40, 75, 120))  # BGR brown
+        cv2.ellipse(img, (cx, cy), axes, angle, 0, 360, color, -1, cv2.LINE_AA)
+        # Centre crease
+        dx = int(np.cos(np.radians(angle)) * axes[0] * 0.8)
+        dy = int(np.sin(np.radians(angle)) * axes[0] * 0.8)
+        cv2.line(img, (cx - dx, cy - dy), (cx + dx, cy + dy), (20, 35, 60), max(1, axes[1] // 5), cv2.LINE_AA)
+
+    ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise RuntimeError("Failed to encode synthetic image")
+    return encoded.tobytes()
+
+
+def tag_jpeg(payload: bytes, tag: str) -> bytes:
+    """
+    Insert a JPEG comment segment after the SOI marker
+
+    The pixels stay the same but the bytes, and so the server's content
+    hash, differ per tag; otherwise every upload after the first would
+    hit the analysis cache.
+
+    Args:
+        payload: JPEG bytes
+        tag: ASCII text unique to the upload
+
+    Returns:
+        JPEG bytes
+    """
+    comment = tag.encode('ascii')
+    return payload[:2] + b'\xff\xfe' + (len(comment) + 2).to_bytes(2, 'big') + comment + payload[2:]
+
+
+# ---------------------------------------------------------------------------
+# Server management and RSS sampling
+# ---------------------------------------------------------------------------
+
+def _process_tree_rss(pid: int) -> int:
+    """Sum VmRSS of a process and its children (Linux /proc, psutil elsewhere)"""
+    try:
+        import psutil
+        process = psutil.Process(pid)
+        return sum(p.memory_info().rss for p in [process] + process.children(recursive=True))
+    except ImportError:
+        pass
+    except Exception:
+        return 0
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return total
+
+
+class RssSampler:
+    """Background sampler of a process tree's peak RSS"""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _process_tree_rss(self.pid))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def reset(self) -> int:
+        """Return the peak since the last reset and start a new window"""
+        peak, self.peak = self.peak, _process_tree_rss(self.pid)
+        return peak
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def start_server(port: int, command: str, timeout: float) -> subprocess.Popen:
+    """
+    Start the backend and wait for /api/health
+
+    Args:
+        port: Port to listen on
+        command: Shell command starting the server ({port} is substituted)
+        timeout: Seconds to wait for the model to load
+
+    Returns:
+        Server process
+    """
+    env = dict(os.environ, PORT=str(port), FLASK_DEBUG='0', LOG_LEVEL=os.getenv('LOG_LEVEL', 'WARNING'))
+    process = subprocess.Popen(command.format(port=port), shell=True, cwd=BACKEND_DIR, env=env,
+                               start_new_session=True)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/api/health", timeout=2).status_code == 200:
+                return process
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    stop_server(process)
+    raise RuntimeError(f"Server did not become healthy within {timeout}s")
+
+
+def stop_server(process: subprocess.Popen):
+    """Terminate the server process group"""
+    import signal
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=15)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+# ---------------------------------------------------------------------------
+# Load generation
+# ---------------------------------------------------------------------------
+
+_sessions = threading.local()
+
+
+def _session() -> requests.Session:
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def parse_server_timing(header: str) -> dict:
+    """Parse 'stage;dur=12.3, other;dur=4' into {stage: ms}"""
+    stages = {}
+    for item in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, _, params = item.partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur':
+                try:
+                    stages[name] = stages.get(name, 0.0) + float(value)
+                except ValueError:
+                    pass
+    return stages
+
+
+def timed_call(method: str, url: str, **kwargs) -> dict:
+    """Issue one request and record latency, status and stage timings"""
+    start = time.perf_counter()
+    try:
+        response = _session().request(method, url, timeout=300, **kwargs)
+        body = response.content
+        return {
+            'latency': time.perf_counter() - start,
+            'status': response.status_code,
+            'stages': parse_server_timing(response.headers.get('Server-Timing')),
+            'bytes': len(body),
+            'json': response.json() if response.headers.get('Content-Type', '').startswith('application/json') else None
+        }
+    except requests.RequestException as e:
+        return {'latency': time.perf_counter() - start, 'status': 0, 'stages': {}, 'bytes': 0,
+                'json': None, 'error': str(e)}
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(calls: list, wall_time: float) -> dict:
+    """Aggregate call records into throughput, latency and stage statistics"""
+    ok = [c for c in calls if 200 <= c['status'] < 300]
+    latencies = [c['latency'] * 1000 for c in ok]
+    stages = {}
+    for call in ok:
+        for stage, ms in call['stages'].items():
+            stages.setdefault(stage, []).append(ms)
+    statuses = {}
+    for call in calls:
+        statuses[str(call['status'])] = statuses.get(str(call['status']), 0) + 1
+    return {
+        'requests': len(calls),
+        'errors': len(calls) - len(ok),
+        'statuses': statuses,
+        'wall_time_s': round(wall_time, 3),
+        'throughput_rps': round(len(ok) / wall_time, 3) if wall_time > 0 else 0,
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies), 1) if latencies else 0,
+            'p50': round(percentile(latencies, 50), 1),
+            'p95': round(percentile(latencies, 95), 1),
+            'p99': round(percentile(latencies, 99), 1),
+            'max': round(max(latencies), 1) if latencies else 0
+        },
+        'stages_ms': {
+            stage: {
+                'mean': round(statistics.fmean(values), 2),
+                'p50': round(percentile(values, 50), 2),
+                'p95': round(percentile(values, 95), 2)
+            }
+            for stage, values in sorted(stages.items())
+        },
+        'mean_response_bytes': int(statistics.fmean([c['bytes'] for c in ok])) if ok else 0
+    }
+
+
+def run_load(concurrency: int, jobs: list) -> tuple:
+    """
+    Run jobs (callables returning call records) on a pool of workers
+
+    Returns:
+        Tuple of (call records, wall time in seconds)
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        calls = list(executor.map(lambda job: job(), jobs))
+    return calls, time.perf_counter() - start
+
+
+def benchmark(args) -> dict:
+    """Run the full benchmark matrix against args.base_url"""
+    base_url = args.base_url.rstrip('/')
+    sizes = [tuple(int(v) for v in size.lower().split('x')) for size in args.sizes.split(',')]
+    densities = [int(d) for d in args.densities.split(',')]
+    concurrency_levels = [int(c) for c in args.concurrency.split(',')]
+    endpoints = set(args.endpoints.split(','))
+
+    print(f"Generating {len(sizes) * len(densities)} synthetic images...")
+    images = {
+        (w, h, d): make_tray_image(w, h, d, seed=w * 31 + h * 7 + d)
+        for w, h in sizes for d in densities
+    }
+
+    # Keeps uploads unique across runs against the same server
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    rss = RssSampler(args.server_pid).start() if args.server_pid else None
+    results = []
+
+    try:
+        # Warm up (first inference pays lazy initialisation)
+        warm = next(iter(images.values()))
+        for _ in range(args.warmup):
+            timed_call('POST', f"{base_url}/api/upload", files={'file': ('warmup.jpg', warm, 'image/jpeg')})
+        if rss:
+            rss.reset()
+
+        for (width, height, density), payload in images.items():
+            scenario = f"{width}x{height}_{density}beans"
+            for concurrency in concurrency_levels:
+                print(f"  {scenario} @ concurrency {concurrency}")
+                upload_jobs = [
+                    (lambda p=tag_jpeg(payload, f"{scenario}-{concurrency}-{index}-{run_id}"):
+                     timed_call('POST', f"{base_url}/api/upload", files={'file': ('tray.jpg', p, 'image/jpeg')}))
+                    for index in range(args.requests)
+                ]
+                calls, wall = run_load(concurrency, upload_jobs)
+                analysis_ids = [c['json']['analysis_id'] for c in calls
+                                if c['json'] and c['json'].get('success')]
+                entries = []
+                if 'upload' in endpoints:
+                    entries.append(('upload', summarize(calls, wall)))
+
+                # Every upload has unique bytes, so the first GET is a cache miss and a repeat is a hit
+                if 'analyze' in endpoints and analysis_ids:
+                    jobs = [(lambda a=a: timed_call('GET', f"{base_url}/api/analyze/{a}")) for a in analysis_ids]
+                    entries.append(('analyze', summarize(*run_load(concurrency, jobs))))
+                    if 'analyze_cached' in endpoints:
+                        entries.append(('analyze_cached', summarize(*run_load(concurrency, jobs))))
+
+                if 'report' in endpoints and analysis_ids:
+                    ids = analysis_ids[:max(1, args.requests // 4)]
+                    jobs = [(lambda a=a: timed_call('GET', f"{base_url}/api/report/{a}/download")) for a in ids]
+                    entries.append(('report', summarize(*run_load(concurrency, jobs))))
+
+                peak = rss.reset() if rss else None
+                for endpoint, summary in entries:
+                    results.append({
+                        'endpoint': endpoint,
+                        'scenario': scenario,
+                        'image': {'width': width, 'height': height, 'beans': density,
+                                  'bytes': len(payload)},
+                        'concurrency': concurrency,
+                        'peak_rss_mb': round(peak / 1048576, 1) if peak else None,
+                        **summary
+                    })
+    finally:
+        if rss:
+            rss.stop()
+
+    return {'results': results}
+
+
+def git_revision() -> str:
+    """Current commit hash, with -dirty when the tree has changes"""
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet'], cwd=BACKEND_DIR) != 0
+        return rev + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(previous_path: str, current: dict):
+    """Print throughput and p95 changes against an earlier run"""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    key = lambda r: (r['endpoint'], r['scenario'], r['concurrency'])
+    before = {key(r): r for r in previous.get('results', [])}
+
+    print(f"\nComparison with {previous_path} ({previous.get('meta', {}).get('git_revision', '?')[:12]})")
+    print(f"{'endpoint':<14} {'scenario':<24} {'conc':>4} {'rps':>9} {'Δrps':>8} {'p95 ms':>9} {'Δp95':>8}")
+    for result in current['results']:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        d_rps = (result['throughput_rps'] / old['throughput_rps'] - 1) * 100 if old['throughput_rps'] else 0
+        d_p95 = (result['latency_ms']['p95'] / old['latency_ms']['p95'] - 1) * 100 if old['latency_ms']['p95'] else 0
+        print(f"{result['endpoint']:<14} {result['scenario']:<24} {result['concurrency']:>4} "
+              f"{result['throughput_rps']:>9.2f} {d_rps:>+7.1f}% {result['latency_ms']['p95']:>9.1f} {d_p95:>+7.1f}%")
+
+
+def print_table(report: dict):
+    """Print a compact summary table"""
+    print(f"\n{'endpoint':<14} {'scenario':<24} {'conc':>4} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'err':>4} {'rss MB':>7}")
+    for r in report['results']:
+        lat = r['latency_ms']
+        print(f"{r['endpoint']:<14} {r['scenario']:<24} {r['concurrency']:>4} {r['throughput_rps']:>8.2f} "
+              f"{lat['p50']:>8.1f} {lat['p95']:>8.1f} {lat['p99']:>8.1f} {r['errors']:>4} "
+              f"{r['peak_rss_mb'] if r['peak_rss_mb'] is not None else '-':>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', help='Benchmark a running server instead of starting one')
+    parser.add_argument('--server-pid', type=int, help='PID to sample RSS from when using --base-url')
+    # Import app the way gunicorn does (module import, not __main__)
+    parser.add_argument('--server-cmd', default=f'{sys.executable} -m flask --app app run --host 127.0.0.1 --port {{port}}',
+                        help='Command used to start the server ({port} is substituted); '
+                             'e.g. "gunicorn --bind :{port} --workers 1 --threads 8 app:app"')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    parser.add_argument('--sizes', default='1280x960,4000x3000', help='Image sizes, WxH comma separated')
+    parser.add_argument('--densities', default='30,150', help='Beans per image, comma separated')
+    parser.add_argument('--concurrency', default='1,4', help='Concurrency levels, comma separated')
+    parser.add_argument('--requests', type=int, default=20, help='Uploads per scenario and concurrency level')
+    parser.add_argument('--endpoints', default='upload,analyze,analyze_cached,report',
+                        help='analyze times cache misses, analyze_cached repeats them as hits')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--output', default=f"bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    parser.add_argument('--compare', help='Earlier result JSON to compare against')
+    args = parser.parse_args()
+
+    process = None
+    if not args.base_url:
+        print(f"Starting server: {args.server_cmd.format(port=args.port)}")
+        process = start_server(args.port, args.server_cmd, args.startup_timeout)
+        args.base_url = f"http://127.0.0.1:{args.port}"
+        args.server_pid = process.pid
+
+    try:
+        report = benchmark(args)
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    report['meta'] = {
+        'git_revision': git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('server_pid',)}
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print_table(report)
+    print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,20 +15,141 @@ class Config:
     # Local Model Configuration
     MODEL_PATH = os.getenv('MODEL_PATH', os.path.join(BASE_DIR, 'models', 'best.pt'))
     MODEL_CACHE_DIR = os.getenv('MODEL_CACHE_DIR', os.path.join(BASE_DIR, 'model_cache'))
+    PREPARED_MODEL_DIR = os.getenv('PREPARED_MODEL_DIR', os.path.join(BASE_DIR, 'models', 'prepared'))  # prepare_model.py output
+    MODEL_ADMIN_TOKEN = os.getenv('MODEL_ADMIN_TOKEN', '')  # Enables /api/models management when set
+    MODEL_REGISTRY_POLL_SECONDS = float(os.getenv('MODEL_REGISTRY_POLL_SECONDS', 30))  # Follow activations (0 = off)
     
     # Detection Parameters
     CONFIDENCE_THRESHOLD = float(os.getenv('CONFIDENCE_THRESHOLD', 0.52))  # Confidence threshold for predictions
     IOU_THRESHOLD = float(os.getenv('IOU_THRESHOLD', 0.40))  # Lower = more aggressive NMS, removes more overlaps
     MAX_DETECTIONS = int(os.getenv('MAX_DETECTIONS', 300))  # Maximum number of detections per image
+    MODEL_WARMUP = os.getenv('MODEL_WARMUP', '1') == '1'  # Run a dummy prediction before taking traffic
+    MODEL_WARMUP_SIZE = int(os.getenv('MODEL_WARMUP_SIZE', 640))  # Side of the blank warm-up image
+    DIRECT_INFERENCE = os.getenv('DIRECT_INFERENCE', '1') == '1'  # Reuse the predictor and letterbox buffers per call
+    
+    # Optimized CPU execution (opt-in; verified against eager mode at load)
+    MODEL_CPU_OPTIMIZE = os.getenv('MODEL_CPU_OPTIMIZE', '0') == '1'  # Fusion, channels_last, inference_mode
+    MODEL_TORCH_COMPILE = os.getenv('MODEL_TORCH_COMPILE', '0') == '1'  # Also torch.compile (slow first start)
+    MODEL_BF16 = os.getenv('MODEL_BF16', 'auto')  # 'auto' (CPUs with native bf16), 'on' or 'off'
+    MODEL_SELF_CHECK_IMAGE = os.getenv('MODEL_SELF_CHECK_IMAGE', '')  # Photo of beans for the self-check (needed for optimizations to be kept)
     
     # Upload
     UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', os.path.join(BASE_DIR, 'uploads'))
     REPORT_FOLDER = os.getenv('REPORT_FOLDER', os.path.join(BASE_DIR, 'reports'))
+    FRONTEND_DIR = os.getenv('FRONTEND_DIR', os.path.join(BASE_DIR, '..', 'Frontend-Qoffea'))  # Loaded into memory at startup
     MAX_FILE_SIZE = int(os.getenv('MAX_FILE_SIZE', 10485760))  # 10MB
     ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png'}
     
+    # Resumable chunked uploads (/api/uploads); sessions idle past the TTL are deleted
+    UPLOAD_SESSION_DIR = os.getenv('UPLOAD_SESSION_DIR', os.path.join(BASE_DIR, 'upload_sessions'))  # Shared between instances
+    UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 4194304))  # Largest chunk accepted (4MB); the frontend sends smaller files in one POST
+    UPLOAD_SESSION_TTL = float(os.getenv('UPLOAD_SESSION_TTL', 21600))  # Seconds (6 hours)
+    UPLOAD_MAX_SESSIONS = int(os.getenv('UPLOAD_MAX_SESSIONS', 100))  # Open sessions before new ones get 503
+
+    # Lot Reports
+    LOT_REPORT_MAX_SAMPLES = int(os.getenv('LOT_REPORT_MAX_SAMPLES', 500))  # Maximum analyses per lot PDF
+    LOT_REPORT_WORKERS = int(os.getenv('LOT_REPORT_WORKERS', 4))  # Threads preparing page images
+    LOT_REPORT_THUMBNAIL_SIZE = int(os.getenv('LOT_REPORT_THUMBNAIL_SIZE', 900))  # Longest thumbnail side in pixels
+
     # CORS
     CORS_ORIGINS = os.getenv('CORS_ORIGINS', '*')
+    CORS_MAX_AGE = int(os.getenv('CORS_MAX_AGE', 7200))  # Seconds browsers may cache a preflight (Chrome caps at 2 hours)
+    
+    # Logging
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # 'json' for Cloud Logging, 'text' for local development
+    LOG_LEVELS = os.getenv('LOG_LEVELS', '')  # Per-module overrides, e.g. "analyzer=DEBUG,pdf_generator=WARNING"
+    LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.01))  # Fraction of per-detection debug logs kept
+    LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', 20))  # Max per-detection debug logs per second
+    
+    # Request deadlines (work is cancelled between stages once expired or the client leaves)
+    REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', 60))  # Seconds; clients may ask for less via X-Request-Timeout
+    LOT_REPORT_TIMEOUT = float(os.getenv('LOT_REPORT_TIMEOUT', 900))  # Seconds for a whole lot report
+    
+    # ASGI serving (asgi.py)
+    ASGI_THREADS = int(os.getenv('ASGI_THREADS', 8))  # Threads running the app once a request body has arrived
+    
+    # Admission control for inference
+    INFERENCE_QUEUE_DEPTH = int(os.getenv('INFERENCE_QUEUE_DEPTH', 16))  # Requests allowed to wait for the model
+    INFERENCE_QUEUE_TIMEOUT = float(os.getenv('INFERENCE_QUEUE_TIMEOUT', 10))  # Seconds a request may wait before 503
+    CLIENT_RATE_LIMIT = float(os.getenv('CLIENT_RATE_LIMIT', 0))  # Inference requests/second per client (0 = off)
+    CLIENT_RATE_BURST = float(os.getenv('CLIENT_RATE_BURST', 5))  # Back-to-back requests allowed per client
+    TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', 1))  # Proxies in front of the app that append to X-Forwarded-For (Cloud Run: 1)
+    PRIORITY_WEIGHTS = os.getenv('PRIORITY_WEIGHTS', 'interactive=8,report=3,batch=1')  # Model share per class under contention
+    BATCH_QUEUE_TIMEOUT = float(os.getenv('BATCH_QUEUE_TIMEOUT', 300))  # Seconds a bulk image may wait for the model
+    
+    # QoS tiers, ordered from full quality to cheapest; under load the cheapest
+    # tier whose queue depth or recent queue wait threshold is reached is used
+    QOS_ENABLED = os.getenv('QOS_ENABLED', '1') == '1'
+    QOS_RECOVERY_SECONDS = float(os.getenv('QOS_RECOVERY_SECONDS', 10))  # Calm period before stepping back up
+    QOS_LIGHT_MODEL_PATH = os.getenv('QOS_LIGHT_MODEL_PATH', '')  # Optional smaller/exported model for the lowest tier
+    QOS_TIERS = [
+        {'name': 'full', 'imgsz': None, 'model_path': None, 'annotate': True},
+        {'name': 'reduced', 'min_queue_depth': 4, 'min_queue_wait_ms': 1500,
+         'imgsz': 480, 'model_path': None, 'annotate': True},
+        {'name': 'minimal', 'min_queue_depth': 8, 'min_queue_wait_ms': 4000,
+         'imgsz': 320, 'model_path': QOS_LIGHT_MODEL_PATH or None, 'annotate': False},
+    ]
+    
+    # Quality gate: reject blurry, badly exposed or empty photos before inference
+    QUALITY_GATE_ENABLED = os.getenv('QUALITY_GATE_ENABLED', '0') == '1'  # Off until the thresholds are tuned on real photos
+    QUALITY_MAX_SIDE = int(os.getenv('QUALITY_MAX_SIDE', 640))  # Longest side of the downscaled copy checked
+    QUALITY_MIN_BRIGHTNESS = float(os.getenv('QUALITY_MIN_BRIGHTNESS', 40))  # Mean grey level (0-255)
+    QUALITY_MAX_BRIGHTNESS = float(os.getenv('QUALITY_MAX_BRIGHTNESS', 230))
+    QUALITY_MAX_CLIPPED = float(os.getenv('QUALITY_MAX_CLIPPED', 0.5))  # Max fraction of near-black/near-white pixels
+    QUALITY_MIN_FOREGROUND = float(os.getenv('QUALITY_MIN_FOREGROUND', 0.02))  # Min fraction of textured cells (beans)
+    QUALITY_MIN_SHARPNESS = float(os.getenv('QUALITY_MIN_SHARPNESS', 100))  # Min Laplacian variance over the beans
+    
+    # ROI crop: run the model only on the bean-bearing region of the photo
+    ROI_CROP_ENABLED = os.getenv('ROI_CROP_ENABLED', '0') == '1'  # Opt-in: changes what the model sees
+    ROI_THUMBNAIL_SIZE = int(os.getenv('ROI_THUMBNAIL_SIZE', 256))  # Longest side of the thumbnail searched
+    ROI_TEXTURE_THRESHOLD = float(os.getenv('ROI_TEXTURE_THRESHOLD', 10))  # Local grey-level std that counts as beans
+    ROI_MARGIN = float(os.getenv('ROI_MARGIN', 0.04))  # Margin around the region (fraction of image size)
+    ROI_MAX_AREA_RATIO = float(os.getenv('ROI_MAX_AREA_RATIO', 0.85))  # Do not crop when the region is bigger
+    
+    # Annotated images are drawn on first request and cached
+    ANNOTATED_FORMAT = os.getenv('ANNOTATED_FORMAT', 'jpg')  # 'jpg' or 'webp'
+    ANNOTATED_QUALITY = int(os.getenv('ANNOTATED_QUALITY', 85))  # Encoder quality (1-100)
+    ANNOTATED_MAX_SIDE = int(os.getenv('ANNOTATED_MAX_SIDE', 2048))  # Longest side of rendered images
+    ANNOTATED_CACHE_DIR = os.getenv('ANNOTATED_CACHE_DIR', os.path.join(BASE_DIR, 'annotated_cache'))
+    ANNOTATED_CACHE_MAX_MB = float(os.getenv('ANNOTATED_CACHE_MAX_MB', 512))  # Least recently used images evicted above
+    
+    # Re-analysis results kept in memory, keyed by model version, parameters and image hash
+    ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', 256))  # 0 = off
+    
+    # Thumbnails, previews and Deep Zoom tiles, generated on first request and cached
+    DERIVATIVE_CACHE_DIR = os.getenv('DERIVATIVE_CACHE_DIR', os.path.join(BASE_DIR, 'derivative_cache'))
+    DERIVATIVE_THUMBNAIL_SIZE = int(os.getenv('DERIVATIVE_THUMBNAIL_SIZE', 256))  # Longest side of thumbnails
+    DERIVATIVE_PREVIEW_SIZE = int(os.getenv('DERIVATIVE_PREVIEW_SIZE', 1024))  # Longest side of previews
+    DERIVATIVE_TILE_SIZE = int(os.getenv('DERIVATIVE_TILE_SIZE', 254))  # Deep Zoom tile side (plus 1px overlap)
+    DERIVATIVE_QUALITY = int(os.getenv('DERIVATIVE_QUALITY', 80))  # JPEG quality (1-100)
+    DERIVATIVE_CACHE_MAX_MB = float(os.getenv('DERIVATIVE_CACHE_MAX_MB', 1024))  # Least recently used analyses evicted above
+    
+    # Cascade: fast low-resolution detector, then a crop classifier only for
+    # detections whose confidence falls inside the ambiguity band
+    CASCADE_ENABLED = os.getenv('CASCADE_ENABLED', '0') == '1'
+    CASCADE_CLASSIFIER_PATH = os.getenv('CASCADE_CLASSIFIER_PATH', os.path.join(BASE_DIR, 'models', 'classifier.pt'))
+    CASCADE_CLASSIFIER_IMGSZ = int(os.getenv('CASCADE_CLASSIFIER_IMGSZ', 128))  # Crop classifier input size
+    CASCADE_DETECTOR_PATH = os.getenv('CASCADE_DETECTOR_PATH', '')  # Optional lighter detector (default: main model)
+    CASCADE_DETECTOR_IMGSZ = int(os.getenv('CASCADE_DETECTOR_IMGSZ', 480))  # First-stage input size
+    CASCADE_BAND_LOW = float(os.getenv('CASCADE_BAND_LOW', 0.30))  # Detector confidences in [low, high) are re-checked
+    CASCADE_BAND_HIGH = float(os.getenv('CASCADE_BAND_HIGH', 0.70))
+    CASCADE_CROP_PADDING = float(os.getenv('CASCADE_CROP_PADDING', 0.15))  # Context around each crop (fraction of box)
+    
+    # Worker recycling (gunicorn restarts the worker after a graceful exit)
+    WORKER_MAX_RSS_MB = float(os.getenv('WORKER_MAX_RSS_MB', 0))  # Recycle above this RSS (0 = off)
+    WORKER_MAX_REQUESTS = int(os.getenv('WORKER_MAX_REQUESTS', 0))  # Recycle after N requests (0 = off)
+    WATCHDOG_INTERVAL = float(os.getenv('WATCHDOG_INTERVAL', 5))  # Seconds between RSS samples
+    WORKER_DRAIN_TIMEOUT = float(os.getenv('WORKER_DRAIN_TIMEOUT', 120))  # Max wait for in-flight requests
+    WORKER_DRAIN_RETRY_AFTER = int(os.getenv('WORKER_DRAIN_RETRY_AFTER', 10))  # Retry-After on inference refused while draining
+    
+    # Profiling (off by default; requires a token when enabled)
+    PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '0') == '1'
+    PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+    PROFILE_SLOW_THRESHOLD_MS = float(os.getenv('PROFILE_SLOW_THRESHOLD_MS', 0))  # Auto-capture slower requests (0 = off)
+    PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', 5))  # Stack sampling interval
+    PROFILE_RING_SIZE = int(os.getenv('PROFILE_RING_SIZE', 20))  # Profiles kept for download
+    PROFILE_MAX_WINDOW_SECONDS = float(os.getenv('PROFILE_MAX_WINDOW_SECONDS', 60))  # Longest time-window capture
     
     @staticmethod
     def init_app():
@@ -1,7 +1,8 @@
 """Module initialization"""
 from .model_loader import ModelLoader
+from .model_registry import ModelRegistry
 from .image_processor import ImageProcessor
 from .analyzer import CoffeeAnalyzer
-from .pdf_generator import PDFGenerator
+from .pdf_generator import PDFGenerator, LotReportGenerator
 
-__all__ = ['ModelLoader', 'ImageProcessor', 'CoffeeAnalyzer', 'PDFGenerator']
+__all__ = ['ModelLoader', 'ModelRegistry', 'ImageProcessor', 'CoffeeAnalyzer', 'PDFGenerator', 'LotReportGenerator']
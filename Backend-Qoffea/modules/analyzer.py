@@ -5,6 +5,18 @@ Main analysis logic for coffee bean grading
 
 from typing import Dict, List, Tuple
 import numpy as np
+from utils.metrics import stage_timer
+from utils.qos import qos, select_tier
+from utils.deadline import check_deadline
+from utils.http_cache import analysis_cache, content_hash, make_etag, ANALYSIS_CACHE_REQUESTS
+from utils.logger import get_logger, SampledLogger
+from modules.cascade import cascade
+from modules.roi import roi_cropper
+from modules.image_processor import ImageProcessor
+
+logger = get_logger('analyzer')
+# Per-detection logs are sampled; a busy image has hundreds of detections
+detection_logger = SampledLogger(get_logger('analyzer.detections'))
 
 
 class CoffeeAnalyzer:
@@ -18,7 +30,8 @@ class CoffeeAnalyzer:
         """
         self.model_loader = model_loader
     
-    def analyze_image(self, image_path: str, confidence: float = 0.52, iou: float = 0.40, max_det: int = 300) -> Dict:
+    def analyze_image(self, image_path: str, confidence: float = 0.52, iou: float = 0.40, max_det: int = 300,
+                      priority: str = 'interactive') -> Dict:
         """
         Analyze coffee beans in image
         
@@ -27,13 +40,128 @@ class CoffeeAnalyzer:
             confidence: Confidence threshold (default: 0.65)
             iou: IoU threshold for NMS (default: 0.40)
             max_det: Maximum detections per image (default: 300)
+            priority: Scheduling class for the model queue (default: 'interactive')
             
         Returns:
             Dictionary with analysis results
         """
+        # Pick a cheaper tier when the model is backed up
+        tier = select_tier(priority)
+        
         # Run prediction with all NMS parameters
-        results = self.model_loader.predict(image_path, conf=confidence, iou=iou, max_det=max_det)
+        results = self.detect(image_path, confidence, iou, max_det, priority, tier)
+        
+        check_deadline('analyze')
+        with stage_timer('analyze'):
+            analysis_result = self.summarize_results(results, confidence)
+        analysis_result['qos_tier'] = qos.served(tier, analysis_result.get('inference'))['name']
+        return analysis_result
+    
+    def analysis_etag(self, image_path: str, confidence: float, iou: float, max_det: int,
+                      model_version: str = None) -> str:
+        """
+        ETag of the analysis of a stored image
         
+        Args:
+            image_path: Path to image file
+            confidence: Confidence threshold
+            iou: IoU threshold for NMS
+            max_det: Maximum detections per image
+            model_version: Model version (default: the one serving new requests)
+            
+        Returns:
+            ETag without quotes
+        """
+        return make_etag(model_version or self.model_loader.version, confidence, iou, max_det,
+                         roi_cropper.settings_key(), cascade.settings_key(), content_hash(image_path))
+    
+    def analyze_stored(self, image_path: str, confidence: float = 0.52, iou: float = 0.40, max_det: int = 300,
+                       priority: str = 'interactive') -> Tuple[Dict, str]:
+        """
+        Analyze a stored upload, reusing an earlier result for the same model, parameters and content
+        
+        Args:
+            image_path: Path to image file
+            confidence: Confidence threshold (default: 0.52)
+            iou: IoU threshold for NMS (default: 0.40)
+            max_det: Maximum detections per image (default: 300)
+            priority: Scheduling class for the model queue (default: 'interactive')
+            
+        Returns:
+            Tuple of (analysis result, ETag), the ETag being None for results
+            that must not be cached (failed or produced by a degraded QoS tier)
+        """
+        etag = self.analysis_etag(image_path, confidence, iou, max_det)
+        cached = analysis_cache.get(etag)
+        if cached is not None:
+            ANALYSIS_CACHE_REQUESTS.inc(result='hit')
+            return dict(cached), etag
+        
+        ANALYSIS_CACHE_REQUESTS.inc(result='miss')
+        analysis_result = self.analyze_image(image_path, confidence, iou, max_det, priority)
+        if not analysis_result.get('success') or analysis_result.get('qos_tier') != qos.tiers[0]['name']:
+            return analysis_result, None
+        
+        # The model may have been swapped while this analysis ran
+        etag = self.analysis_etag(image_path, confidence, iou, max_det, analysis_result.get('model_version'))
+        analysis_cache.put(etag, analysis_result)
+        return dict(analysis_result), etag
+    
+    def detect(self, image, confidence: float = 0.52, iou: float = 0.40, max_det: int = 300,
+               priority: str = 'interactive', tier: Dict = None):
+        """
+        Run the detector, and the crop classifier for ambiguous beans when the cascade is enabled
+        
+        When ROI cropping is enabled the detector only sees the bean-bearing
+        region; returned boxes are in full-image coordinates either way.
+        
+        Args:
+            image: Path to image file or decoded BGR image array
+            confidence: Confidence threshold (default: 0.52)
+            iou: IoU threshold for NMS (default: 0.40)
+            max_det: Maximum detections per image (default: 300)
+            priority: Scheduling class for the model queue (default: 'interactive')
+            tier: QoS tier from select_tier (default: full quality)
+            
+        Returns:
+            Prediction results with the cascade verdicts merged in
+        """
+        tier = tier or {}
+        options = cascade.detector_options(confidence, tier.get('imgsz'), tier.get('model_path'))
+        
+        # Spend the model's resolution on the beans, not the table around them
+        roi = None
+        if roi_cropper.enabled:
+            if not isinstance(image, np.ndarray):
+                image = ImageProcessor.load_image(str(image))
+            with stage_timer('roi'):
+                roi = roi_cropper.find(image)
+        
+        if roi:
+            x1, y1, x2, y2 = roi
+            results = self.model_loader.predict(image[y1:y2, x1:x2], iou=iou, max_det=max_det, priority=priority,
+                                                **options)
+            roi_cropper.restore(results, image, roi)
+        else:
+            results = self.model_loader.predict(image, iou=iou, max_det=max_det, priority=priority, **options)
+        
+        if cascade.enabled:
+            check_deadline('classify')
+            stats = cascade.refine(results, self.model_loader)
+            logger.debug("Cascade verdicts merged", extra=stats)
+        return results
+    
+    def summarize_results(self, results, confidence: float = 0.52) -> Dict:
+        """
+        Count good and defect beans in existing prediction results
+        
+        Args:
+            results: YOLO prediction results
+            confidence: Confidence threshold (default: 0.52)
+            
+        Returns:
+            Dictionary with analysis results
+        """
         if len(results) == 0:
             return {
                 'success': False,
@@ -43,10 +171,15 @@ class CoffeeAnalyzer:
         
         # Extract detection data
         result = results[0]
+        # Set by ModelLoader.predict; part of cache keys and reports
+        model_version = getattr(result, 'model_version', None)
+        inference = getattr(result, 'inference', None)
         
         if result.boxes is None or len(result.boxes) == 0:
             return {
                 'success': True,
+                'model_version': model_version,
+            'inference': inference,
                 'total_beans': 0,
                 'good_beans': 0,
                 'defect_beans': 0,
@@ -66,11 +199,18 @@ class CoffeeAnalyzer:
         defect_count = 0
         detections = []
         
+        # Checked once so the loop pays nothing when debug logging is off
+        trace_detections = detection_logger.enabled()
+        filtered_count = 0
+        
         # CRITICAL: Filter out detections below confidence threshold
         for box, cls, conf in zip(boxes, classes, confidences):
             # SKIP if confidence is below threshold
             if conf < confidence:
-                print(f"🚫 Filtering out detection with confidence {conf:.2f} < {confidence}")
+                filtered_count += 1
+                if trace_detections:
+                    detection_logger.debug("Filtering out low-confidence detection",
+                                           extra={'confidence': round(float(conf), 3), 'threshold': confidence})
                 continue
             
             class_id = int(cls)
@@ -94,17 +234,27 @@ class CoffeeAnalyzer:
         
         total_beans = good_count + defect_count
         
+        if filtered_count:
+            logger.debug("Filtered detections below threshold",
+                         extra={'filtered': filtered_count, 'threshold': confidence})
+        
         # Calculate percentages
         good_percentage = (good_count / total_beans * 100) if total_beans > 0 else 0
         defect_percentage = (defect_count / total_beans * 100) if total_beans > 0 else 0
         
         return {
             'success': True,
+            'model_version': model_version,
+            'inference': inference,
             'total_beans': total_beans,
             'good_beans': good_count,
             'defect_beans': defect_count,
             'good_percentage': round(good_percentage, 2),
             'defect_percentage': round(defect_percentage, 2),
             'detections': detections,
-            'class_names': class_names
+            'class_names': class_names,
+            # Set by the cascade: how many borderline beans the classifier decided
+            'cascade': getattr(result, 'cascade', None),
+            # Set by the ROI crop: region of the photo the model saw
+            'roi': getattr(result, 'roi', None)
         }
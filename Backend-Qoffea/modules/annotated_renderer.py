@@ -0,0 +1,263 @@
+"""
+Annotated Renderer Module
+Draws annotated images on first request from stored detections, with a size-bounded cache
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+import cv2
+from utils.metrics import metrics, stage_timer
+from utils.logger import get_logger
+from modules.image_processor import ImageProcessor
+
+logger = get_logger('annotated_renderer')
+
+ANNOTATED_REQUESTS = metrics.counter(
+    'qoffea_annotated_requests_total',
+    'Annotated image requests, by cache result',
+    ('result',)
+)
+ANNOTATED_CACHE_BYTES = metrics.gauge(
+    'qoffea_annotated_cache_bytes',
+    'Size of the rendered annotated image cache'
+)
+
+# Detections saved at upload time, one JSON file per analysis
+DETECTIONS_DIR = '.detections'
+ANNOTATED_PATTERN = re.compile(r'^annotated_([A-Za-z0-9_-]+)\.(jpg|webp)$')
+
+ENCODE_PARAMS = {
+    'jpg': cv2.IMWRITE_JPEG_QUALITY,
+    'webp': cv2.IMWRITE_WEBP_QUALITY,
+}
+
+
+def write_atomic(path: str, data: bytes):
+    """Write a file so readers never see it half-written"""
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class AnnotatedRenderer:
+    """
+    Lazy annotated images
+
+    Uploads only store their detections; the annotated image is drawn when
+    /uploads/annotated_<id>.<ext> is first requested (or a report needs it),
+    downscaled to max_side and encoded as JPEG or WebP. Rendered files live
+    in cache_dir, named after the render settings, and the least recently
+    used ones are deleted once the cache grows past max_bytes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rendering = {}
+        self._cache_bytes = None
+        self.configure(os.path.join(tempfile.gettempdir(), 'qoffea-uploads'),
+                       os.path.join(tempfile.gettempdir(), 'qoffea-annotated'))
+
+    def configure(self, upload_folder: str, cache_dir: str, fmt: str = 'jpg', quality: int = 85,
+                  max_side: int = 2048, max_cache_mb: float = 512):
+        """
+        Apply renderer settings
+
+        Args:
+            upload_folder: Folder holding the original uploads
+            cache_dir: Folder for rendered images
+            fmt: 'jpg' or 'webp'
+            quality: Encoder quality (1-100)
+            max_side: Longest side of rendered images
+            max_cache_mb: Cache size before least recently used images are evicted
+        """
+        if fmt not in ENCODE_PARAMS:
+            raise ValueError(f"Unsupported annotated image format: {fmt}")
+        self.upload_folder = os.path.abspath(upload_folder)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.format = fmt
+        self.quality = quality
+        self.max_side = max_side
+        self.max_bytes = max_cache_mb * 1024 * 1024
+        self._cache_bytes = None
+
+    def filename(self, analysis_id: str) -> str:
+        """Public name of the annotated image of an analysis"""
+        return f"annotated_{analysis_id}.{self.format}"
+
+    def _detections_path(self, analysis_id: str) -> str:
+        return os.path.join(self.upload_folder, DETECTIONS_DIR, f"{analysis_id}.json")
+
+    def save_detections(self, analysis_id: str, image_filename: str, analysis_result: dict):
+        """
+        Store what is needed to draw the annotated image later
+
+        Args:
+            analysis_id: ID of analysis
+            image_filename: Uploaded image in the upload folder
+            analysis_result: Result of CoffeeAnalyzer.summarize_results
+        """
+        os.makedirs(os.path.dirname(self._detections_path(analysis_id)), exist_ok=True)
+        record = {
+            'image': image_filename,
+            'model_version': analysis_result.get('model_version'),
+            'detections': [
+                {'class_name': d['class_name'], 'confidence': round(d['confidence'], 4),
+                 'bbox': [round(c, 1) for c in d['bbox']]}
+                for d in analysis_result.get('detections', [])
+            ]
+        }
+        write_atomic(self._detections_path(analysis_id), json.dumps(record).encode())
+
+    def resolve(self, filename: str):
+        """
+        Path of an annotated image, rendering it if needed
+
+        Annotated files written to the upload folder by earlier versions are
+        served as they are.
+
+        Args:
+            filename: Requested name, e.g. 'annotated_<id>.jpg'
+
+        Returns:
+            Absolute path, or None if there is no such analysis
+        """
+        legacy = os.path.join(self.upload_folder, filename)
+        if os.path.isfile(legacy):
+            return legacy
+        match = ANNOTATED_PATTERN.match(filename)
+        if not match or match.group(2) != self.format:
+            return None
+        return self.render(match.group(1))
+
+    def path_for(self, analysis_id: str, image_filename: str):
+        """
+        Annotated image of an analysis for reports
+
+        Args:
+            analysis_id: ID of analysis
+            image_filename: Uploaded image in the upload folder
+
+        Returns:
+            Absolute path, or None if there is no annotated image
+        """
+        legacy = os.path.join(self.upload_folder, f"annotated_{image_filename}")
+        if os.path.isfile(legacy):
+            return legacy
+        return self.render(analysis_id)
+
+    def load_record(self, analysis_id: str):
+        """
+        Read the detections stored for an analysis
+
+        Returns:
+            Dictionary with 'image', 'model_version' and 'detections', or None
+        """
+        try:
+            with open(self._detections_path(analysis_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def draw(self, analysis_id: str, max_side: int = None):
+        """
+        Draw the annotated image of an analysis in memory
+
+        Args:
+            analysis_id: ID of analysis
+            max_side: Longest side of the result (default: full resolution)
+
+        Returns:
+            BGR image, or None if the analysis has no stored detections
+        """
+        record = self.load_record(analysis_id)
+        if record is None:
+            return None
+        image = ImageProcessor.load_image(os.path.join(self.upload_folder, record['image']))
+        height, width = image.shape[:2]
+        scale = min(1.0, max_side / max(height, width)) if max_side else 1.0
+        if scale < 1.0:
+            image = cv2.resize(image, (round(width * scale), round(height * scale)),
+                               interpolation=cv2.INTER_AREA)
+        return ImageProcessor.render_detection_list(image, record['detections'], scale)
+
+    def render(self, analysis_id: str):
+        """
+        Get the rendered annotated image of an analysis
+
+        Args:
+            analysis_id: ID of analysis
+
+        Returns:
+            Absolute path in the cache, or None if the analysis has no stored detections
+        """
+        cached = os.path.join(self.cache_dir, f"{analysis_id}_{self.max_side}q{self.quality}.{self.format}")
+        if os.path.exists(cached):
+            ANNOTATED_REQUESTS.inc(result='hit')
+            # Recently used entries survive eviction
+            os.utime(cached)
+            return cached
+
+        # One render per image even when several requests arrive at once
+        with self._lock:
+            key_lock = self._rendering.setdefault(analysis_id, threading.Lock())
+        with key_lock:
+            try:
+                if os.path.exists(cached):
+                    ANNOTATED_REQUESTS.inc(result='hit')
+                    return cached
+
+                with stage_timer('draw'):
+                    image = self.draw(analysis_id, self.max_side)
+                if image is None:
+                    ANNOTATED_REQUESTS.inc(result='missing')
+                    return None
+
+                with stage_timer('encode'):
+                    ok, encoded = cv2.imencode(f".{self.format}", image, [ENCODE_PARAMS[self.format], self.quality])
+                    if not ok:
+                        raise RuntimeError(f"Failed to encode annotated image as {self.format}")
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    write_atomic(cached, encoded.tobytes())
+
+                ANNOTATED_REQUESTS.inc(result='rendered')
+                self._account(len(encoded))
+                return cached
+            finally:
+                with self._lock:
+                    self._rendering.pop(analysis_id, None)
+
+    def _account(self, added: int):
+        """Track the cache size and evict the least recently used images past the limit"""
+        with self._lock:
+            if self._cache_bytes is None:
+                self._cache_bytes = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                                        if entry.is_file())
+            else:
+                self._cache_bytes += added
+            if self._cache_bytes > self.max_bytes:
+                entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.is_file()),
+                                 key=lambda entry: entry.stat().st_mtime)
+                # Evict down to 90% so a full cache does not evict on every render
+                for entry in entries:
+                    if self._cache_bytes <= self.max_bytes * 0.9:
+                        break
+                    try:
+                        size = entry.stat().st_size
+                        os.remove(entry.path)
+                        self._cache_bytes -= size
+                    except OSError:
+                        continue
+            ANNOTATED_CACHE_BYTES.set(self._cache_bytes)
+
+
+# Configured by create_app
+annotated_renderer = AnnotatedRenderer()
@@ -0,0 +1,183 @@
+"""
+Cascade Module
+Re-classifies detections near the confidence threshold with a crop classifier
+"""
+
+import math
+import os
+import numpy as np
+from utils.metrics import metrics
+from utils.logger import get_logger
+
+logger = get_logger('cascade')
+
+CASCADE_CROPS = metrics.counter(
+    'qoffea_cascade_crops_total',
+    'Ambiguous detections sent to the crop classifier, by outcome',
+    ('verdict',)
+)
+
+
+def crop_boxes(image: np.ndarray, boxes: np.ndarray, padding: float = 0.15) -> list:
+    """
+    Cut padded crops out of an image
+
+    Args:
+        image: BGR image the boxes refer to
+        boxes: (N, 4) xyxy boxes in image coordinates
+        padding: Margin added on every side, as a fraction of the box size
+
+    Returns:
+        List of BGR crops (views into image)
+    """
+    height, width = image.shape[:2]
+    crops = []
+    for x1, y1, x2, y2 in boxes:
+        pad_x = (x2 - x1) * padding
+        pad_y = (y2 - y1) * padding
+        left = min(max(0, int(x1 - pad_x)), width - 1)
+        top = min(max(0, int(y1 - pad_y)), height - 1)
+        right = max(min(width, math.ceil(x2 + pad_x)), left + 1)
+        bottom = max(min(height, math.ceil(y2 + pad_y)), top + 1)
+        crops.append(image[top:bottom, left:right])
+    return crops
+
+
+class Cascade:
+    """
+    Two-stage prediction: a fast detector, then a classifier for borderline beans
+
+    The detector runs at low resolution (optionally with a lighter model)
+    and with its confidence cut lowered to the bottom of the ambiguity band.
+    Detections whose confidence lies inside the band are cropped from the
+    original image and classified in one batch; everything above the band
+    keeps the detector's verdict. The classifier's class and probability
+    replace the detector's, so the usual confidence filter then applies to
+    the merged verdict. Crops the classifier labels with a class the
+    detector does not know (e.g. 'background') are dropped.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.classifier_path = None
+        self.classifier_imgsz = 128
+        self.detector_path = None
+        self.detector_imgsz = None
+        self.band = (0.30, 0.70)
+        self.padding = 0.15
+
+    def configure(self, classifier_path: str, band: tuple = (0.30, 0.70), detector_path: str = None,
+                  detector_imgsz: int = None, classifier_imgsz: int = 128, padding: float = 0.15,
+                  enabled: bool = True):
+        """
+        Apply cascade settings
+
+        Args:
+            classifier_path: Crop classifier, loaded with ModelLoader.load_variant(task='classify')
+            band: (low, high) detector confidences that are sent to the classifier
+            detector_path: Optional lighter detector variant (default: the serving model)
+            detector_imgsz: Detector input size (default: the model's own)
+            classifier_imgsz: Classifier input size
+            padding: Context margin around each crop, as a fraction of the box size
+            enabled: Turn the cascade on or off
+        """
+        self.classifier_path = classifier_path
+        self.band = (float(band[0]), float(band[1]))
+        self.detector_path = detector_path or None
+        self.detector_imgsz = detector_imgsz or None
+        self.classifier_imgsz = classifier_imgsz
+        self.padding = padding
+        self.enabled = bool(enabled and classifier_path)
+        if self.enabled:
+            logger.info("Cascade enabled", extra={
+                'band': self.band,
+                'detector': self.detector_path or 'serving model',
+                'detector_imgsz': self.detector_imgsz,
+                'classifier': self.classifier_path
+            })
+
+    def settings_key(self) -> tuple:
+        """Everything that changes cascade results, for cache keys (model files by mtime and size)"""
+        if not self.enabled:
+            return (False,)
+
+        def file_key(path):
+            try:
+                stat = os.stat(path)
+                return path, stat.st_mtime_ns, stat.st_size
+            except (OSError, TypeError):
+                return path
+
+        return (True, file_key(self.classifier_path), self.classifier_imgsz, file_key(self.detector_path),
+                self.detector_imgsz, self.band, self.padding)
+
+    def detector_options(self, confidence: float, imgsz: int = None, model_path: str = None) -> dict:
+        """
+        Prediction arguments for the first stage
+
+        Args:
+            confidence: Confidence threshold of the request
+            imgsz: Input size chosen by the QoS tier, if any
+            model_path: Model variant chosen by the QoS tier, if any
+
+        Returns:
+            Dict with 'conf', 'imgsz' and 'model_path' for ModelLoader.predict
+        """
+        if not self.enabled:
+            return {'conf': confidence, 'imgsz': imgsz, 'model_path': model_path}
+        sizes = [size for size in (imgsz, self.detector_imgsz) if size]
+        return {
+            'conf': min(confidence, self.band[0]),
+            'imgsz': min(sizes) if sizes else None,
+            'model_path': model_path or self.detector_path
+        }
+
+    def refine(self, results, model_loader) -> dict:
+        """
+        Classify ambiguous detections and merge the verdicts into results in place
+
+        Args:
+            results: Detector results from ModelLoader.predict
+            model_loader: ModelLoader holding the classifier variant
+
+        Returns:
+            Dictionary with the number of ambiguous, changed and rejected detections
+        """
+        stats = {'ambiguous': 0, 'changed': 0, 'rejected': 0}
+        if not self.enabled or len(results) == 0:
+            return stats
+        result = results[0]
+        if result.boxes is None or len(result.boxes) == 0:
+            result.cascade = stats
+            return stats
+
+        data = result.boxes.data.clone()
+        confidences = data[:, 4].cpu().numpy()
+        low, high = self.band
+        ambiguous = np.flatnonzero((confidences >= low) & (confidences < high))
+        stats['ambiguous'] = int(len(ambiguous))
+        if len(ambiguous):
+            crops = crop_boxes(result.orig_img, data[ambiguous, :4].cpu().numpy(), self.padding)
+            verdicts = model_loader.classify(crops, self.classifier_path, self.classifier_imgsz)
+
+            class_ids = {name: class_id for class_id, name in result.names.items()}
+            for index, verdict in zip(ambiguous, verdicts):
+                class_id = class_ids.get(verdict.names[verdict.probs.top1])
+                if class_id is None:
+                    data[index, 4] = 0.0
+                    stats['rejected'] += 1
+                    CASCADE_CROPS.inc(verdict='rejected')
+                    continue
+                changed = class_id != int(data[index, 5])
+                stats['changed'] += int(changed)
+                CASCADE_CROPS.inc(verdict='changed' if changed else 'confirmed')
+                data[index, 4] = float(verdict.probs.top1conf)
+                data[index, 5] = class_id
+            result.update(boxes=data)
+
+        result.cascade = stats
+        return stats
+
+
+# Configured by create_app
+cascade = Cascade()
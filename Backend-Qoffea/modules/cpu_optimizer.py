@@ -0,0 +1,239 @@
+"""
+CPU Optimizer Module
+Opt-in graph-level optimizations for CPU inference, verified against eager mode
+"""
+
+import functools
+import os
+import time
+import cv2
+import numpy as np
+import torch
+from utils.logger import get_logger
+
+logger = get_logger('cpu_optimizer')
+
+
+def cpu_supports_bf16() -> bool:
+    """Check for native bf16 matmul support (AVX512-BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return torch.backends.mkldnn.is_available() and ('avx512_bf16' in flags or 'amx_bf16' in flags)
+
+
+def make_check_image(size: int = 960, beans: int = 60, seed: int = 7) -> np.ndarray:
+    """
+    Synthetic tray with bean-like ellipses, used when no reference image is configured
+
+    A trained bean detector usually finds nothing here, which makes the
+    self-check inconclusive (and the optimizations are then not kept);
+    configure a real reference photo instead.
+
+    Returns:
+        BGR image
+    """
+    rng = np.random.default_rng(seed)
+    image = np.full((size, size, 3), (200, 205, 210), dtype=np.uint8)
+    for _ in range(beans):
+        center = (int(rng.integers(30, size - 30)), int(rng.integers(30, size - 30)))
+        axes = (int(rng.integers(12, 22)), int(rng.integers(8, 14)))
+        color = tuple(int(c) for c in rng.integers(20, 90, 3))
+        cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360, color, -1)
+        cv2.line(image, (center[0] - axes[0] // 2, center[1]), (center[0] + axes[0] // 2, center[1]), (15, 15, 15), 1)
+    return image
+
+
+def _detections(results) -> tuple:
+    boxes = results[0].boxes
+    if boxes is None or len(boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0)
+    return boxes.xyxy.cpu().numpy(), boxes.cls.cpu().numpy(), boxes.conf.cpu().numpy()
+
+
+def _box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Pairwise IoU of two (N, 4) and (M, 4) xyxy arrays"""
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def compare_detections(reference, candidate, min_iou: float = 0.9, conf_tolerance: float = 0.05,
+                       max_unmatched: float = 0.02) -> dict:
+    """
+    Check that two prediction results agree
+
+    Each reference box must be matched by a candidate box of the same class
+    with IoU >= min_iou and a confidence within conf_tolerance. Boxes near
+    the confidence threshold may legitimately flip, so a small fraction
+    (max_unmatched) is allowed to go unmatched. Without any detections
+    there is nothing to compare, so the check does not pass.
+
+    Returns:
+        Dictionary with 'passed' and match statistics ('inconclusive' when
+        neither result has detections)
+    """
+    ref_boxes, ref_cls, ref_conf = _detections(reference)
+    cand_boxes, cand_cls, cand_conf = _detections(candidate)
+    total = max(len(ref_boxes), len(cand_boxes))
+    if total == 0:
+        return {'passed': False, 'inconclusive': True, 'reference': 0, 'candidate': 0, 'matched': 0,
+                'max_conf_delta': 0.0}
+
+    matched = 0
+    max_conf_delta = 0.0
+    if len(ref_boxes) and len(cand_boxes):
+        iou = _box_iou(ref_boxes, cand_boxes)
+        iou[ref_cls[:, None] != cand_cls[None, :]] = 0
+        used = set()
+        for i in np.argsort(-ref_conf):
+            candidates = [j for j in np.argsort(-iou[i]) if j not in used and iou[i, j] >= min_iou]
+            if not candidates:
+                continue
+            j = candidates[0]
+            delta = abs(float(ref_conf[i]) - float(cand_conf[j]))
+            if delta <= conf_tolerance:
+                used.add(j)
+                matched += 1
+                max_conf_delta = max(max_conf_delta, delta)
+
+    unmatched = total - matched
+    return {
+        'passed': unmatched <= max(1, int(total * max_unmatched)) if total > 10 else unmatched == 0,
+        'reference': int(len(ref_boxes)),
+        'candidate': int(len(cand_boxes)),
+        'matched': matched,
+        'max_conf_delta': round(max_conf_delta, 4)
+    }
+
+
+def _time_predict(model, image: np.ndarray, runs: int, **kwargs) -> tuple:
+    results = None
+    start = time.perf_counter()
+    for _ in range(runs):
+        results = model(image, verbose=False, **kwargs)
+    return results, (time.perf_counter() - start) * 1000 / runs
+
+
+def optimize_for_cpu(model, use_compile: bool = False, bf16: str = 'auto', cache_dir: str = None,
+                     check_image: np.ndarray = None, predict_args: dict = None, runs: int = 3) -> dict:
+    """
+    Apply CPU optimizations to a YOLO model in place and verify them
+
+    Steps: Conv+BN fusion, channels_last weights, optional torch.compile
+    (with the inductor FX graph cache in cache_dir) and bf16 autocast.
+    The forward pass keeps running under torch.inference_mode. Detections
+    on check_image are compared with eager mode afterwards; on mismatch,
+    or when eager mode detects nothing to compare, every step except
+    fusion is undone.
+
+    Args:
+        model: ultralytics YOLO instance loaded from a .pt file
+        use_compile: Wrap the network in torch.compile
+        bf16: 'auto' (when the CPU has native bf16), 'on' or 'off'
+        cache_dir: Directory for compiled-graph caches
+        check_image: BGR photo of beans for the self-check (default: synthetic
+            tray, which rarely yields detections; see make_check_image)
+        predict_args: conf/iou/max_det used for the comparison
+        runs: Timed runs for the before/after latency
+
+    Returns:
+        Report with applied steps, latencies and the self-check result
+    """
+    predict_args = predict_args or {}
+    if check_image is None:
+        logger.warning("No self-check image configured (MODEL_SELF_CHECK_IMAGE); using a synthetic tray, "
+                       "optimizations are only kept if the model detects beans on it")
+        check_image = make_check_image()
+    image = check_image
+
+    # The first call builds the predictor and its AutoBackend
+    reference, eager_ms = _time_predict(model, image, runs, **predict_args)
+    backend = getattr(model.predictor, 'model', None)
+    network = getattr(backend, 'model', None)
+    if not getattr(backend, 'pt', False) or not isinstance(network, torch.nn.Module):
+        logger.warning("CPU optimizations skipped; model is not a PyTorch module (already exported)")
+        return {'applied': [], 'self_check': {'passed': True}, 'eager_ms': round(eager_ms, 1)}
+
+    applied = []
+    original_forward = backend.forward
+
+    if hasattr(network, 'fuse') and not (hasattr(network, 'is_fused') and network.is_fused()):
+        network.fuse()
+    applied.append('fuse')
+
+    network.to(memory_format=torch.channels_last)
+    applied.append('channels_last')
+
+    use_bf16 = bf16 == 'on' or (bf16 == 'auto' and cpu_supports_bf16())
+    compiled = None
+    if use_compile:
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+            os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+        try:
+            compiled = torch.compile(network, dynamic=True)
+            backend.model = compiled
+            applied.append('torch.compile')
+        except Exception as e:
+            logger.warning("torch.compile unavailable", extra={'error': str(e)})
+
+    @functools.wraps(original_forward)
+    def forward(im, *args, **kwargs):
+        with torch.inference_mode():
+            im = im.contiguous(memory_format=torch.channels_last)
+            if use_bf16:
+                with torch.autocast('cpu', dtype=torch.bfloat16):
+                    output = original_forward(im, *args, **kwargs)
+                # Postprocessing (NMS, box scaling) expects float32
+                if isinstance(output, (list, tuple)):
+                    return type(output)(o.float() if torch.is_tensor(o) else o for o in output)
+                return output.float() if torch.is_tensor(output) else output
+            return original_forward(im, *args, **kwargs)
+
+    backend.forward = forward
+    applied.append('inference_mode')
+    if use_bf16:
+        applied.append('bf16_autocast')
+
+    # Warm-up (compilation happens here) and self-check against eager
+    try:
+        _time_predict(model, image, 1, **predict_args)
+        candidate, optimized_ms = _time_predict(model, image, runs, **predict_args)
+        check = compare_detections(reference, candidate)
+    except Exception as e:
+        logger.exception("Optimized model failed during warm-up")
+        candidate, optimized_ms = None, None
+        check = {'passed': False, 'error': str(e)}
+
+    if not check['passed']:
+        # Fall back to eager (fusion is kept: ultralytics fuses on load anyway)
+        backend.forward = original_forward
+        if compiled is not None:
+            backend.model = network
+        network.to(memory_format=torch.contiguous_format)
+        if check.get('inconclusive'):
+            logger.warning("CPU optimizations disabled; self-check image has no detections to compare",
+                           extra={'applied': applied, 'self_check': check})
+        else:
+            logger.warning("CPU optimizations disabled; detections differ from eager mode",
+                           extra={'applied': applied, 'self_check': check})
+        applied = ['fuse']
+
+    report = {
+        'applied': applied,
+        'eager_ms': round(eager_ms, 1),
+        'optimized_ms': round(optimized_ms, 1) if optimized_ms else None,
+        'self_check': check
+    }
+    if check['passed']:
+        logger.info("CPU optimizations applied", extra=report)
+    else:
+        logger.info("CPU optimizations reverted to eager mode", extra=report)
+    return report
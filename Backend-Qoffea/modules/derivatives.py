@@ -0,0 +1,309 @@
+"""
+Derivatives Module
+Thumbnails, previews and Deep Zoom tile pyramids of analysed images, generated on first request
+"""
+
+import mimetypes
+import os
+import re
+import shutil
+import threading
+import cv2
+from utils import FileHandler
+from utils.metrics import metrics, stage_timer
+from utils.logger import get_logger
+from modules.image_processor import ImageProcessor
+from modules.annotated_renderer import annotated_renderer, write_atomic
+
+logger = get_logger('derivatives')
+
+DERIVATIVE_REQUESTS = metrics.counter(
+    'qoffea_derivative_requests_total',
+    'Derivative image requests, by kind and cache result',
+    ('kind', 'result')
+)
+DERIVATIVE_CACHE_BYTES = metrics.gauge(
+    'qoffea_derivative_cache_bytes',
+    'Size of the derivative image cache'
+)
+
+# Names under /derivatives/<analysis_id>/, laid out the way Deep Zoom viewers expect
+ANALYSIS_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+SIZED_PATTERN = re.compile(r'^(original|annotated)_(thumb|preview)\.jpg$')
+DZI_PATTERN = re.compile(r'^(original|annotated)\.dzi$')
+TILE_PATTERN = re.compile(r'^(original|annotated)_files/(\d+)/(\d+)_(\d+)\.jpg$')
+
+# Derived from user photos, which are deleted after 24 hours: browser cache only
+DERIVATIVE_CACHE_CONTROL = 'private, max-age=86400'
+
+# Deep Zoom descriptors are XML; viewers fetch them with XHR
+mimetypes.add_type('application/xml', '.dzi')
+
+
+class DerivativeStore:
+    """
+    Lazily generated, disk-cached image derivatives
+
+    Each analysis gets a folder in cache_dir holding, per source image
+    (original upload or annotated image), a thumbnail, a medium preview and
+    a Deep Zoom pyramid (<source>.dzi plus <source>_files/<level>/<col>_<row>.jpg).
+    Thumbnails and previews are made on their first request; the whole
+    pyramid is cut on the first request for its descriptor or any tile, and
+    the descriptor is written last so its presence marks a complete pyramid.
+    Derivatives never change for an analysis, so clients may keep them as
+    long as the upload exists. Whole analysis folders are evicted, least
+    recently used first, once the cache grows past max_bytes, and by
+    cleanup() once their upload is gone.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._building = {}
+        self._cache_bytes = None
+        self.configure(os.path.join(annotated_renderer.cache_dir, 'derivatives'))
+
+    def configure(self, cache_dir: str, thumbnail_size: int = 256, preview_size: int = 1024,
+                  tile_size: int = 254, tile_overlap: int = 1, quality: int = 80, max_cache_mb: float = 1024):
+        """
+        Apply derivative settings
+
+        Args:
+            cache_dir: Folder for generated derivatives
+            thumbnail_size: Longest side of thumbnails
+            preview_size: Longest side of medium previews
+            tile_size: Deep Zoom tile side without overlap
+            tile_overlap: Pixels shared by neighbouring tiles
+            quality: JPEG quality (1-100)
+            max_cache_mb: Cache size before least recently used analyses are evicted
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.sizes = {'thumb': thumbnail_size, 'preview': preview_size}
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.quality = quality
+        self.max_bytes = max_cache_mb * 1024 * 1024
+        self._cache_bytes = None
+
+    @staticmethod
+    def urls(analysis_id: str, source: str = 'annotated') -> dict:
+        """
+        Public URLs of the derivatives of an analysis
+
+        Args:
+            analysis_id: ID of analysis
+            source: 'original' or 'annotated'
+
+        Returns:
+            Dictionary with 'thumbnail', 'preview' and 'dzi' paths
+        """
+        prefix = f"/derivatives/{analysis_id}/{source}"
+        return {
+            'thumbnail': f"{prefix}_thumb.jpg",
+            'preview': f"{prefix}_preview.jpg",
+            'dzi': f"{prefix}.dzi"
+        }
+
+    def resolve(self, analysis_id: str, name: str):
+        """
+        Path of a derivative, generating it if needed
+
+        Args:
+            analysis_id: ID of analysis
+            name: Derivative name, e.g. 'annotated_preview.jpg' or 'annotated_files/12/3_4.jpg'
+
+        Returns:
+            Absolute path, or None if the analysis or derivative does not exist
+        """
+        if not ANALYSIS_ID_PATTERN.match(analysis_id):
+            return None
+        folder = os.path.join(self.cache_dir, analysis_id)
+
+        match = SIZED_PATTERN.match(name)
+        if match:
+            return self._sized(analysis_id, folder, match.group(1), match.group(2))
+
+        match = DZI_PATTERN.match(name) or TILE_PATTERN.match(name)
+        if match:
+            kind = 'dzi' if name.endswith('.dzi') else 'tile'
+            if not self._pyramid(analysis_id, folder, match.group(1)):
+                DERIVATIVE_REQUESTS.inc(kind=kind, result='missing')
+                return None
+            path = os.path.join(folder, name)
+            # Tiles outside the pyramid do not exist
+            return path if os.path.exists(path) else None
+
+        return None
+
+    def _source_path(self, analysis_id: str, source: str):
+        """Encoded file a derivative is made from, or None"""
+        record = annotated_renderer.load_record(analysis_id)
+        if source == 'annotated':
+            return annotated_renderer.path_for(analysis_id, record['image']) if record else None
+        image_filename = record['image'] if record else FileHandler.find_upload(annotated_renderer.upload_folder,
+                                                                                 analysis_id)
+        return os.path.join(annotated_renderer.upload_folder, image_filename) if image_filename else None
+
+    def _sized(self, analysis_id: str, folder: str, source: str, kind: str):
+        path = os.path.join(folder, f"{source}_{kind}.jpg")
+        if os.path.exists(path):
+            DERIVATIVE_REQUESTS.inc(kind=kind, result='hit')
+            self._touch(folder)
+            return path
+
+        # One generation per file even when several requests arrive at once
+        with self._lock:
+            key_lock = self._building.setdefault(path, threading.Lock())
+        with key_lock:
+            try:
+                if os.path.exists(path):
+                    DERIVATIVE_REQUESTS.inc(kind=kind, result='hit')
+                    return path
+                source_path = self._source_path(analysis_id, source)
+                if source_path is None or not os.path.exists(source_path):
+                    DERIVATIVE_REQUESTS.inc(kind=kind, result='missing')
+                    return None
+
+                with stage_timer('draw'):
+                    image = ImageProcessor.load_reduced(source_path, self.sizes[kind])
+                    image = ImageProcessor.resize_to_fit(image, self.sizes[kind])
+                with stage_timer('encode'):
+                    data = self._encode(image)
+                    os.makedirs(folder, exist_ok=True)
+                    write_atomic(path, data)
+            finally:
+                with self._lock:
+                    self._building.pop(path, None)
+
+        DERIVATIVE_REQUESTS.inc(kind=kind, result='generated')
+        self._account(len(data))
+        return path
+
+    def _pyramid(self, analysis_id: str, folder: str, source: str) -> bool:
+        """Make sure the pyramid of a source exists; False if there is nothing to cut"""
+        descriptor = os.path.join(folder, f"{source}.dzi")
+        if os.path.exists(descriptor):
+            DERIVATIVE_REQUESTS.inc(kind='pyramid', result='hit')
+            self._touch(folder)
+            return True
+
+        with self._lock:
+            key_lock = self._building.setdefault(descriptor, threading.Lock())
+        with key_lock:
+            try:
+                if os.path.exists(descriptor):
+                    DERIVATIVE_REQUESTS.inc(kind='pyramid', result='hit')
+                    return True
+
+                with stage_timer('draw'):
+                    if source == 'annotated':
+                        # Full resolution, so zoomed-in tiles are sharp
+                        image = annotated_renderer.draw(analysis_id)
+                    else:
+                        source_path = self._source_path(analysis_id, source)
+                        image = ImageProcessor.load_image(source_path) \
+                            if source_path and os.path.exists(source_path) else None
+                if image is None:
+                    return False
+
+                tiles_folder = os.path.join(folder, f"{source}_files")
+                # Leftovers of an interrupted build
+                shutil.rmtree(tiles_folder, ignore_errors=True)
+                added = 0
+                with stage_timer('encode'):
+                    for level, col, row, tile in ImageProcessor.build_tile_pyramid(image, self.tile_size,
+                                                                                   self.tile_overlap):
+                        level_folder = os.path.join(tiles_folder, str(level))
+                        if col == 0 and row == 0:
+                            os.makedirs(level_folder, exist_ok=True)
+                        data = self._encode(tile)
+                        with open(os.path.join(level_folder, f"{col}_{row}.jpg"), 'wb') as f:
+                            f.write(data)
+                        added += len(data)
+                    height, width = image.shape[:2]
+                    write_atomic(descriptor, ImageProcessor.dzi_descriptor(
+                        width, height, self.tile_size, self.tile_overlap).encode())
+            finally:
+                with self._lock:
+                    self._building.pop(descriptor, None)
+
+        DERIVATIVE_REQUESTS.inc(kind='pyramid', result='generated')
+        logger.info("Tile pyramid generated",
+                    extra={'analysis_id': analysis_id, 'source': source, 'bytes': added})
+        self._account(added)
+        return True
+
+    def _encode(self, image) -> bytes:
+        ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            raise RuntimeError("Failed to encode derivative image")
+        return encoded.tobytes()
+
+    def cleanup(self) -> int:
+        """
+        Delete the derivatives of analyses whose upload has been cleaned up
+
+        Returns:
+            Number of analysis folders removed
+        """
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        removed = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir():
+                continue
+            source = self._source_path(entry.name, 'original')
+            if source and os.path.exists(source):
+                continue
+            size = _folder_size(entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed += 1
+            with self._lock:
+                if self._cache_bytes is not None:
+                    self._cache_bytes -= size
+                    DERIVATIVE_CACHE_BYTES.set(self._cache_bytes)
+        if removed:
+            logger.info("Derivatives of deleted uploads removed", extra={'analyses': removed})
+        return removed
+
+    @staticmethod
+    def _touch(folder: str):
+        # Folder mtime orders eviction
+        try:
+            os.utime(folder)
+        except OSError:
+            pass
+
+    def _account(self, added: int):
+        """Track the cache size and evict the least recently used analyses past the limit"""
+        with self._lock:
+            if self._cache_bytes is None:
+                self._cache_bytes = sum(_folder_size(entry.path) for entry in os.scandir(self.cache_dir)
+                                        if entry.is_dir())
+            else:
+                self._cache_bytes += added
+            if self._cache_bytes > self.max_bytes:
+                entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.is_dir()),
+                                 key=lambda entry: entry.stat().st_mtime)
+                # Evict down to 90% so a full cache does not evict on every request
+                for entry in entries:
+                    if self._cache_bytes <= self.max_bytes * 0.9:
+                        break
+                    size = _folder_size(entry.path)
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    self._cache_bytes -= size
+            DERIVATIVE_CACHE_BYTES.set(self._cache_bytes)
+
+
+def _folder_size(folder: str) -> int:
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+# Configured by create_app
+derivative_store = DerivativeStore()
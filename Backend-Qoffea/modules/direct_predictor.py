@@ -0,0 +1,175 @@
+"""
+Direct Predictor Module
+Runs a configured ultralytics predictor on decoded images through reusable buffers
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+import cv2
+import numpy as np
+import torch
+from utils.logger import get_logger
+
+logger = get_logger('direct_predictor')
+
+# Letterbox padding colour used by ultralytics
+PAD_VALUE = 114
+# Distinct letterbox shapes (image aspect ratios) kept per thread
+MAX_BUFFER_SHAPES = 4
+
+
+class LetterboxBuffers:
+    """
+    Preallocated letterbox canvas and input tensor for one output shape
+
+    The canvas holds the padded uint8 image and the tensor the normalized
+    float32 (1, 3, H, W) network input; both are reused for every image that
+    letterboxes to the same shape.
+    """
+
+    def __init__(self, height: int, width: int):
+        self.canvas = np.full((height, width, 3), PAD_VALUE, dtype=np.uint8)
+        self.tensor = torch.empty((1, 3, height, width), dtype=torch.float32)
+        self.planes = self.tensor.numpy()[0]
+        # Region the last image was resized into; the rest is padding
+        self.content = None
+        self.resized = None
+
+
+class DirectPredictor:
+    """
+    Inference on decoded BGR arrays without ultralytics' per-call setup
+
+    `model(source, ...)` re-reads files, builds a new data loader, rebuilds
+    the predictor arguments with get_cfg and allocates fresh letterbox and
+    tensor buffers for every image. This path reuses the predictor the model
+    already set up on its first call and only updates conf/iou/max_det. The
+    letterbox (same geometry as ultralytics' LetterBox) is written into
+    per-thread buffers keyed by output shape, and BGR->RGB, HWC->CHW and the
+    /255 scaling happen in one pass into the preallocated input tensor.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _buffers(self, height: int, width: int) -> LetterboxBuffers:
+        pool = getattr(self._local, 'pool', None)
+        if pool is None:
+            pool = self._local.pool = OrderedDict()
+        buffers = pool.get((height, width))
+        if buffers is None:
+            buffers = LetterboxBuffers(height, width)
+            pool[(height, width)] = buffers
+            if len(pool) > MAX_BUFFER_SHAPES:
+                pool.popitem(last=False)
+        else:
+            pool.move_to_end((height, width))
+        return buffers
+
+    @staticmethod
+    def supports(model, image) -> bool:
+        """Whether the direct path can serve this model and input"""
+        predictor = getattr(model, 'predictor', None)
+        return (predictor is not None and getattr(predictor, 'model', None) is not None
+                and getattr(predictor.args, 'task', 'detect') == 'detect'
+                and isinstance(image, np.ndarray) and image.ndim == 3 and image.shape[2] == 3)
+
+    def letterbox(self, image: np.ndarray, imgsz: int, stride: int, auto: bool) -> LetterboxBuffers:
+        """
+        Letterbox an image into reusable buffers and fill the input tensor
+
+        Args:
+            image: BGR image
+            imgsz: Target size (longest side)
+            stride: Model stride; padding is trimmed to a multiple of it when auto
+            auto: Pad to the smallest stride-aligned rectangle instead of a square
+
+        Returns:
+            LetterboxBuffers with the normalized input in .tensor
+        """
+        size = math.ceil(imgsz / stride) * stride
+        height, width = image.shape[:2]
+        ratio = min(size / height, size / width)
+        new_w, new_h = round(width * ratio), round(height * ratio)
+        pad_w, pad_h = size - new_w, size - new_h
+        if auto:
+            pad_w, pad_h = pad_w % stride, pad_h % stride
+        pad_w, pad_h = pad_w / 2, pad_h / 2
+        top, bottom = round(pad_h - 0.1), round(pad_h + 0.1)
+        left, right = round(pad_w - 0.1), round(pad_w + 0.1)
+
+        buffers = self._buffers(new_h + top + bottom, new_w + left + right)
+        content = (top, left, new_h, new_w)
+        if buffers.content != content:
+            # A different placement leaves old pixels in what is now padding
+            buffers.canvas.fill(PAD_VALUE)
+            buffers.content = content
+        region = buffers.canvas[top:top + new_h, left:left + new_w]
+        if (new_w, new_h) != (width, height):
+            if buffers.resized is None or buffers.resized.shape[:2] != (new_h, new_w):
+                buffers.resized = np.empty((new_h, new_w, 3), dtype=np.uint8)
+            cv2.resize(image, (new_w, new_h), dst=buffers.resized, interpolation=cv2.INTER_LINEAR)
+            np.copyto(region, buffers.resized)
+        else:
+            np.copyto(region, image)
+
+        # BGR HWC uint8 -> RGB CHW float32 in [0, 1], written in place
+        for channel in range(3):
+            np.multiply(buffers.canvas[:, :, 2 - channel], 1 / 255, out=buffers.planes[channel],
+                        casting='unsafe')
+        return buffers
+
+    def predict(self, model, image: np.ndarray, conf: float, iou: float, max_det: int, imgsz: int = None):
+        """
+        Run one decoded image through the model's existing predictor
+
+        Args:
+            model: ultralytics YOLO instance whose predictor has been set up
+            image: BGR image
+            conf: Confidence threshold
+            iou: IoU threshold for NMS
+            max_det: Maximum detections
+            imgsz: Inference size (default: the predictor's)
+
+        Returns:
+            List with one Results object, like model(image)
+        """
+        predictor = model.predictor
+        backend = predictor.model
+        args = predictor.args
+        args.conf, args.iou, args.max_det = conf, iou, max_det
+
+        start = time.perf_counter()
+        size = imgsz or (args.imgsz if isinstance(args.imgsz, int) else max(args.imgsz))
+        stride = max(int(getattr(backend, 'stride', 32)), 32)
+        # Same rule as ultralytics: only PyTorch models take variable rectangles
+        buffers = self.letterbox(image, size, stride, auto=bool(getattr(backend, 'pt', False)))
+        tensor = buffers.tensor
+        if predictor.device.type != 'cpu':
+            tensor = tensor.to(predictor.device, non_blocking=True)
+        if getattr(backend, 'fp16', False):
+            tensor = tensor.half()
+        preprocessed = time.perf_counter()
+
+        with torch.inference_mode():
+            preds = predictor.inference(tensor)
+            inferred = time.perf_counter()
+            # construct_results reads source paths from the current batch
+            predictor.batch = ([''], [image], [''])
+            results = predictor.postprocess(preds, tensor, [image])
+        finished = time.perf_counter()
+
+        speed = {
+            'preprocess': (preprocessed - start) * 1000,
+            'inference': (inferred - preprocessed) * 1000,
+            'postprocess': (finished - inferred) * 1000
+        }
+        for result in results:
+            result.speed = speed
+        return results
+
+
+# Shared by every model; buffers are per thread
+direct_predictor = DirectPredictor()
@@ -7,10 +7,26 @@ import cv2
 import numpy as np
 from PIL import Image
 from pathlib import Path
+from utils.logger import get_logger, SampledLogger
+
+logger = get_logger('image_processor')
+detection_logger = SampledLogger(get_logger('image_processor.detections'))
 
 
 class ImageProcessor:
     
+    # Box colors for each class (BGR format)
+    CLASS_COLORS = {
+        'Specialty': (0, 255, 0),      # Green - Good quality
+        'specialty': (0, 255, 0),      # Green - Good quality (lowercase)
+        'good': (0, 255, 0),           # Green - Good quality
+        'Defect': (0, 0, 255),         # Red - Bad quality
+        'defect': (0, 0, 255),         # Red - Bad quality (lowercase)
+        'break': (0, 0, 255),          # Red - Bad quality
+        'coffee-grade-good': (0, 255, 0),   # Green - Old model
+        'coffee-grade-break': (0, 0, 255),  # Red - Old model
+    }
+    
     @staticmethod
     def validate_image(file_path: str) -> bool:
         """
@@ -27,7 +43,7 @@ class ImageProcessor:
             img.verify()
             return True
         except Exception as e:
-            print(f"❌ Invalid image: {e}")
+            logger.warning("Invalid image", extra={'path': file_path, 'error': str(e)})
             return False
     
     @staticmethod
@@ -79,6 +95,144 @@ class ImageProcessor:
         
         return img
     
+    @staticmethod
+    def load_image(file_path: str) -> np.ndarray:
+        """
+        Decode image file into a BGR array
+        
+        Args:
+            file_path: Path to image file
+            
+        Returns:
+            Decoded image as numpy array (BGR)
+        """
+        img = cv2.imread(file_path)
+        
+        if img is None:
+            raise ValueError(f"Failed to load image: {file_path}")
+        
+        return img
+    
+    @staticmethod
+    def save_image(img: np.ndarray, output_path: str) -> str:
+        """
+        Encode image array to file (format from extension)
+        
+        Args:
+            img: BGR image array
+            output_path: Path to save image
+            
+        Returns:
+            Path to saved image
+        """
+        if not cv2.imwrite(output_path, img):
+            raise ValueError(f"Failed to write image: {output_path}")
+        return output_path
+    
+    @staticmethod
+    def load_reduced(file_path: str, max_side: int) -> np.ndarray:
+        """
+        Decode an image at roughly the size it will be shown
+        
+        JPEG files are decoded at 1/2, 1/4 or 1/8 scale by the decoder itself
+        when that still covers max_side, which is far cheaper than decoding
+        the full photo and resizing it.
+        
+        Args:
+            file_path: Path to image file
+            max_side: Longest side needed
+        
+        Returns:
+            Decoded image as numpy array (BGR), reduced by up to 8x
+        """
+        with Image.open(file_path) as header:
+            longest = max(header.size)
+        flag = cv2.IMREAD_COLOR
+        for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if longest // factor >= max_side:
+                flag = reduced
+                break
+        img = cv2.imread(file_path, flag)
+        
+        if img is None:
+            raise ValueError(f"Failed to load image: {file_path}")
+        
+        return img
+    
+    @staticmethod
+    def resize_to_fit(img: np.ndarray, max_side: int) -> np.ndarray:
+        """
+        Downscale an image so its longest side is at most max_side
+        
+        Args:
+            img: BGR image array
+            max_side: Longest side in pixels
+        
+        Returns:
+            Resized image, or img itself when it already fits
+        """
+        height, width = img.shape[:2]
+        scale = max_side / max(height, width)
+        if scale >= 1.0:
+            return img
+        return cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                          interpolation=cv2.INTER_AREA)
+    
+    @staticmethod
+    def dzi_descriptor(width: int, height: int, tile_size: int, overlap: int, fmt: str = 'jpg') -> str:
+        """
+        Deep Zoom (DZI) descriptor of a tile pyramid
+        
+        Args:
+            width: Full-resolution width
+            height: Full-resolution height
+            tile_size: Tile side without overlap
+            overlap: Pixels shared with each neighbouring tile
+            fmt: Tile file extension
+        
+        Returns:
+            DZI XML document
+        """
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{fmt}" '
+                f'Overlap="{overlap}" TileSize="{tile_size}">'
+                f'<Size Width="{width}" Height="{height}"/></Image>\n')
+    
+    @staticmethod
+    def build_tile_pyramid(img: np.ndarray, tile_size: int = 254, overlap: int = 1):
+        """
+        Cut an image into a Deep Zoom tile pyramid
+        
+        Level N (the highest) is the full image and each level below is half
+        the size of the one above, down to level 0 at 1x1 pixel. Each level is
+        downscaled from the previous one rather than from the full image.
+        
+        Args:
+            img: Full-resolution BGR image
+            tile_size: Tile side without overlap
+            overlap: Pixels shared with each neighbouring tile
+        
+        Yields:
+            Tuples of (level, column, row, tile)
+        """
+        height, width = img.shape[:2]
+        max_level = int(np.ceil(np.log2(max(height, width))))
+        level_img = img
+        for level in range(max_level, -1, -1):
+            level_h, level_w = level_img.shape[:2]
+            for row in range((level_h + tile_size - 1) // tile_size):
+                for col in range((level_w + tile_size - 1) // tile_size):
+                    x1 = max(0, col * tile_size - overlap)
+                    y1 = max(0, row * tile_size - overlap)
+                    x2 = min(level_w, (col + 1) * tile_size + overlap)
+                    y2 = min(level_h, (row + 1) * tile_size + overlap)
+                    yield level, col, row, level_img[y1:y2, x1:x2]
+            if level > 0:
+                # DZI level sizes are ceil(size / 2) of the level above
+                level_img = cv2.resize(level_img, ((level_w + 1) // 2, (level_h + 1) // 2),
+                                       interpolation=cv2.INTER_AREA)
+    
     @staticmethod
     def draw_detections(image_path: str, results, output_path: str, min_confidence: float = 0.52) -> str:
         """
@@ -96,18 +250,25 @@ class ImageProcessor:
         # Read original image
         img = cv2.imread(image_path)
         
-        # Define colors for each class (BGR format)
-        class_colors = {
-            'Specialty': (0, 255, 0),      # Green - Good quality
-            'specialty': (0, 255, 0),      # Green - Good quality (lowercase)
-            'good': (0, 255, 0),           # Green - Good quality
-            'Defect': (0, 0, 255),         # Red - Bad quality
-            'defect': (0, 0, 255),         # Red - Bad quality (lowercase)
-            'break': (0, 0, 255),          # Red - Bad quality
-            'coffee-grade-good': (0, 255, 0),   # Green - Old model
-            'coffee-grade-break': (0, 0, 255),  # Red - Old model
-        }
+        ImageProcessor.render_detections(img, results, min_confidence)
+        
+        # Save annotated image
+        cv2.imwrite(output_path, img)
+        return output_path
+    
+    @staticmethod
+    def render_detections(img: np.ndarray, results, min_confidence: float = 0.52) -> np.ndarray:
+        """
+        Draw detection boxes in place on a decoded image
         
+        Args:
+            img: Decoded BGR image, modified in place
+            results: YOLO prediction results
+            min_confidence: Minimum confidence threshold to display
+            
+        Returns:
+            The annotated image
+        """
         if len(results) > 0 and results[0].boxes is not None:
             # Get boxes, classes, and confidences
             boxes = results[0].boxes.xyxy.cpu().numpy()
@@ -115,34 +276,58 @@ class ImageProcessor:
             confidences = results[0].boxes.conf.cpu().numpy()
             names = results[0].names
             
+            trace_detections = detection_logger.enabled()
+            
             # Draw each detection ONLY if confidence >= min_confidence
             for box, cls, conf in zip(boxes, classes, confidences):
                 # CRITICAL FILTER: Skip detections below minimum confidence
                 if conf < min_confidence:
-                    print(f"🚫 Skipping low confidence detection: {conf:.2f} < {min_confidence}")
+                    if trace_detections:
+                        detection_logger.debug("Skipping low-confidence detection",
+                                               extra={'confidence': round(float(conf), 3), 'threshold': min_confidence})
                     continue
                 
-                x1, y1, x2, y2 = map(int, box)
-                class_name = names[int(cls)]
-                label = f"{class_name} {conf:.2f}"
-                
-                # Get color for this class (default to blue if not found)
-                color = class_colors.get(class_name, (255, 0, 0))
-                
-                # Draw rectangle with thicker border
-                cv2.rectangle(img, (x1, y1), (x2, y2), color, 3)
-                
-                # Draw label background
-                label_size, baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)
-                y1_label = max(y1, label_size[1] + 10)
-                cv2.rectangle(img, (x1, y1_label - label_size[1] - 10), 
-                            (x1 + label_size[0], y1_label + baseline - 10), 
-                            color, -1)
-                
-                # Draw label text
-                cv2.putText(img, label, (x1, y1_label - 7), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+                ImageProcessor._draw_box(img, box, names[int(cls)], conf)
         
-        # Save annotated image
-        cv2.imwrite(output_path, img)
-        return output_path
+        return img
+    
+    @staticmethod
+    def render_detection_list(img: np.ndarray, detections: list, scale: float = 1.0) -> np.ndarray:
+        """
+        Draw stored detections (as returned in analysis results) in place
+        
+        Args:
+            img: Decoded BGR image, modified in place
+            detections: List of dicts with 'class_name', 'confidence' and 'bbox'
+            scale: Factor from detection coordinates to img coordinates
+            
+        Returns:
+            The annotated image
+        """
+        for detection in detections:
+            box = [coordinate * scale for coordinate in detection['bbox']]
+            ImageProcessor._draw_box(img, box, detection['class_name'], detection['confidence'])
+        return img
+    
+    @staticmethod
+    def _draw_box(img: np.ndarray, box, class_name: str, conf: float):
+        """Draw one labelled detection box"""
+        x1, y1, x2, y2 = map(int, box)
+        label = f"{class_name} {conf:.2f}"
+        
+        # Get color for this class (default to blue if not found)
+        color = ImageProcessor.CLASS_COLORS.get(class_name, (255, 0, 0))
+        
+        # Draw rectangle with thicker border
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, 3)
+        
+        # Draw label background
+        label_size, baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)
+        y1_label = max(y1, label_size[1] + 10)
+        cv2.rectangle(img, (x1, y1_label - label_size[1] - 10), 
+                    (x1 + label_size[0], y1_label + baseline - 10), 
+                    color, -1)
+        
+        # Draw label text
+        cv2.putText(img, label, (x1, y1_label - 7), 
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
@@ -7,7 +7,27 @@ from ultralytics import YOLO
 import torch
 from pathlib import Path
 import os
+import gc
+import json
+import threading
+import time
+from contextlib import contextmanager
+import cv2
+import numpy as np
 from huggingface_hub import hf_hub_download
+from utils.metrics import metrics, stage_timer, record_model_speed, MODEL_REPLICAS
+from utils.admission import admission, INTERACTIVE
+from utils.deadline import check_deadline
+from utils.logger import get_logger
+from modules.direct_predictor import direct_predictor
+
+logger = get_logger('model_loader')
+
+MODEL_VERSION_INFO = metrics.gauge(
+    'qoffea_model_version_info',
+    'Model version serving new requests (value is always 1)',
+    ('version',)
+)
 
 # Configure PyTorch to allow loading custom model architectures
 # This is safe for trusted model files from Ultralytics
@@ -37,16 +57,91 @@ try:
                     safe_classes.append(module_obj)
         
         torch.serialization.add_safe_globals(safe_classes)
-        print("✅ Registered Ultralytics safe globals for PyTorch")
+        logger.debug("Registered Ultralytics safe globals for PyTorch")
 except Exception as e:
-    print(f"⚠️ Warning: Could not register all safe globals: {e}")
+    logger.warning("Could not register all safe globals", extra={'error': str(e)})
     # Fallback: set environment to allow all torch.load operations
     os.environ['TORCH_FORCE_WEIGHTS_ONLY_LOAD'] = '0'
 
 
+def find_prepared_model(source_path: str, prepared_dir: str):
+    """
+    Find a prepared artifact (see prepare_model.py) that is valid for a model file
+    
+    Args:
+        source_path: Model file the artifact must have been built from
+        prepared_dir: Directory holding the artifact and manifest.json
+        
+    Returns:
+        Tuple of (manifest with 'path' added or None, sha256 of the source)
+    """
+    from modules.model_registry import file_sha256
+    import ultralytics
+    
+    source_sha256 = file_sha256(source_path)
+    manifest_path = os.path.join(prepared_dir or '', 'manifest.json')
+    if not prepared_dir or not os.path.exists(manifest_path):
+        return None, source_sha256
+    
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        artifact_path = os.path.join(prepared_dir, manifest['artifact'])
+        versions = manifest.get('versions', {})
+        if manifest.get('source_sha256') != source_sha256:
+            reason = 'built from a different model file'
+        elif not os.path.exists(artifact_path):
+            reason = 'artifact missing'
+        elif versions.get('torch') != getattr(torch, '__version__', 'unknown') or \
+                versions.get('ultralytics') != getattr(ultralytics, '__version__', 'unknown'):
+            reason = 'built with different torch/ultralytics versions'
+        elif file_sha256(artifact_path) != manifest.get('artifact_sha256'):
+            reason = 'artifact checksum mismatch'
+        else:
+            manifest['path'] = artifact_path
+            return manifest, source_sha256
+    except (OSError, ValueError, KeyError) as e:
+        reason = f'unreadable manifest: {e}'
+    
+    logger.warning("Prepared model is stale, loading source model", extra={'reason': reason, 'source': source_path})
+    return None, source_sha256
+
+
+class ModelHandle:
+    """A loaded model version with a count of predictions still using it"""
+    
+    def __init__(self, model, version: str, path: str, fixed_imgsz: int = None):
+        self.model = model
+        self.version = version
+        self.path = path
+        # Traced artifacts only accept the input size they were exported with
+        self.fixed_imgsz = fixed_imgsz
+        self.refs = 0
+        self.retired = False
+
+
 class ModelLoader:
     _instance = None
     _model = None
+    # Version serving new requests; older handles live until their last lease ends
+    _handle = None
+    _handle_lock = threading.Lock()
+    _retired = []
+    _loading_version = None
+    # Last version asked for; a swap that has been overtaken is dropped
+    _requested_version = None
+    # Swaps load one at a time, in the order they were asked for
+    _swap_lock = threading.Lock()
+    # CPU optimization settings, reapplied to every swapped-in version
+    _cpu_options = None
+    # Extra models used by QoS tiers and the cascade, keyed by path
+    _variants = {}
+    # Variants asked for but never loaded, warned about once each
+    _missing_variants = set()
+    # Ultralytics predictors are not re-entrant; callers queue here
+    _predict_lock = threading.Lock()
+    # Feed decoded images through the configured predictor and reusable buffers
+    direct_inference = True
     
     def __new__(cls):
         """Singleton pattern to ensure only one model instance"""
@@ -58,10 +153,11 @@ class ModelLoader:
         """Initialize model loader"""
         if self._model is None:
             self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-            print(f"🔧 Using device: {self.device}")
+            logger.info("Using device", extra={'device': self.device})
     
     def load_model(self, model_repo: str = None, model_file: str = None, cache_dir: str = None, 
-                   confidence: float = 0.52, iou: float = 0.40, max_det: int = 300, local_path: str = None):
+                   confidence: float = 0.52, iou: float = 0.40, max_det: int = 300, local_path: str = None,
+                   version: str = None, prepared_dir: str = None):
         """
         Load YOLO model from Hugging Face repository or local path
         
@@ -73,6 +169,9 @@ class ModelLoader:
             iou: IoU threshold for NMS to eliminate overlapping boxes (default: 0.40)
             max_det: Maximum number of detections per image (default: 300)
             local_path: Path to local model file (if provided, skips Hugging Face download)
+            version: Registry version of the model (default: derived from the file hash)
+            prepared_dir: Directory of a prepare_model.py artifact to load instead of
+                local_path when it is present and up to date
             
         Returns:
             Loaded YOLO model
@@ -81,19 +180,29 @@ class ModelLoader:
             try:
                 # Check if should use local model
                 if not model_repo or (model_repo and model_repo.strip() == ""):
-                    print(f"🔧 Using local model (no HF repo specified)")
                     if local_path and os.path.exists(local_path):
-                        print(f"📂 Loading model from: {local_path}")
-                        self._model = YOLO(local_path)
+                        start = time.perf_counter()
+                        prepared, source_sha256 = find_prepared_model(local_path, prepared_dir)
+                        version = version or f"file-{source_sha256[:12]}"
+                        if prepared:
+                            logger.info("Loading prepared model", extra={'path': prepared['path'], 'format': prepared['format']})
+                            self._model = YOLO(prepared['path'], task='detect')
+                            self._install(self._model, version, prepared['path'], prepared.get('imgsz'))
+                        else:
+                            logger.info("Loading local model (no HF repo specified)", extra={'path': local_path})
+                            self._model = YOLO(local_path)
+                            self._install(self._model, version, local_path)
                         self._model_loaded = True
-                        print(f"✅ Model loaded successfully from local path")
+                        logger.info("Model loaded from local path", extra={
+                            'classes': self._model.names,
+                            'duration_ms': round((time.perf_counter() - start) * 1000, 1)
+                        })
                         return self._model
                     else:
-                        raise RuntimeError(f"❌ Local model not found: {local_path}")
+                        raise RuntimeError(f"Local model not found: {local_path}")
                 
-                print(f"🔍 Downloading model from Hugging Face...")
-                print(f"   Repository: {model_repo}")
-                print(f"   File: {model_file}")
+                logger.info("Downloading model from Hugging Face",
+                            extra={'repository': model_repo, 'file': model_file})
                 
                 # Try to download as a Space first, then as a Model repo if that fails
                 model_path = None
@@ -109,22 +218,22 @@ class ModelLoader:
                 # Try downloading from Space with different paths
                 for file_path in possible_paths:
                     try:
-                        print(f"   Attempting to download from Space: {file_path}...")
+                        logger.debug("Attempting to download from Space", extra={'file': file_path})
                         model_path = hf_hub_download(
                             repo_id=model_repo,
                             filename=file_path,
                             cache_dir=cache_dir,
                             repo_type="space"
                         )
-                        print(f"   ✓ Found at: {file_path}")
+                        logger.info("Model found in Space", extra={'file': file_path})
                         break
                     except Exception as space_error:
-                        print(f"   ✗ Not found at: {file_path}")
+                        logger.debug("Model not found in Space", extra={'file': file_path})
                         continue
                 
                 # If Space download failed, try Model repository
                 if not model_path:
-                    print(f"   Attempting to download from Model repository...")
+                    logger.info("Attempting to download from Model repository")
                     try:
                         model_path = hf_hub_download(
                             repo_id=model_repo,
@@ -133,8 +242,8 @@ class ModelLoader:
                             repo_type="model"
                         )
                     except Exception as model_error:
-                        print(f"   Model repo download failed: {model_error}")
-                        print(f"   Attempting default download (no repo_type)...")
+                        logger.warning("Model repo download failed, trying default repo type",
+                                       extra={'error': str(model_error)})
                         # Last resort: try without specifying repo_type
                         model_path = hf_hub_download(
                             repo_id=model_repo,
@@ -145,34 +254,195 @@ class ModelLoader:
                 if not model_path:
                     raise RuntimeError("Failed to download model from all attempted methods")
                 
-                print(f"✅ Model downloaded to: {model_path}")
-                print(f"📦 Loading model...")
+                logger.info("Model downloaded", extra={'path': model_path})
                 
                 self._model = YOLO(model_path)
                 # Set detection parameters
                 self._model.conf = confidence  # Confidence threshold
                 self._model.iou = iou  # IoU threshold for NMS
                 self._model.max_det = max_det  # Maximum detections per image
+                self._install(self._model, version or self._file_version(model_path), model_path)
                 
                 # Get model info
                 if hasattr(self._model, 'names'):
-                    print(f"✅ Model loaded successfully!")
-                    print(f"📊 Classes detected: {self._model.names}")
-                    print(f"⚙️  Detection settings:")
-                    print(f"   - Confidence threshold: {confidence}")
-                    print(f"   - IoU threshold (NMS): {iou}")
-                    print(f"   - Max detections: {max_det}")
+                    logger.info("Model loaded", extra={
+                        'classes': self._model.names,
+                        'confidence': confidence,
+                        'iou': iou,
+                        'max_det': max_det
+                    })
                 
             except Exception as e:
-                print(f"❌ Error loading model from Hugging Face: {e}")
-                print(f"   Make sure:")
-                print(f"   1. Repository exists: {model_repo}")
-                print(f"   2. File exists in repo: {model_file}")
-                print(f"   3. You have internet connection")
+                logger.error("Error loading model from Hugging Face; check that the repository and file "
+                             "exist and that the instance has internet access",
+                             extra={'repository': model_repo, 'file': model_file, 'error': str(e)})
                 raise RuntimeError(f"Failed to load model from Hugging Face: {e}")
             
         return self._model
     
+    @staticmethod
+    def _file_version(path: str) -> str:
+        """Version name for a model that is not in the registry"""
+        from modules.model_registry import file_sha256
+        return f"file-{file_sha256(path)[:12]}"
+    
+    def _update_model_metrics(self):
+        # Caller holds _handle_lock
+        MODEL_REPLICAS.set(1 + len(self._retired) + len(self._variants))
+    
+    def _install(self, model, version: str, path: str, fixed_imgsz: int = None):
+        """
+        Make a loaded model serve new requests
+        
+        The previous handle is retired and freed as soon as no prediction
+        holds it; requests already running finish on the old model.
+        """
+        with self._handle_lock:
+            previous = ModelLoader._handle
+            ModelLoader._handle = ModelHandle(model, version, path, fixed_imgsz)
+            ModelLoader._model = model
+            if previous is not None:
+                MODEL_VERSION_INFO.set(0, version=previous.version)
+                previous.retired = True
+                self._retired.append(previous)
+                self._free_if_idle(previous)
+            MODEL_VERSION_INFO.set(1, version=version)
+            self._update_model_metrics()
+        logger.info("Model version serving", extra={
+            'version': version,
+            'previous': previous.version if previous else None
+        })
+    
+    def _free_if_idle(self, handle: ModelHandle):
+        # Caller holds _handle_lock
+        if handle.retired and handle.refs == 0 and handle in self._retired:
+            self._retired.remove(handle)
+            handle.model = None
+            self._update_model_metrics()
+            logger.info("Previous model version freed", extra={'version': handle.version})
+            # Drop the weights now rather than at some later collection
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    
+    @contextmanager
+    def lease(self):
+        """
+        Hold the current model version for the duration of a prediction
+        
+        Yields:
+            ModelHandle
+        """
+        with self._handle_lock:
+            handle = self._handle
+            if handle is None:
+                raise RuntimeError("Model not loaded. Call load_model() first.")
+            handle.refs += 1
+        try:
+            yield handle
+        finally:
+            with self._handle_lock:
+                handle.refs -= 1
+                self._free_if_idle(handle)
+    
+    @property
+    def version(self):
+        """Version serving new requests"""
+        return self._handle.version if self._handle else None
+    
+    @property
+    def fixed_imgsz(self):
+        """Input size a prepared torchscript artifact was traced at, or None if any size works"""
+        return self._handle.fixed_imgsz if self._handle else None
+    
+    def optimize_cpu(self, model=None, **options) -> dict:
+        """
+        Enable optimized CPU execution (see modules/cpu_optimizer.py)
+        
+        Args:
+            model: Model to optimize (default: the serving model)
+            **options: Arguments for optimize_for_cpu; remembered for later swaps
+            
+        Returns:
+            Optimization report
+        """
+        from modules.cpu_optimizer import optimize_for_cpu
+        if self.device != 'cpu':
+            return {'applied': [], 'skipped': 'not running on CPU'}
+        ModelLoader._cpu_options = options
+        if model is not None:
+            return optimize_for_cpu(model, **options)
+        with self.lease() as handle, self._predict_lock:
+            return optimize_for_cpu(handle.model, **options)
+    
+    def _load_and_install(self, path: str, version: str, warmup_size: int, superseded):
+        """Load and warm one version for swap_model(); caller holds _swap_lock"""
+        try:
+            start = time.perf_counter()
+            model = YOLO(path)
+            # Warm outside the predict lock; the serving model keeps running
+            model(np.full((warmup_size, warmup_size, 3), 114, dtype=np.uint8), verbose=False)
+            if self._cpu_options is not None:
+                self.optimize_cpu(model, **self._cpu_options)
+            logger.info("Model version loaded and warmed", extra={
+                'version': version,
+                'duration_ms': round((time.perf_counter() - start) * 1000, 1)
+            })
+            with self._handle_lock:
+                if superseded():
+                    return
+            self._install(model, version, path)
+        except Exception:
+            logger.exception("Failed to load model version; keeping current version",
+                             extra={'version': version, 'path': path})
+    
+    def swap_model(self, path: str, version: str, warmup_size: int = 640, background: bool = True):
+        """
+        Load and warm a model version, then switch new requests to it
+        
+        Swaps run one at a time. A swap overtaken by a later request
+        before it installs is dropped, so an older version that finishes
+        loading last never replaces a newer one.
+        
+        Args:
+            path: Model file
+            version: Version name
+            warmup_size: Side of the blank warm-up image
+            background: Load on a background thread and return immediately
+            
+        Returns:
+            False if that version is already serving or loading, else True
+        """
+        with self._handle_lock:
+            ModelLoader._requested_version = version
+            if version in (self.version, self._loading_version):
+                return False
+        
+        def superseded():
+            if self._requested_version != version:
+                logger.info("Model swap superseded; not installing", extra={
+                    'version': version, 'requested': self._requested_version
+                })
+                return True
+            return False
+        
+        def load():
+            with self._swap_lock:
+                # A duplicate request queued behind the swap that installed it
+                if superseded() or version == self.version:
+                    return
+                ModelLoader._loading_version = version
+                try:
+                    self._load_and_install(path, version, warmup_size, superseded)
+                finally:
+                    ModelLoader._loading_version = None
+        
+        if background:
+            threading.Thread(target=load, name=f'model-swap-{version}', daemon=True).start()
+        else:
+            load()
+        return True
+    
     def get_model(self):
         """Get the loaded model instance"""
         if self._model is None:
@@ -184,21 +454,75 @@ class ModelLoader:
         model = self.get_model()
         return model.names if hasattr(model, 'names') else {}
     
-    def predict(self, image_path: str, conf: float = None, iou: float = None, max_det: int = None):
+    def load_variant(self, path: str, warmup_size: int = 320, task: str = 'detect'):
+        """
+        Load an additional model (e.g. a smaller export) used by a QoS tier
+        or the cascade
+        
+        Args:
+            path: Path to the model file
+            warmup_size: Side of the blank warm-up image
+            task: Ultralytics task of the model ('detect' or 'classify')
+        
+        Returns:
+            Loaded YOLO model
+        """
+        if path not in self._variants:
+            if not os.path.exists(path):
+                raise RuntimeError(f"Model variant not found: {path}")
+            variant = YOLO(path, task=task)
+            with self._predict_lock:
+                variant(np.full((warmup_size, warmup_size, 3), 114, dtype=np.uint8), verbose=False)
+            self._variants[path] = variant
+            with self._handle_lock:
+                self._update_model_metrics()
+            logger.info("Model variant loaded", extra={'path': path})
+        return self._variants[path]
+    
+    def warmup(self, size: int = 640, runs: int = 2) -> float:
+        """
+        Run dummy predictions so the first real request does not pay for
+        lazy initialisation (predictor setup, kernel selection, allocations)
+        
+        Args:
+            size: Side of the blank warm-up image
+            runs: Number of predictions
+            
+        Returns:
+            Seconds spent warming up
+        """
+        model = self.get_model()
+        image = np.full((size, size, 3), 114, dtype=np.uint8)
+        start = time.perf_counter()
+        with self._predict_lock:
+            for _ in range(runs):
+                model(image, verbose=False)
+        elapsed = time.perf_counter() - start
+        logger.info("Model warmed up", extra={'runs': runs, 'size': size, 'duration_ms': round(elapsed * 1000, 1)})
+        return elapsed
+    
+    def predict(self, image, conf: float = None, iou: float = None, max_det: int = None,
+                priority: str = INTERACTIVE, imgsz: int = None, model_path: str = None):
         """
         Run prediction on an image
         
         Args:
-            image_path: Path to image file
+            image: Path to image file or decoded BGR image array
             conf: Optional confidence threshold override
             iou: Optional IoU threshold override for NMS
             max_det: Optional max detections override
+            priority: Scheduling class ('interactive', 'report' or 'batch')
+            imgsz: Optional inference size override (QoS tiers)
+            model_path: Optional variant loaded with load_variant() to use instead
+                (the main model is used, with a warning, if it was never loaded)
             
         Returns:
             Prediction results
+            
+        Raises:
+            Overloaded: If admission control rejects the request
+            RequestCancelled: If the request expires or its client leaves before inference
         """
-        model = self.get_model()
-        
         # Set default values if not provided
         if conf is None:
             conf = 0.52
@@ -207,7 +531,79 @@ class ModelLoader:
         if max_det is None:
             max_det = 300
         
-        # Run prediction with parameters directly
-        results = model(image_path, conf=conf, iou=iou, max_det=max_det)
+        # Decode before queueing so the direct path can take the array
+        if self.direct_inference and isinstance(image, (str, Path)):
+            decoded = cv2.imread(str(image))
+            if decoded is not None:
+                image = decoded
+        
+        # Wait for the model (time spent here is queueing, not inference);
+        # raises Overloaded when the queue is full or the wait is too long
+        with stage_timer('queue'):
+            admission.acquire(priority)
+            self._predict_lock.acquire()
+        
+        start = time.perf_counter()
+        try:
+            # Last chance to skip the model for a request nobody is waiting for
+            check_deadline('predict')
+            
+            # Pin the version so a hot swap cannot free it mid-prediction
+            with self.lease() as handle:
+                model = self._variants.get(model_path) if model_path else None
+                if model_path and model is None and model_path not in self._missing_variants:
+                    self._missing_variants.add(model_path)
+                    logger.warning("Model variant not loaded; using the main model", extra={'path': model_path})
+                if model is None:
+                    model = handle.model
+                    if handle.fixed_imgsz:
+                        imgsz = handle.fixed_imgsz
+                
+                # Run prediction with parameters directly
+                with stage_timer('predict'):
+                    if self.direct_inference and direct_predictor.supports(model, image):
+                        results = direct_predictor.predict(model, image, conf, iou, max_det, imgsz)
+                    else:
+                        # verbose=False stops ultralytics printing a summary line per image
+                        overrides = {'imgsz': imgsz} if imgsz else {}
+                        results = model(image, conf=conf, iou=iou, max_det=max_det, verbose=False, **overrides)
+        finally:
+            self._predict_lock.release()
+            admission.release(time.perf_counter() - start)
+        
+        # Tag results so every analysis records the version and settings that produced it
+        inference = {'variant': model_path if model is not handle.model else None, 'imgsz': imgsz}
+        for result in results:
+            result.model_version = handle.version
+            result.inference = inference
+        record_model_speed(results)
+        return results
+    
+    def classify(self, crops: list, model_path: str, imgsz: int = None):
+        """
+        Classify a batch of crops with a classifier loaded through load_variant()
+        
+        The crops belong to a request that has already been admitted for
+        detection, so only the model lock is taken, not another queue slot.
+        
+        Args:
+            crops: List of BGR crops
+            model_path: Path the classifier was loaded from
+            imgsz: Optional classifier input size
+            
+        Returns:
+            Classification results, one per crop
+        """
+        model = self._variants.get(model_path)
+        if model is None:
+            raise RuntimeError(f"Classifier not loaded: {model_path}")
         
+        with stage_timer('queue'):
+            self._predict_lock.acquire()
+        try:
+            with stage_timer('classify'):
+                overrides = {'imgsz': imgsz} if imgsz else {}
+                results = model(crops, verbose=False, **overrides)
+        finally:
+            self._predict_lock.release()
         return results
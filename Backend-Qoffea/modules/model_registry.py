@@ -0,0 +1,187 @@
+"""
+Model Registry Module
+Versioned model artifacts in MODEL_CACHE_DIR with an atomically switched active pointer
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from utils.logger import get_logger
+
+logger = get_logger('model_registry')
+
+# Allowed characters in version names (they become directory names)
+VERSION_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$')
+
+ACTIVE_FILE = 'ACTIVE'
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_sha256(path: str) -> str:
+    """
+    Compute the SHA-256 of a file
+
+    Args:
+        path: Path to file
+
+    Returns:
+        Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """
+    Directory of model versions
+
+    Layout:
+        <root>/<version>/<model file>
+        <root>/<version>/manifest.json
+        <root>/ACTIVE            (name of the version new workers should serve)
+
+    The active pointer is replaced with os.replace, so readers never see a
+    partial write, and every worker sharing the directory can poll it.
+    """
+
+    def __init__(self, root: str):
+        """
+        Args:
+            root: Registry directory (created if missing)
+        """
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self._watcher = None
+
+    def _version_dir(self, version: str) -> str:
+        if not VERSION_PATTERN.match(version or ''):
+            raise ValueError(f"Invalid model version: {version!r}")
+        return os.path.join(self.root, version)
+
+    def register(self, source_path: str, version: str = None) -> dict:
+        """
+        Copy a model file into the registry as a new version
+
+        Args:
+            source_path: Model file to register
+            version: Version name (default: '<UTC timestamp>-<sha256 prefix>')
+
+        Returns:
+            Manifest of the new version
+        """
+        sha256 = file_sha256(source_path)
+        version = version or f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{sha256[:8]}"
+        target_dir = self._version_dir(version)
+        if os.path.exists(target_dir):
+            raise ValueError(f"Model version already exists: {version}")
+
+        # Build the version in a temporary directory and rename it into place
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        try:
+            filename = os.path.basename(source_path)
+            shutil.copy2(source_path, os.path.join(staging, filename))
+            manifest = {
+                'version': version,
+                'file': filename,
+                'sha256': sha256,
+                'size_bytes': os.path.getsize(source_path),
+                'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            }
+            with open(os.path.join(staging, MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.rename(staging, target_dir)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        logger.info("Model version registered", extra={'version': version, 'sha256': sha256})
+        return manifest
+
+    def get(self, version: str):
+        """
+        Get the manifest of a version
+
+        Returns:
+            Manifest dict with an added 'path', or None if the version does not exist
+        """
+        try:
+            version_dir = self._version_dir(version)
+            with open(os.path.join(version_dir, MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+        except (ValueError, OSError):
+            return None
+        manifest['path'] = os.path.join(version_dir, manifest['file'])
+        return manifest
+
+    def list_versions(self) -> list:
+        """List manifests of all versions, newest first"""
+        manifests = [self.get(name) for name in os.listdir(self.root) if not name.startswith('.')]
+        manifests = [manifest for manifest in manifests if manifest]
+        return sorted(manifests, key=lambda manifest: manifest['created'], reverse=True)
+
+    def active(self):
+        """
+        Get the active version name
+
+        Returns:
+            Version name, or None if nothing has been activated
+        """
+        try:
+            with open(os.path.join(self.root, ACTIVE_FILE)) as f:
+                version = f.read().strip()
+        except OSError:
+            return None
+        return version if self.get(version) else None
+
+    def set_active(self, version: str):
+        """
+        Point the registry at a version
+
+        Raises:
+            ValueError: If the version does not exist
+        """
+        if self.get(version) is None:
+            raise ValueError(f"Unknown model version: {version}")
+        fd, tmp_path = tempfile.mkstemp(prefix='.active-', dir=self.root)
+        with os.fdopen(fd, 'w') as f:
+            f.write(version)
+        os.replace(tmp_path, os.path.join(self.root, ACTIVE_FILE))
+        logger.info("Active model version set", extra={'version': version})
+
+    def watch(self, callback, interval: float = 30.0):
+        """
+        Poll the active pointer and call callback(manifest) when it changes
+
+        Lets every worker (and instance, on a shared volume) follow an
+        activation made through any one of them.
+
+        Args:
+            callback: Called with the new version's manifest
+            interval: Seconds between polls
+        """
+        if self._watcher is not None or interval <= 0:
+            return
+
+        def run():
+            seen = self.active()
+            while True:
+                time.sleep(interval)
+                current = self.active()
+                if current and current != seen:
+                    seen = current
+                    try:
+                        callback(self.get(current))
+                    except Exception:
+                        logger.exception("Model registry callback failed", extra={'version': current})
+
+        self._watcher = threading.Thread(target=run, name='model-registry-watch', daemon=True)
+        self._watcher.start()
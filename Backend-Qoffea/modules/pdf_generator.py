@@ -11,9 +11,22 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from reportlab.graphics.shapes import Drawing, Rect, String
 from reportlab.graphics import renderPDF
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas as pdf_canvas
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import datetime
+from io import BytesIO
+from xml.sax.saxutils import escape
 from PIL import Image
+import gc
 import os
+import tempfile
+from utils.logger import get_logger
+from utils.pdf_concat import concatenate_pdfs
+from utils.deadline import check_deadline
+
+logger = get_logger('pdf_generator')
 
 
 class PercentageBarChart(Flowable):
@@ -144,58 +157,20 @@ class PDFGenerator:
                 
                 return (width * inch, height * inch)
         except Exception as e:
-            print(f"⚠️ Error getting image dimensions: {e}")
+            logger.warning("Error getting image dimensions", extra={'path': image_path, 'error': str(e)})
             # Fallback to default size
             return (5 * inch, 3.5 * inch)
     
-    def generate_report(self, analysis_result: dict, original_image_path: str,
-                       annotated_image_path: str, output_path: str, analyzer):
+    def _build_stats_table(self, analysis_result: dict) -> Table:
         """
-        Generate PDF report
+        Build the total/good/defect statistics cards
         
         Args:
             analysis_result: Analysis results dictionary
-            original_image_path: Path to original image
-            annotated_image_path: Path to annotated image
-            output_path: Path to save PDF
-            analyzer: CoffeeAnalyzer instance
+            
+        Returns:
+            Styled statistics table
         """
-        # Use absolute paths
-        abs_output_path = os.path.abspath(output_path)
-        abs_annotated_path = os.path.abspath(annotated_image_path) if annotated_image_path else None
-        
-        # Create PDF with margins
-        doc = SimpleDocTemplate(
-            abs_output_path, 
-            pagesize=A4,
-            topMargin=0.75*inch,
-            bottomMargin=0.75*inch,
-            leftMargin=0.75*inch,
-            rightMargin=0.75*inch
-        )
-        story = []
-        
-        # Title
-        title = Paragraph("QOFFEA", self.styles['CustomTitle'])
-        story.append(title)
-        story.append(Spacer(1, 0.1*inch))
-        
-        subtitle = Paragraph("Coffee Bean Quality Analysis Report", self.styles['CustomSubtitle'])
-        story.append(subtitle)
-        story.append(Spacer(1, 0.25*inch))
-        
-        # Date and Time
-        date_text = f"<b>Generated:</b> {datetime.now().strftime('%d %B %Y, %H:%M:%S')}"
-        date_para = Paragraph(date_text, self.styles['Normal'])
-        story.append(date_para)
-        story.append(Spacer(1, 0.4*inch))
-        
-        # Summary Section Title
-        summary_title = Paragraph("Hasil Klasifikasi", self.styles['SectionTitle'])
-        story.append(summary_title)
-        story.append(Spacer(1, 0.15*inch))
-        
-        # Statistics Cards (like web display)
         stats_data = [
             ['Total Biji:', 'Biji Baik:', 'Biji Cacat:'],
             [
@@ -225,15 +200,18 @@ class PDFGenerator:
             ('GRID', (0, 0), (-1, -1), 1.5, colors.HexColor('#8B7355')),
         ]))
         
-        story.append(stats_table)
-        story.append(Spacer(1, 0.4*inch))
-        
-        # Percentage Section with Bar Chart
-        percentage_title = Paragraph("Persentase Kualitas Biji Kopi:", self.styles['SectionTitle'])
-        story.append(percentage_title)
-        story.append(Spacer(1, 0.2*inch))
+        return stats_table
+    
+    def _build_percentage_chart(self, analysis_result: dict) -> Table:
+        """
+        Build the percentage bar chart with its labels
         
-        # Create a table with bar chart on left and percentages on right
+        Args:
+            analysis_result: Analysis results dictionary
+            
+        Returns:
+            Table combining the bar chart and percentage labels
+        """
         # Bar chart
         bar_chart = PercentageBarChart(
             analysis_result['good_percentage'],
@@ -271,6 +249,68 @@ class PDFGenerator:
             ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
         ]))
         
+        return chart_and_labels
+    
+    def generate_report(self, analysis_result: dict, original_image_path: str,
+                       annotated_image_path: str, output_path: str, analyzer):
+        """
+        Generate PDF report
+        
+        Args:
+            analysis_result: Analysis results dictionary
+            original_image_path: Path to original image
+            annotated_image_path: Path to annotated image
+            output_path: Path to save PDF
+            analyzer: CoffeeAnalyzer instance
+        """
+        # Use absolute paths
+        abs_output_path = os.path.abspath(output_path)
+        abs_annotated_path = os.path.abspath(annotated_image_path) if annotated_image_path else None
+        
+        # Create PDF with margins
+        doc = SimpleDocTemplate(
+            abs_output_path, 
+            pagesize=A4,
+            topMargin=0.75*inch,
+            bottomMargin=0.75*inch,
+            leftMargin=0.75*inch,
+            rightMargin=0.75*inch
+        )
+        story = []
+        
+        # Title
+        title = Paragraph("QOFFEA", self.styles['CustomTitle'])
+        story.append(title)
+        story.append(Spacer(1, 0.1*inch))
+        
+        subtitle = Paragraph("Coffee Bean Quality Analysis Report", self.styles['CustomSubtitle'])
+        story.append(subtitle)
+        story.append(Spacer(1, 0.25*inch))
+        
+        # Date and Time
+        date_text = f"<b>Generated:</b> {datetime.now().strftime('%d %B %Y, %H:%M:%S')}"
+        date_para = Paragraph(date_text, self.styles['Normal'])
+        story.append(date_para)
+        story.append(Spacer(1, 0.4*inch))
+        
+        # Summary Section Title
+        summary_title = Paragraph("Hasil Klasifikasi", self.styles['SectionTitle'])
+        story.append(summary_title)
+        story.append(Spacer(1, 0.15*inch))
+        
+        # Statistics Cards (like web display)
+        stats_table = self._build_stats_table(analysis_result)
+        
+        story.append(stats_table)
+        story.append(Spacer(1, 0.4*inch))
+        
+        # Percentage Section with Bar Chart
+        percentage_title = Paragraph("Persentase Kualitas Biji Kopi:", self.styles['SectionTitle'])
+        story.append(percentage_title)
+        story.append(Spacer(1, 0.2*inch))
+        
+        chart_and_labels = self._build_percentage_chart(analysis_result)
+        
         story.append(chart_and_labels)
         story.append(Spacer(1, 0.4*inch))
         
@@ -296,4 +336,289 @@ class PDFGenerator:
         
         # Build PDF
         doc.build(story)
-        print(f"✅ PDF report generated: {abs_output_path}")
+        logger.info("PDF report generated", extra={'path': abs_output_path})
+
+
+class LotReportGenerator(PDFGenerator):
+    """
+    Generates one PDF covering every sample of a lot
+
+    Pages are drawn straight onto a canvas one sample at a time instead of
+    building a platypus story, so only a small window of decoded images is
+    alive at once. A ReportLab canvas keeps every page until it is saved,
+    so pages go into part files of SAMPLES_PER_PART samples that are
+    joined at the end (utils/pdf_concat.py); memory stays bounded by one
+    part however many samples the lot has.
+    """
+    
+    # Rows per page of the per-sample summary table
+    SUMMARY_ROWS_PER_PAGE = 32
+    # Sample pages held by one canvas before it is written out
+    SAMPLES_PER_PART = 20
+    
+    def __init__(self, max_workers: int = 4, thumbnail_size: int = 900):
+        """
+        Initialize lot report generator
+        
+        Args:
+            max_workers: Number of threads preparing page images
+            thumbnail_size: Longest side of page thumbnails in pixels
+        """
+        super().__init__()
+        self.max_workers = max(1, max_workers)
+        self.thumbnail_size = thumbnail_size
+    
+    @classmethod
+    def _prepare_page_thumbnail(cls, sample: dict, max_side: int):
+        """
+        Prepare the thumbnail of a lot sample, preferring its annotated image
+        
+        Args:
+            sample: Lot sample; a callable 'annotated_path' is resolved here,
+                so rendering happens on the worker thread
+            max_side: Longest side of the thumbnail in pixels
+            
+        Returns:
+            Same as _prepare_thumbnail
+        """
+        annotated_path = sample.get('annotated_path')
+        if callable(annotated_path):
+            annotated_path = annotated_path()
+        page_image = annotated_path if annotated_path and os.path.exists(annotated_path) else sample['image_path']
+        return cls._prepare_thumbnail(page_image, max_side)
+    
+    @staticmethod
+    def _prepare_thumbnail(image_path: str, max_side: int):
+        """
+        Decode, downscale and JPEG-encode an image for a report page
+        
+        Args:
+            image_path: Path to image file
+            max_side: Longest side of the thumbnail in pixels
+            
+        Returns:
+            Tuple of (ImageReader, width, height) or None if the image is unreadable
+        """
+        try:
+            with Image.open(image_path) as img:
+                # Let the JPEG decoder scale down while decoding
+                img.draft('RGB', (max_side, max_side))
+                img = img.convert('RGB')
+                img.thumbnail((max_side, max_side))
+                width, height = img.size
+                buffer = BytesIO()
+                img.save(buffer, format='JPEG', quality=80, optimize=True)
+            buffer.seek(0)
+            # ReportLab embeds JPEG data as-is, without decoding it again
+            return ImageReader(buffer), width, height
+        except Exception as e:
+            logger.warning("Error preparing thumbnail", extra={'path': image_path, 'error': str(e)})
+            return None
+    
+    def _draw_flowable(self, c, flowable, x: float, top: float, max_width: float) -> float:
+        """
+        Draw a flowable at a position measured from its top edge
+        
+        Returns:
+            Y coordinate of the flowable's bottom edge
+        """
+        top -= flowable.getSpaceBefore()
+        _, height = flowable.wrapOn(c, max_width, top)
+        flowable.drawOn(c, x, top - height)
+        return top - height - flowable.getSpaceAfter()
+    
+    def _draw_header(self, c, page_title: str, lot_name: str) -> float:
+        """
+        Draw the common page header
+        
+        Returns:
+            Y coordinate below the header
+        """
+        page_width, page_height = A4
+        margin = 0.75 * inch
+        content_width = page_width - 2 * margin
+        
+        y = page_height - margin
+        y = self._draw_flowable(c, Paragraph("QOFFEA", self.styles['CustomTitle']), margin, y, content_width)
+        y = self._draw_flowable(c, Paragraph(page_title, self.styles['CustomSubtitle']), margin, y, content_width)
+        info = f"<b>Lot:</b> {escape(lot_name)} &nbsp;&nbsp; <b>Generated:</b> {self._generated_at}"
+        y = self._draw_flowable(c, Paragraph(info, self.styles['Normal']), margin, y, content_width)
+        return y - 0.2 * inch
+    
+    def _draw_sample_page(self, c, index: int, total: int, sample: dict,
+                          analysis_result: dict, thumbnail, lot_name: str):
+        """
+        Draw one sample page: counts, percentage chart and thumbnail
+        """
+        page_width, _ = A4
+        margin = 0.75 * inch
+        content_width = page_width - 2 * margin
+        
+        y = self._draw_header(c, f"Sampel {index} dari {total}", lot_name)
+        id_text = f"<b>Analysis ID:</b> {sample['analysis_id']}"
+        y = self._draw_flowable(c, Paragraph(id_text, self.styles['Normal']), margin, y, content_width)
+        y -= 0.15 * inch
+        
+        if not analysis_result.get('success'):
+            error_text = f"Analisis gagal: {analysis_result.get('error', 'unknown error')}"
+            self._draw_flowable(c, Paragraph(error_text, self.styles['SectionTitle']), margin, y, content_width)
+            return
+        
+        y = self._draw_flowable(c, self._build_stats_table(analysis_result), margin, y, content_width)
+        y -= 0.1 * inch
+        y = self._draw_flowable(c, self._build_percentage_chart(analysis_result), margin, y, content_width)
+        y -= 0.2 * inch
+        
+        if thumbnail is not None:
+            reader, img_width, img_height = thumbnail
+            max_height = y - margin
+            scale = min(content_width / img_width, max_height / img_height)
+            draw_width, draw_height = img_width * scale, img_height * scale
+            c.drawImage(reader, margin + (content_width - draw_width) / 2, y - draw_height,
+                        width=draw_width, height=draw_height)
+    
+    def _draw_summary_pages(self, c, rows: list, lot_name: str):
+        """
+        Draw aggregated lot totals followed by the per-sample table
+        """
+        page_width, _ = A4
+        margin = 0.75 * inch
+        content_width = page_width - 2 * margin
+        
+        total_beans = sum(row[1] for row in rows)
+        good_beans = sum(row[2] for row in rows)
+        defect_beans = sum(row[3] for row in rows)
+        lot_result = {
+            'total_beans': total_beans,
+            'good_beans': good_beans,
+            'defect_beans': defect_beans,
+            'good_percentage': round(good_beans / total_beans * 100, 2) if total_beans > 0 else 0,
+            'defect_percentage': round(defect_beans / total_beans * 100, 2) if total_beans > 0 else 0,
+        }
+        
+        y = self._draw_header(c, "Ringkasan Lot", lot_name)
+        y = self._draw_flowable(c, Paragraph(f"Jumlah sampel: {len(rows)}", self.styles['SectionTitle']),
+                                margin, y, content_width)
+        y = self._draw_flowable(c, self._build_stats_table(lot_result), margin, y, content_width)
+        y -= 0.1 * inch
+        self._draw_flowable(c, self._build_percentage_chart(lot_result), margin, y, content_width)
+        c.showPage()
+        
+        header = ['No', 'Analysis ID', 'Total', 'Baik', 'Cacat', 'Baik %']
+        for start in range(0, len(rows), self.SUMMARY_ROWS_PER_PAGE):
+            chunk = rows[start:start + self.SUMMARY_ROWS_PER_PAGE]
+            table_data = [header] + [
+                [str(start + offset + 1), row[0], str(row[1]), str(row[2]), str(row[3]), row[4]]
+                for offset, row in enumerate(chunk)
+            ]
+            table = Table(table_data, colWidths=[0.5*inch, 2.95*inch, 0.75*inch, 0.75*inch, 0.75*inch, 0.8*inch])
+            table.setStyle(TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#8B7355')),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('FONTSIZE', (0, 0), (-1, -1), 8),
+                ('ALIGN', (2, 0), (-1, -1), 'CENTER'),
+                ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.Color(0.95, 0.95, 0.93)]),
+                ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#8B7355')),
+            ]))
+            y = self._draw_header(c, "Rincian Sampel", lot_name)
+            self._draw_flowable(c, table, margin, y, content_width)
+            c.showPage()
+    
+    def generate_lot_report(self, samples: list, output_path: str, analyzer,
+                            analysis_params: dict = None, lot_name: str = '-') -> dict:
+        """
+        Generate a multi-sample lot PDF report
+        
+        Thumbnails for upcoming samples are prepared in a thread pool while the
+        current sample is analyzed, with at most 2 * max_workers prepared ahead.
+        
+        Args:
+            samples: List of dicts with 'analysis_id', 'image_path' and 'annotated_path'
+                (a path, or a callable returning one)
+            output_path: Path to save PDF
+            analyzer: CoffeeAnalyzer instance
+            analysis_params: Keyword arguments for analyzer.analyze_image
+            lot_name: Name printed in page headers
+            
+        Returns:
+            Dictionary with lot totals
+        """
+        abs_output_path = os.path.abspath(output_path)
+        analysis_params = analysis_params or {}
+        self._generated_at = datetime.now().strftime('%d %B %Y, %H:%M:%S')
+        
+        total = len(samples)
+        rows = []
+        pending = deque()
+        sample_iter = iter(samples)
+        
+        # Parts sit next to the report so the join stays on one filesystem
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(abs_output_path), prefix='.lot-') as part_dir:
+            part_paths = []
+            
+            def new_part():
+                part_paths.append(os.path.join(part_dir, f"part-{len(part_paths):05d}.pdf"))
+                return pdf_canvas.Canvas(part_paths[-1], pagesize=A4, pageCompression=1)
+            
+            c = new_part()
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                def submit_next():
+                    sample = next(sample_iter, None)
+                    if sample is None:
+                        return
+                    pending.append((sample, executor.submit(self._prepare_page_thumbnail, sample, self.thumbnail_size)))
+                
+                for _ in range(self.max_workers * 2):
+                    submit_next()
+                
+                index = 0
+                while pending:
+                    sample, future = pending.popleft()
+                    submit_next()
+                    index += 1
+                    
+                    # Stop between pages if the client gave up or the lot ran out of time
+                    check_deadline('pdf')
+                    analysis_result = analyzer.analyze_image(sample['image_path'], **analysis_params)
+                    thumbnail = future.result()
+                    
+                    self._draw_sample_page(c, index, total, sample, analysis_result, thumbnail, lot_name)
+                    c.showPage()
+                    
+                    if analysis_result.get('success'):
+                        rows.append((
+                            sample['analysis_id'],
+                            analysis_result['total_beans'],
+                            analysis_result['good_beans'],
+                            analysis_result['defect_beans'],
+                            f"{analysis_result['good_percentage']:.1f}%"
+                        ))
+                    else:
+                        rows.append((sample['analysis_id'], 0, 0, 0, '-'))
+                    
+                    # Drop references to the page's image and detections before the next sample
+                    del analysis_result, thumbnail
+                    
+                    # Write the finished pages out instead of keeping them on the canvas
+                    if index % self.SAMPLES_PER_PART == 0:
+                        c.save()
+                        # The canvas and its document reference each other; free the part now
+                        c = None
+                        gc.collect()
+                        c = new_part()
+            
+            self._draw_summary_pages(c, rows, lot_name)
+            c.save()
+            concatenate_pdfs(part_paths, abs_output_path, title=f"QOFFEA Lot Report - {lot_name}")
+        
+        logger.info("Lot PDF report generated", extra={'path': abs_output_path, 'samples': total})
+        
+        total_beans = sum(row[1] for row in rows)
+        good_beans = sum(row[2] for row in rows)
+        return {
+            'samples': total,
+            'total_beans': total_beans,
+            'good_beans': good_beans,
+            'defect_beans': total_beans - good_beans
+        }
@@ -0,0 +1,139 @@
+"""
+ROI Module
+Finds the bean-bearing region of a photo so the model only sees that part
+"""
+
+import cv2
+import numpy as np
+from utils.metrics import metrics
+from utils.logger import get_logger
+
+logger = get_logger('roi')
+
+ROI_AREA_RATIO = metrics.histogram(
+    'qoffea_roi_area_ratio',
+    'Fraction of the photo kept by the ROI crop (1 = not cropped)',
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+)
+
+
+class RoiCropper:
+    """
+    Crop photos to the region that contains beans
+
+    On a small grey thumbnail, pixels with local texture (box-filtered
+    standard deviation above a threshold) are marked, closed into blobs,
+    and blobs smaller than a bean are dropped as noise. The bounding box of
+    what remains, plus a margin, is the region of interest. Plain tables,
+    trays and walls have no texture and fall outside it.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, enabled: bool = False, max_side: int = 256, texture_threshold: float = 10.0,
+                  margin: float = 0.04, min_component: float = 0.0005, max_area_ratio: float = 0.85):
+        """
+        Apply ROI settings
+
+        Args:
+            enabled: Never crop when False
+            max_side: Longest side of the thumbnail analysed
+            texture_threshold: Local grey-level standard deviation that counts as texture
+            margin: Margin added around the region, as a fraction of the image size
+            min_component: Smallest blob kept, as a fraction of the thumbnail area
+            max_area_ratio: Skip cropping when the region keeps more than this fraction
+        """
+        self.enabled = enabled
+        self.max_side = max_side
+        self.texture_threshold = texture_threshold
+        self.margin = margin
+        self.min_component = min_component
+        self.max_area_ratio = max_area_ratio
+
+    def settings_key(self) -> tuple:
+        """Everything that changes the crop, for cache keys"""
+        if not self.enabled:
+            return (False,)
+        return (True, self.max_side, self.texture_threshold, self.margin, self.min_component, self.max_area_ratio)
+
+    def find(self, image: np.ndarray):
+        """
+        Locate the bean-bearing region
+
+        Args:
+            image: Decoded BGR image
+
+        Returns:
+            (x1, y1, x2, y2) in image pixels, or None to use the whole image
+        """
+        if not self.enabled:
+            return None
+        height, width = image.shape[:2]
+        scale = min(1.0, self.max_side / max(height, width))
+        thumb_w, thumb_h = max(1, round(width * scale)), max(1, round(height * scale))
+        thumbnail = cv2.resize(image, (thumb_w, thumb_h), interpolation=cv2.INTER_LINEAR) if scale < 1.0 else image
+        gray = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+        # Local standard deviation in a 5x5 window
+        mean = cv2.blur(gray, (5, 5))
+        variance = cv2.blur(gray * gray, (5, 5)) - mean * mean
+        mask = (variance > self.texture_threshold ** 2).astype(np.uint8)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        min_area = self.min_component * thumb_w * thumb_h
+        keep = [index for index in range(1, count) if stats[index, cv2.CC_STAT_AREA] >= min_area]
+        if not keep:
+            ROI_AREA_RATIO.observe(1.0)
+            return None
+
+        left = stats[keep, cv2.CC_STAT_LEFT]
+        top = stats[keep, cv2.CC_STAT_TOP]
+        x1, y1 = left.min(), top.min()
+        x2 = (left + stats[keep, cv2.CC_STAT_WIDTH]).max()
+        y2 = (top + stats[keep, cv2.CC_STAT_HEIGHT]).max()
+
+        # Back to full resolution, with a margin so edge beans are not clipped
+        margin_x, margin_y = self.margin * width, self.margin * height
+        box = (
+            max(0, int(x1 / scale - margin_x)),
+            max(0, int(y1 / scale - margin_y)),
+            min(width, int(np.ceil(x2 / scale + margin_x))),
+            min(height, int(np.ceil(y2 / scale + margin_y)))
+        )
+        ratio = (box[2] - box[0]) * (box[3] - box[1]) / (width * height)
+        if ratio > self.max_area_ratio:
+            ROI_AREA_RATIO.observe(1.0)
+            return None
+        ROI_AREA_RATIO.observe(ratio)
+        return box
+
+    @staticmethod
+    def restore(results, image: np.ndarray, box: tuple):
+        """
+        Map results predicted on a crop back onto the full image in place
+
+        Boxes are shifted by the crop offset and the results point at the
+        full image, so drawing, reports and the cascade use original
+        coordinates.
+
+        Args:
+            results: Prediction results for image[y1:y2, x1:x2]
+            image: Full BGR image
+            box: (x1, y1, x2, y2) the crop was taken from
+        """
+        for result in results:
+            result.orig_img = image
+            result.orig_shape = image.shape[:2]
+            result.roi = list(box)
+            if result.boxes is None:
+                continue
+            data = result.boxes.data.clone()
+            data[:, [0, 2]] += box[0]
+            data[:, [1, 3]] += box[1]
+            result.update(boxes=data)
+
+
+# Configured by create_app
+roi_cropper = RoiCropper()
@@ -0,0 +1,151 @@
+"""
+Build-time model preparation for fast container start
+
+Turns models/best.pt into a ready-to-run artifact in models/prepared/:
+- pt (default): fused, inference-only float checkpoint without optimizer/EMA
+  state, which keeps variable input sizes, so QoS tiers, the cascade and
+  MODEL_CPU_OPTIMIZE keep working
+- torchscript: layers fused and the graph traced, so startup skips
+  rebuilding the ultralytics model from Python; input size is fixed, and
+  every request runs at that size whatever a QoS tier or the cascade asks for
+
+A manifest.json records checksums of the source and the artifact plus the
+torch/ultralytics versions, so ModelLoader can tell when the artifact is
+stale and fall back to best.pt.
+
+Examples:
+    python prepare_model.py
+    python prepare_model.py --format torchscript --imgsz 640
+    python prepare_model.py --if-present          # Dockerfile: skip quietly without best.pt
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from copy import deepcopy
+from datetime import datetime
+
+from config import Config
+from modules.model_registry import file_sha256
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def runtime_versions() -> dict:
+    """Versions an artifact is only valid for"""
+    import torch
+    import ultralytics
+    return {
+        'torch': getattr(torch, '__version__', 'unknown'),
+        'ultralytics': getattr(ultralytics, '__version__', 'unknown')
+    }
+
+
+def export_torchscript(model, output_dir: str, imgsz: int) -> str:
+    """Fuse and trace the model; returns the artifact filename"""
+    exported = model.export(format='torchscript', imgsz=imgsz, device='cpu', optimize=False, verbose=False)
+    filename = 'model.torchscript'
+    shutil.move(exported, os.path.join(output_dir, filename))
+    return filename
+
+
+def export_fused_checkpoint(model, output_dir: str) -> str:
+    """Save a fused, inference-only checkpoint; returns the artifact filename"""
+    import torch
+
+    network = deepcopy(model.model).float().eval()
+    network.fuse()
+    for parameter in network.parameters():
+        parameter.requires_grad = False
+    checkpoint = {
+        'model': network,
+        'train_args': getattr(model, 'ckpt', {}).get('train_args', {}),
+        'date': datetime.utcnow().isoformat(),
+    }
+    filename = 'model.pt'
+    torch.save(checkpoint, os.path.join(output_dir, filename))
+    return filename
+
+
+def prepare(source: str, output_dir: str, fmt: str = 'pt', imgsz: int = 640) -> dict:
+    """
+    Build the prepared artifact and its manifest
+
+    Args:
+        source: Path to best.pt
+        output_dir: Directory for the artifact and manifest
+        fmt: 'torchscript' or 'pt'
+        imgsz: Input size traced into a torchscript artifact
+
+    Returns:
+        Manifest dict
+    """
+    from ultralytics import YOLO
+
+    os.makedirs(output_dir, exist_ok=True)
+    # Remove the old manifest first so a failed build never looks valid
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    start = time.perf_counter()
+    model = YOLO(source)
+    if fmt == 'torchscript':
+        artifact = export_torchscript(model, output_dir, imgsz)
+    else:
+        artifact = export_fused_checkpoint(model, output_dir)
+    build_seconds = time.perf_counter() - start
+
+    artifact_path = os.path.join(output_dir, artifact)
+    manifest = {
+        'format': fmt,
+        'artifact': artifact,
+        'artifact_sha256': file_sha256(artifact_path),
+        'artifact_size_bytes': os.path.getsize(artifact_path),
+        'source': os.path.basename(source),
+        'source_sha256': file_sha256(source),
+        'imgsz': imgsz if fmt == 'torchscript' else None,
+        'names': getattr(model, 'names', {}),
+        'versions': runtime_versions(),
+        'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'build_seconds': round(build_seconds, 2)
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def measure_load(output_dir: str, manifest: dict) -> float:
+    """Time a cold load of the artifact the way ModelLoader does it"""
+    from ultralytics import YOLO
+    start = time.perf_counter()
+    YOLO(os.path.join(output_dir, manifest['artifact']), task='detect')
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prepare an optimized model artifact for fast startup')
+    parser.add_argument('--source', default=Config.MODEL_PATH, help='Model to prepare (default: MODEL_PATH)')
+    parser.add_argument('--output', default=Config.PREPARED_MODEL_DIR, help='Artifact directory')
+    parser.add_argument('--format', choices=('pt', 'torchscript'), default='pt',
+                        help='pt keeps variable input sizes; torchscript fixes the input to --imgsz')
+    parser.add_argument('--imgsz', type=int, default=640, help='Input size for torchscript')
+    parser.add_argument('--if-present', action='store_true', help='Exit successfully when the source is missing')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        print(f"Model not found: {args.source}")
+        sys.exit(0 if args.if_present else 1)
+
+    print(f"Preparing {args.source} as {args.format}...")
+    manifest = prepare(args.source, args.output, args.format, args.imgsz)
+    print(f"  artifact: {os.path.join(args.output, manifest['artifact'])} "
+          f"({manifest['artifact_size_bytes'] / 1048576:.1f} MB, built in {manifest['build_seconds']}s)")
+    print(f"  load time: {measure_load(args.output, manifest) * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 """Routes initialization"""
 from .upload import upload_bp
 from .report import report_bp
+from .models import models_bp
 
-__all__ = ['upload_bp', 'report_bp']
+__all__ = ['upload_bp', 'report_bp', 'models_bp']
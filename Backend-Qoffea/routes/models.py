@@ -0,0 +1,126 @@
+"""
+Model Routes
+Token-protected model registry management and zero-downtime activation
+"""
+
+import hmac
+import os
+import tempfile
+from flask import Blueprint, jsonify, request
+from werkzeug.utils import secure_filename
+from config import Config
+from utils.logger import get_logger
+from app import model_loader, model_registry
+
+models_bp = Blueprint('models', __name__)
+logger = get_logger('routes.models')
+
+
+@models_bp.before_request
+def require_admin_token():
+    """Model management is disabled without MODEL_ADMIN_TOKEN and needs it on every call"""
+    supplied = request.headers.get('X-Admin-Token', '')
+    if not Config.MODEL_ADMIN_TOKEN or not hmac.compare_digest(Config.MODEL_ADMIN_TOKEN, supplied):
+        return jsonify({
+            'success': False,
+            'error': 'Invalid or missing admin token'
+        }), 403
+
+
+@models_bp.route('/models', methods=['GET'])
+def list_models():
+    """
+    List registered model versions
+
+    Returns:
+        JSON with the serving, active and loading versions and all manifests
+    """
+    return jsonify({
+        'success': True,
+        'serving': model_loader.version,
+        'active': model_registry.active(),
+        'loading': model_loader._loading_version,
+        'versions': model_registry.list_versions()
+    }), 200
+
+
+@models_bp.route('/models', methods=['POST'])
+def register_model():
+    """
+    Register a new model version
+
+    Expected form data:
+    - file: Model file (.pt, .torchscript or .onnx)
+    - version (optional): Version name
+    - activate (optional): '1' to activate right away
+
+    Returns:
+        JSON with the new version's manifest
+    """
+    file = request.files.get('file')
+    if file is None or not file.filename:
+        return jsonify({
+            'success': False,
+            'error': 'No file provided'
+        }), 400
+
+    filename = secure_filename(file.filename)
+    if os.path.splitext(filename)[1].lower() not in ('.pt', '.torchscript', '.onnx'):
+        return jsonify({
+            'success': False,
+            'error': 'Model file must be .pt, .torchscript or .onnx'
+        }), 400
+
+    with tempfile.TemporaryDirectory(dir=model_registry.root, prefix='.upload-') as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, filename)
+        file.save(tmp_path)
+        try:
+            manifest = model_registry.register(tmp_path, request.form.get('version') or None)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+
+    if request.form.get('activate') == '1':
+        model_registry.set_active(manifest['version'])
+        model_loader.swap_model(model_registry.get(manifest['version'])['path'], manifest['version'],
+                                Config.MODEL_WARMUP_SIZE)
+
+    return jsonify({
+        'success': True,
+        'model': manifest
+    }), 201
+
+
+@models_bp.route('/models/<version>/activate', methods=['POST'])
+def activate_model(version):
+    """
+    Activate a registered version
+
+    This worker loads and warms it in the background and then switches new
+    requests over; other workers follow through the registry watcher.
+
+    Args:
+        version: Version name
+
+    Returns:
+        JSON with the activation status (202 while loading)
+    """
+    manifest = model_registry.get(version)
+    if manifest is None:
+        return jsonify({
+            'success': False,
+            'error': 'Model version not found'
+        }), 404
+
+    model_registry.set_active(version)
+    started = model_loader.swap_model(manifest['path'], version, Config.MODEL_WARMUP_SIZE)
+    logger.info("Model activation requested", extra={'version': version, 'loading': started})
+
+    return jsonify({
+        'success': True,
+        'active': version,
+        'serving': model_loader.version,
+        'loading': model_loader._loading_version
+    }), 202 if started else 200
@@ -0,0 +1,161 @@
+"""
+Profiling Routes
+Token-protected access to captured profiles (registered only when enabled)
+"""
+
+from flask import Blueprint, jsonify, request, g, Response
+from config import Config
+from utils.profiler import Profiler
+from utils.logger import get_logger
+
+profiling_bp = Blueprint('profiling', __name__)
+logger = get_logger('routes.profiling')
+
+profiler = None
+
+
+def _supplied_token() -> str:
+    """Read the profiling token from X-Profile-Token or a Bearer header"""
+    token = request.headers.get('X-Profile-Token', '')
+    if not token:
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            token = auth[len('Bearer '):]
+    return token
+
+
+@profiling_bp.before_request
+def require_token():
+    """Reject profiling API calls without a valid token"""
+    if not profiler.check_token(_supplied_token()):
+        return jsonify({
+            'success': False,
+            'error': 'Invalid or missing profiling token'
+        }), 403
+
+
+@profiling_bp.route('/profiles', methods=['GET'])
+def list_profiles():
+    """
+    List captured profiles, newest first
+    
+    Returns:
+        JSON with profile metadata
+    """
+    return jsonify({
+        'success': True,
+        'profiles': profiler.store.list()
+    }), 200
+
+
+@profiling_bp.route('/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """
+    Download a captured profile
+    
+    Query params:
+    - format (optional): 'text' renders cProfile stats as a pstats table
+    
+    Returns:
+        .prof file (load with pstats/snakeviz) or folded stacks (flamegraph.pl/speedscope)
+    """
+    found = profiler.store.get(profile_id)
+    if found is None:
+        return jsonify({
+            'success': False,
+            'error': 'Profile not found'
+        }), 404
+    
+    entry, data = found
+    if entry['format'] == 'pstats':
+        if request.args.get('format') == 'text':
+            return Response(Profiler.render_text(data), mimetype='text/plain')
+        return Response(data, mimetype='application/octet-stream', headers={
+            'Content-Disposition': f'attachment; filename=profile_{profile_id}.prof'
+        })
+    return Response(data, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename=profile_{profile_id}.folded'
+    })
+
+
+@profiling_bp.route('/profiles/window', methods=['POST'])
+def capture_window():
+    """
+    Sample the whole process for a time window
+    
+    Query params:
+    - seconds (optional): Window length (default: 10)
+    
+    Returns:
+        JSON with the ID the profile will be stored under
+    """
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': 'Invalid seconds value'
+        }), 400
+    
+    profile_id = profiler.capture_window(seconds)
+    return jsonify({
+        'success': True,
+        'profile_id': profile_id,
+        'seconds': min(seconds, profiler.max_window_seconds)
+    }), 202
+
+
+def init_profiling(app) -> bool:
+    """
+    Hook the profiler into the app
+    
+    Requests carrying `X-Profile: cprofile|sample` and a valid token are
+    profiled; with PROFILE_SLOW_THRESHOLD_MS set, every request is sampled
+    and kept only if it turns out slower than the threshold.
+    
+    Args:
+        app: Flask application
+        
+    Returns:
+        True if profiling was enabled
+    """
+    global profiler
+    
+    if not Config.PROFILING_TOKEN:
+        logger.warning("PROFILING_ENABLED is set but PROFILING_TOKEN is empty; profiling stays off")
+        return False
+    
+    profiler = Profiler(
+        token=Config.PROFILING_TOKEN,
+        slow_threshold_ms=Config.PROFILE_SLOW_THRESHOLD_MS,
+        sample_interval_ms=Config.PROFILE_SAMPLE_INTERVAL_MS,
+        max_profiles=Config.PROFILE_RING_SIZE,
+        max_window_seconds=Config.PROFILE_MAX_WINDOW_SECONDS
+    )
+    
+    @app.before_request
+    def start_profile():
+        mode = request.headers.get('X-Profile')
+        if mode not in ('cprofile', 'sample') or not profiler.check_token(_supplied_token()):
+            mode = None
+        g.profile_state = profiler.start_request(mode)
+    
+    @app.after_request
+    def finish_profile(response):
+        state = g.pop('profile_state', None)
+        if state is not None:
+            profile_id = profiler.finish_request(state, request.path)
+            if profile_id and state[0] != 'slow':
+                response.headers['X-Profile-Id'] = profile_id
+        return response
+    
+    @app.teardown_request
+    def abandon_profile(exc):
+        # after_request is skipped when a view raises; still release the profiler
+        state = g.pop('profile_state', None)
+        if state is not None:
+            profiler.finish_request(state, request.path)
+    
+    app.register_blueprint(profiling_bp, url_prefix='/api/debug')
+    logger.info("Profiling enabled", extra={'slow_threshold_ms': Config.PROFILE_SLOW_THRESHOLD_MS})
+    return True
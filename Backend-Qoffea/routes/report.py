@@ -3,14 +3,24 @@ Report Routes
 Handles PDF report generation and download
 """
 
-from flask import Blueprint, jsonify, send_file
+from flask import Blueprint, jsonify, request, send_file
+import functools
 import os
+import uuid
 from config import Config
 from modules import CoffeeAnalyzer
+from modules.annotated_renderer import annotated_renderer, DETECTIONS_DIR
+from modules.derivatives import derivative_store
 from utils import FileHandler
+from utils.metrics import stage_timer
+from utils.upload_sessions import upload_sessions
+from utils.admission import admission, get_client_id, Overloaded, REPORT, BATCH
+from utils.deadline import start_deadline, check_deadline, RequestCancelled
+from utils.logger import get_logger
 from app import model_loader
 
 report_bp = Blueprint('report', __name__)
+logger = get_logger('routes.report')
 
 
 @report_bp.route('/report/<analysis_id>/download', methods=['GET'])
@@ -25,6 +35,8 @@ def download_report(analysis_id):
         PDF file
     """
     try:
+        admission.check_rate(get_client_id(request))
+        
         # Use absolute paths
         abs_upload_folder = os.path.abspath(Config.UPLOAD_FOLDER)
         abs_report_folder = os.path.abspath(Config.REPORT_FOLDER)
@@ -40,15 +52,16 @@ def download_report(analysis_id):
             }), 404
         
         filepath = os.path.abspath(os.path.join(abs_upload_folder, image_files[0]))
-        annotated_path = os.path.abspath(os.path.join(abs_upload_folder, f"annotated_{image_files[0]}"))
+        annotated_path = annotated_renderer.path_for(analysis_id, image_files[0])
         
-        # Re-analyze to get fresh data with all NMS parameters
+        # Re-analyze to get fresh data with all NMS parameters (reused if unchanged)
         analyzer = CoffeeAnalyzer(model_loader)
-        analysis_result = analyzer.analyze_image(
+        analysis_result, _ = analyzer.analyze_stored(
             filepath, 
             Config.CONFIDENCE_THRESHOLD,
             Config.IOU_THRESHOLD,
-            Config.MAX_DETECTIONS
+            Config.MAX_DETECTIONS,
+            priority=REPORT
         )
         
         # Generate PDF report
@@ -58,15 +71,118 @@ def download_report(analysis_id):
         pdf_filename = f"report_{analysis_id}.pdf"
         pdf_path = os.path.abspath(os.path.join(abs_report_folder, pdf_filename))
         
-        pdf_generator.generate_report(
-            analysis_result=analysis_result,
-            original_image_path=filepath,
-            annotated_image_path=annotated_path if os.path.exists(annotated_path) else None,
-            output_path=pdf_path,
-            analyzer=analyzer
-        )
+        check_deadline('pdf')
+        with stage_timer('pdf'):
+            pdf_generator.generate_report(
+                analysis_result=analysis_result,
+                original_image_path=filepath,
+                annotated_image_path=annotated_path,
+                output_path=pdf_path,
+                analyzer=analyzer
+            )
         
         # Send PDF file
+        response = send_file(
+            pdf_path,
+            mimetype='application/pdf',
+            as_attachment=True,
+            download_name=pdf_filename
+        )
+        response.headers['X-QoS-Tier'] = analysis_result.get('qos_tier', 'full')
+        return response
+        
+    except (Overloaded, RequestCancelled) as e:
+        return e.to_response()
+    except Exception as e:
+        logger.exception("Error generating report", extra={'analysis_id': analysis_id})
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@report_bp.route('/report/lot', methods=['POST'])
+def download_lot_report():
+    """
+    Generate and download one PDF report covering a whole lot
+    
+    Expected JSON body:
+    - analysis_ids: List of analysis IDs in the lot
+    - lot_name (optional): Name printed on every page
+        
+    Returns:
+        PDF file
+    """
+    try:
+        admission.check_rate(get_client_id(request))
+        
+        # A lot is many predictions; give it its own, longer deadline
+        start_deadline(Config.LOT_REPORT_TIMEOUT, request.environ)
+        
+        data = request.get_json(silent=True) or {}
+        analysis_ids = data.get('analysis_ids')
+        
+        if not isinstance(analysis_ids, list) or not analysis_ids:
+            return jsonify({
+                'success': False,
+                'error': 'analysis_ids must be a non-empty list'
+            }), 400
+        
+        if len(analysis_ids) > Config.LOT_REPORT_MAX_SAMPLES:
+            return jsonify({
+                'success': False,
+                'error': f'A lot report supports at most {Config.LOT_REPORT_MAX_SAMPLES} analyses'
+            }), 400
+        
+        abs_upload_folder = os.path.abspath(Config.UPLOAD_FOLDER)
+        abs_report_folder = os.path.abspath(Config.REPORT_FOLDER)
+        
+        # Resolve every analysis to its uploaded image
+        samples = []
+        missing_ids = []
+        for analysis_id in analysis_ids:
+            filename = FileHandler.find_upload(abs_upload_folder, str(analysis_id)) if analysis_id else None
+            if filename is None:
+                missing_ids.append(analysis_id)
+                continue
+            samples.append({
+                'analysis_id': str(analysis_id),
+                'image_path': os.path.join(abs_upload_folder, filename),
+                # Rendered on the lot generator's worker threads
+                'annotated_path': functools.partial(annotated_renderer.path_for, str(analysis_id), filename)
+            })
+        
+        if missing_ids:
+            return jsonify({
+                'success': False,
+                'error': 'Analysis not found',
+                'missing_ids': missing_ids
+            }), 404
+        
+        from modules.pdf_generator import LotReportGenerator
+        lot_generator = LotReportGenerator(
+            max_workers=Config.LOT_REPORT_WORKERS,
+            thumbnail_size=Config.LOT_REPORT_THUMBNAIL_SIZE
+        )
+        
+        pdf_filename = f"lot_report_{uuid.uuid4().hex}.pdf"
+        pdf_path = os.path.abspath(os.path.join(abs_report_folder, pdf_filename))
+        
+        with stage_timer('pdf'):
+            lot_generator.generate_lot_report(
+                samples=samples,
+                output_path=pdf_path,
+                analyzer=CoffeeAnalyzer(model_loader),
+                analysis_params={
+                    'confidence': Config.CONFIDENCE_THRESHOLD,
+                    'iou': Config.IOU_THRESHOLD,
+                    'max_det': Config.MAX_DETECTIONS,
+                    # One slot per image, so interactive uploads can cut in between pages
+                    'priority': BATCH
+                },
+                lot_name=str(data.get('lot_name') or '-')
+            )
+        
         return send_file(
             pdf_path,
             mimetype='application/pdf',
@@ -74,8 +190,10 @@ def download_report(analysis_id):
             download_name=pdf_filename
         )
         
+    except (Overloaded, RequestCancelled) as e:
+        return e.to_response()
     except Exception as e:
-        print(f"❌ Error generating report: {str(e)}")
+        logger.exception("Error generating lot report")
         return jsonify({
             'success': False,
             'error': str(e)
@@ -95,7 +213,11 @@ def cleanup_files():
         abs_report_folder = os.path.abspath(Config.REPORT_FOLDER)
         
         FileHandler.cleanup_old_files(abs_upload_folder, max_age_hours=24)
+        FileHandler.cleanup_old_files(os.path.join(abs_upload_folder, DETECTIONS_DIR), max_age_hours=24)
         FileHandler.cleanup_old_files(abs_report_folder, max_age_hours=24)
+        upload_sessions.cleanup()
+        # After the uploads, so derivatives of just-deleted photos go too
+        derivative_store.cleanup()
         
         return jsonify({
             'success': True,
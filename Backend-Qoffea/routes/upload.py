@@ -3,15 +3,143 @@ Upload Routes
 Handles image upload and analysis
 """
 
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, url_for
 from werkzeug.utils import secure_filename
 import os
+import time
 from config import Config
 from modules import ImageProcessor, CoffeeAnalyzer
+from modules.quality_gate import quality_gate
+from modules.annotated_renderer import annotated_renderer
+from modules.derivatives import derivative_store
 from utils import FileHandler, Validator
+from utils.metrics import stage_timer
+from utils.http_cache import etag_matches, ANALYSIS_CACHE_CONTROL, ANALYSIS_CACHE_REQUESTS
+from utils.response_formats import (choose_format, choose_encoding, variant_etag, render_analysis, compress,
+                                    RESPONSE_BYTES)
+from utils.upload_sessions import upload_sessions, UploadSessionError
+from utils.admission import admission, get_client_id, Overloaded, INTERACTIVE, REPORT
+from utils.qos import qos, select_tier
+from utils.deadline import check_deadline, RequestCancelled
+from utils.logger import get_logger
 from app import model_loader
 
 upload_bp = Blueprint('upload', __name__)
+logger = get_logger('routes.upload')
+
+
+def _analyze_upload(filename: str, filepath: str, original_filename: str, confidence: float,
+                    iou_threshold: float, max_detections: int, keep_file: bool = False):
+    """
+    Validate, check and analyze an image saved in the upload folder
+    
+    Shared by single-request and resumable uploads. Overloaded and
+    RequestCancelled propagate to the caller.
+    
+    Args:
+        filename: Unique filename in the upload folder
+        filepath: Path of the saved file
+        original_filename: Client's file name (sanitized)
+        confidence: Confidence threshold
+        iou_threshold: NMS IoU threshold
+        max_detections: Maximum detections per image
+        keep_file: Keep the file when the model is overloaded or the
+            analysis fails, so it can be retried without uploading again
+
+    Returns:
+        Tuple of (JSON response, status code)
+    """
+    # Validate image
+    with stage_timer('validate'):
+        is_valid_image = ImageProcessor.validate_image(filepath)
+    
+    if not is_valid_image:
+        FileHandler.delete_file(filepath)
+        return jsonify({
+            'success': False,
+            'error': 'Invalid or corrupted image file'
+        }), 400
+    
+    # Use absolute path
+    abs_filepath = os.path.abspath(filepath)
+    
+    # Get image info
+    image_info = ImageProcessor.get_image_info(abs_filepath)
+    
+    # Decode once and share the pixels between the model and drawing
+    check_deadline('decode')
+    with stage_timer('decode'):
+        image = ImageProcessor.load_image(abs_filepath)
+    
+    # Turn away unusable photos before they cost an inference
+    with stage_timer('quality'):
+        quality = quality_gate.check(image)
+    
+    if not quality['passed']:
+        FileHandler.delete_file(filepath)
+        return jsonify({
+            'success': False,
+            'error': quality['message'],
+            'quality': {
+                'reason': quality['reason'],
+                'metrics': quality['metrics']
+            }
+        }), 422
+    
+    # Pick a cheaper tier when the model is backed up
+    tier = select_tier(INTERACTIVE)
+    
+    # Predict once with all NMS parameters
+    analyzer = CoffeeAnalyzer(model_loader)
+    try:
+        results = analyzer.detect(image, confidence, iou_threshold, max_detections, INTERACTIVE, tier)
+    except Overloaded:
+        if not keep_file:
+            FileHandler.delete_file(filepath)
+        raise
+    
+    check_deadline('analyze')
+    
+    # Analyze the prediction results
+    with stage_timer('analyze'):
+        analysis_result = analyzer.summarize_results(results, confidence)
+    
+    if not analysis_result['success']:
+        if not keep_file:
+            FileHandler.delete_file(filepath)
+        return jsonify(analysis_result), 500
+    
+    # The annotated image is drawn on first request from the stored detections
+    analysis_id = filename.split('.')[0]
+    annotated_renderer.save_detections(analysis_id, filename, analysis_result)
+    annotated_filename = annotated_renderer.filename(analysis_id) if tier.get('annotate', True) else None
+    
+    # Prepare response
+    response = {
+        'success': True,
+        'analysis_id': analysis_id,
+        'original_filename': original_filename,
+        'uploaded_filename': filename,
+        'annotated_filename': annotated_filename,
+        'derivatives': derivative_store.urls(analysis_id) if annotated_filename else None,
+        'image_info': image_info,
+        'analysis': {
+            'total_beans': analysis_result['total_beans'],
+            'good_beans': analysis_result['good_beans'],
+            'defect_beans': analysis_result['defect_beans'],
+            'good_percentage': analysis_result['good_percentage'],
+            'defect_percentage': analysis_result['defect_percentage'],
+            'confidence_threshold': confidence,
+            'iou_threshold': iou_threshold,
+            'max_detections': max_detections
+        },
+        'detections_count': len(analysis_result.get('detections', [])),
+        'model_version': analysis_result.get('model_version'),
+        'qos_tier': qos.served(tier, analysis_result.get('inference'))['name'],
+        'inference': analysis_result.get('inference')
+    }
+    
+    return jsonify(response), 200
 
 
 @upload_bp.route('/upload', methods=['POST'])
@@ -26,9 +154,16 @@ def upload_image():
     Returns:
     - JSON with analysis results
     """
+    filepath = None
     try:
-        # Check if file is in request
-        if 'file' not in request.files:
+        # Turn away clients over their rate before reading the body
+        admission.check_rate(get_client_id(request))
+        
+        # Check if file is in request (first access parses the request body)
+        with stage_timer('receive'):
+            has_file = 'file' in request.files
+        
+        if not has_file:
             return jsonify({
                 'success': False,
                 'error': 'No file provided'
@@ -37,11 +172,12 @@ def upload_image():
         file = request.files['file']
         
         # Validate file
-        is_valid, message = Validator.validate_upload(
-            file, 
-            Config.ALLOWED_EXTENSIONS,
-            Config.MAX_FILE_SIZE
-        )
+        with stage_timer('validate'):
+            is_valid, message = Validator.validate_upload(
+                file, 
+                Config.ALLOWED_EXTENSIONS,
+                Config.MAX_FILE_SIZE
+            )
         
         if not is_valid:
             return jsonify({
@@ -71,65 +207,225 @@ def upload_image():
             confidence = 0.52
         
         # Save uploaded file
-        filename, filepath = FileHandler.save_upload(file, Config.UPLOAD_FOLDER)
+        with stage_timer('receive'):
+            filename, filepath = FileHandler.save_upload(file, Config.UPLOAD_FOLDER)
         
-        # Validate image
-        if not ImageProcessor.validate_image(filepath):
+        return _analyze_upload(filename, filepath, secure_filename(file.filename),
+                               confidence, iou_threshold, max_detections)
+        
+    except Overloaded as e:
+        return e.to_response()
+    except RequestCancelled as e:
+        # Nobody will look at the result; do not keep its files either
+        if filepath:
             FileHandler.delete_file(filepath)
+        return e.to_response()
+    except Exception as e:
+        logger.exception("Error in upload")
+        return jsonify({
+            'success': False,
+            'error': f'Internal server error: {str(e)}'
+        }), 500
+
+
+def _session_status(session: dict) -> dict:
+    """Public view of an upload session"""
+    return {
+        'success': True,
+        'upload_id': session['upload_id'],
+        'offset': session['offset'],
+        'size': session['size'],
+        'complete': session['offset'] == session['size'],
+        'chunk_size': upload_sessions.chunk_size,
+        'expires_in': int(session['updated_at'] + upload_sessions.ttl_seconds - time.time())
+    }
+
+
+def _with_offset(response, session: dict):
+    """Add the resumable upload headers to a response"""
+    response.headers['Upload-Offset'] = str(session['offset'])
+    response.headers['Upload-Length'] = str(session['size'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@upload_bp.route('/uploads', methods=['POST'])
+def create_upload_session():
+    """
+    Start a resumable upload
+    
+    For slow or unreliable connections: the file is sent in chunks with
+    PUT /api/uploads/<upload_id>, an interrupted upload continues from the
+    offset reported by GET/HEAD, and POST /api/uploads/<upload_id>/finalize
+    analyzes the complete file.
+    
+    Expected JSON body:
+    - filename: Original file name
+    - size: File size in bytes
+    - sha256 (optional): Hex digest of the whole file
+    - confidence, iou, max_det (optional): Detection parameters
+    
+    Returns:
+    - JSON with upload_id, offset and the largest chunk accepted (201)
+    """
+    try:
+        admission.check_rate(get_client_id(request))
+        
+        data = request.get_json(silent=True) or {}
+        filename = secure_filename(str(data.get('filename', '')))
+        if not filename or not Validator.allowed_file(filename, Config.ALLOWED_EXTENSIONS):
             return jsonify({
                 'success': False,
-                'error': 'Invalid or corrupted image file'
+                'error': f"Invalid file type. Allowed: {', '.join(Config.ALLOWED_EXTENSIONS)}"
             }), 400
         
-        # Use absolute path
-        abs_filepath = os.path.abspath(filepath)
+        try:
+            size = int(data.get('size'))
+            confidence = float(data.get('confidence', Config.CONFIDENCE_THRESHOLD))
+            iou_threshold = float(data.get('iou', Config.IOU_THRESHOLD))
+            max_detections = int(data.get('max_det', Config.MAX_DETECTIONS))
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'error': 'size, confidence, iou and max_det must be numbers'
+            }), 400
         
-        # Get image info
-        image_info = ImageProcessor.get_image_info(abs_filepath)
+        is_valid_conf, conf_msg = Validator.validate_confidence(confidence)
+        if not is_valid_conf:
+            return jsonify({
+                'success': False,
+                'error': conf_msg
+            }), 400
         
-        # Analyze image with all NMS parameters
-        analyzer = CoffeeAnalyzer(model_loader)
-        analysis_result = analyzer.analyze_image(abs_filepath, confidence, iou_threshold, max_detections)
+        session = upload_sessions.create(filename, size, data.get('sha256'), {
+            'confidence': max(confidence, 0.52),
+            'iou': iou_threshold,
+            'max_det': max_detections
+        })
+        response = jsonify(_session_status(session))
+        response.status_code = 201
+        response.headers['Location'] = url_for('upload.upload_session_status', upload_id=session['upload_id'])
+        return _with_offset(response, session)
         
-        if not analysis_result['success']:
-            FileHandler.delete_file(filepath)
-            return jsonify(analysis_result), 500
+    except (Overloaded, UploadSessionError) as e:
+        return e.to_response()
+    except Exception as e:
+        logger.exception("Error creating upload session")
+        return jsonify({
+            'success': False,
+            'error': f'Internal server error: {str(e)}'
+        }), 500
+
+
+@upload_bp.route('/uploads/<upload_id>', methods=['GET'])
+def upload_session_status(upload_id):
+    """
+    Bytes received so far (HEAD returns only the Upload-Offset/Upload-Length headers)
+    
+    Args:
+        upload_id: ID of upload session
+    """
+    try:
+        session = upload_sessions.get(upload_id)
+        return _with_offset(jsonify(_session_status(session)), session)
+    except UploadSessionError as e:
+        return e.to_response()
+
+
+@upload_bp.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    """
+    Append a chunk to a resumable upload
+    
+    The body is the raw chunk; it is written to disk as it arrives.
+    
+    Headers:
+    - Upload-Offset: Position of the chunk's first byte (must equal the bytes received)
+    - Content-Length: Chunk size (at most chunk_size)
+    - X-Chunk-SHA256 (optional): Hex digest of the chunk
+    
+    Args:
+        upload_id: ID of upload session
         
-        # Draw detections on image
-        annotated_filename = f"annotated_{filename}"
-        abs_upload_folder = os.path.abspath(Config.UPLOAD_FOLDER)
-        annotated_path = os.path.abspath(os.path.join(abs_upload_folder, annotated_filename))
-        
-        # Get results for drawing with all detection parameters
-        from modules.model_loader import ModelLoader
-        results = model_loader.predict(abs_filepath, conf=confidence, iou=iou_threshold, max_det=max_detections)
-        ImageProcessor.draw_detections(abs_filepath, results, annotated_path, min_confidence=confidence)
-        
-        # Prepare response
-        response = {
-            'success': True,
-            'analysis_id': filename.split('.')[0],
-            'original_filename': secure_filename(file.filename),
-            'uploaded_filename': filename,
-            'annotated_filename': annotated_filename,
-            'image_info': image_info,
-            'analysis': {
-                'total_beans': analysis_result['total_beans'],
-                'good_beans': analysis_result['good_beans'],
-                'defect_beans': analysis_result['defect_beans'],
-                'good_percentage': analysis_result['good_percentage'],
-                'defect_percentage': analysis_result['defect_percentage'],
-                'confidence_threshold': confidence,
-                'iou_threshold': iou_threshold,
-                'max_detections': max_detections
-            },
-            'detections_count': len(analysis_result.get('detections', []))
-        }
-        
-        return jsonify(response), 200
+    Returns:
+    - JSON with the new offset; 409 with the current offset if the client is out of step
+    """
+    try:
+        try:
+            offset = int(request.headers.get('Upload-Offset', request.args.get('offset', '')))
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'Upload-Offset header required'
+            }), 400
         
+        with stage_timer('receive'):
+            session = upload_sessions.write_chunk(upload_id, offset, request.stream, request.content_length,
+                                                  request.headers.get('X-Chunk-SHA256'))
+        return _with_offset(jsonify(_session_status(session)), session)
+        
+    except UploadSessionError as e:
+        return e.to_response()
     except Exception as e:
-        print(f"❌ Error in upload: {str(e)}")
+        logger.exception("Error writing upload chunk")
+        return jsonify({
+            'success': False,
+            'error': f'Internal server error: {str(e)}'
+        }), 500
+
+
+@upload_bp.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload_session(upload_id):
+    """
+    Abandon a resumable upload and delete its bytes
+    
+    Args:
+        upload_id: ID of upload session
+    """
+    try:
+        upload_sessions.abort(upload_id)
+        return jsonify({'success': True}), 200
+    except UploadSessionError as e:
+        return e.to_response()
+
+
+@upload_bp.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload_session(upload_id):
+    """
+    Analyze a completely received upload
+    
+    Args:
+        upload_id: ID of upload session
+        
+    Safe to repeat: after a 429, 5xx or dropped connection the client
+    calls it again; once analyzed (or rejected with a 4xx), the same
+    result is returned.
+    
+    Returns:
+    - JSON with analysis results, as from /api/upload
+    """
+    try:
+        admission.check_rate(get_client_id(request))
+        
+        with upload_sessions.finalizing(upload_id, Config.UPLOAD_FOLDER) as session:
+            if session.get('result'):
+                # Repeated finalize: the analysis already ran
+                return jsonify(session['result']['body']), session['result']['status']
+            
+            # Shed or cancelled requests keep the file, so finalize can be retried
+            params = session['params']
+            response, status = _analyze_upload(session['stored_filename'], session['filepath'], session['filename'],
+                                               params['confidence'], params['iou'], params['max_det'],
+                                               keep_file=True)
+            # Server errors may be transient; only final outcomes are replayed
+            if status < 500:
+                upload_sessions.record_result(session, status, response.get_json())
+            return response, status
+        
+    except (Overloaded, RequestCancelled, UploadSessionError) as e:
+        return e.to_response()
+    except Exception as e:
+        logger.exception("Error finalizing upload")
         return jsonify({
             'success': False,
             'error': f'Internal server error: {str(e)}'
@@ -144,10 +440,22 @@ def get_analysis(analysis_id):
     Args:
         analysis_id: ID of analysis (filename without extension)
         
+    Query parameters:
+    - confidence, iou, max_det (optional): Detection parameters
+    
+    Headers:
+    - Accept (optional): application/json (default), application/msgpack
+      (detections as binary columns) or application/vnd.qoffea.detections+float32
+      (N x 6 float32 rows, summary in X-Analysis-Summary)
+    - Accept-Encoding (optional): zstd or gzip
+    - If-None-Match (optional): ETag of a previous response
+        
     Returns:
-        JSON with detailed analysis
+        Detailed analysis in the negotiated format, or 304
     """
     try:
+        admission.check_rate(get_client_id(request))
+        
         # Use absolute path
         abs_upload_folder = os.path.abspath(Config.UPLOAD_FOLDER)
         
@@ -168,12 +476,38 @@ def get_analysis(analysis_id):
         iou = float(request.args.get('iou', Config.IOU_THRESHOLD))
         max_det = int(request.args.get('max_det', Config.MAX_DETECTIONS))
         
-        # Re-analyze with all NMS parameters
+        # JSON by default; columnar MessagePack or raw float32 for clients that ask
+        fmt = choose_format(request.headers.get('Accept'))
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        
+        # The client's copy is current if model, parameters and image are unchanged
         analyzer = CoffeeAnalyzer(model_loader)
-        analysis_result = analyzer.analyze_image(filepath, confidence, iou, max_det)
+        etag = analyzer.analysis_etag(filepath, confidence, iou, max_det)
+        if etag_matches(request.headers.get('If-None-Match'), variant_etag(etag, fmt, encoding)):
+            ANALYSIS_CACHE_REQUESTS.inc(result='not_modified')
+            response = Response(status=304)
+        else:
+            # Re-analyze with all NMS parameters (or reuse an identical earlier run)
+            analysis_result, etag = analyzer.analyze_stored(filepath, confidence, iou, max_det, priority=REPORT)
+            with stage_timer('serialize'):
+                body, content_type, headers = render_analysis(analysis_result, fmt)
+                body, applied = compress(body, encoding)
+            RESPONSE_BYTES.observe(len(body), format=fmt, encoding=applied)
+            response = Response(body, status=200, content_type=content_type, headers=headers)
+            if applied != 'identity':
+                response.headers['Content-Encoding'] = applied
         
-        return jsonify(analysis_result), 200
+        response.headers['Vary'] = 'Accept, Accept-Encoding'
+        if etag:
+            response.set_etag(variant_etag(etag, fmt, encoding))
+            response.headers['Cache-Control'] = ANALYSIS_CACHE_CONTROL
+        else:
+            # Degraded results must not be reused
+            response.headers['Cache-Control'] = 'no-store'
+        return response
         
+    except (Overloaded, RequestCancelled) as e:
+        return e.to_response()
     except Exception as e:
         return jsonify({
             'success': False,
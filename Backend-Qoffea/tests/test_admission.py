@@ -0,0 +1,113 @@
+"""
+Tests for the admission controller: stride scheduling, shedding and rate limits
+"""
+
+import pytest
+
+from utils.admission import AdmissionController, Overloaded, _Waiter, INTERACTIVE, REPORT, BATCH
+
+
+def busy_controller(**options) -> AdmissionController:
+    """Controller with its only slot taken, so new requests queue"""
+    controller = AdmissionController(concurrency=1, **options)
+    controller.acquire(INTERACTIVE)
+    return controller
+
+
+def queue_waiters(controller: AdmissionController, priority: str, count: int) -> list:
+    """Put waiters straight into a class queue, as blocked acquire() calls would"""
+    waiters = [_Waiter(priority) for _ in range(count)]
+    controller._queues[priority].extend(waiters)
+    return waiters
+
+
+def grant_order(controller: AdmissionController, waiters: list) -> list:
+    """Release the slot once per waiter and record which class gets it next"""
+    order = []
+    for _ in waiters:
+        controller.release()
+        granted = [waiter for waiter in waiters if waiter.granted and waiter not in order]
+        assert len(granted) == 1
+        order.append(granted[0])
+    return [waiter.priority for waiter in order]
+
+
+def test_classes_share_the_model_by_weight():
+    controller = busy_controller(weights={INTERACTIVE: 3, REPORT: 1, BATCH: 1})
+    waiters = queue_waiters(controller, BATCH, 4) + queue_waiters(controller, INTERACTIVE, 8)
+
+    order = grant_order(controller, waiters)
+
+    # Three interactive grants for every batch grant while both are queued
+    assert order[:8].count(INTERACTIVE) == 6
+    assert order[:8].count(BATCH) == 2
+    # Batch is not starved by a steady interactive queue
+    assert BATCH in order[:4]
+
+
+def test_waiters_of_one_class_are_served_in_order():
+    controller = busy_controller()
+    waiters = queue_waiters(controller, REPORT, 3)
+
+    for waiter in waiters:
+        controller.release()
+        assert waiter.granted
+
+
+def test_full_queue_sheds_interactive_requests():
+    controller = busy_controller(max_queue_depth=2)
+    queue_waiters(controller, INTERACTIVE, 2)
+
+    with pytest.raises(Overloaded) as excinfo:
+        controller.acquire(INTERACTIVE)
+
+    assert excinfo.value.status == 503
+    assert excinfo.value.reason == 'queue_full'
+    assert excinfo.value.retry_after >= 1
+
+
+def test_batch_waiters_do_not_fill_the_queue():
+    controller = busy_controller(max_queue_depth=2, max_queue_time=0.05, batch_queue_time=0.05)
+    queue_waiters(controller, BATCH, 5)
+
+    # Interactive still gets a place (and times out, since nothing releases)
+    with pytest.raises(Overloaded) as excinfo:
+        controller.acquire(INTERACTIVE)
+    assert excinfo.value.reason == 'queue_timeout'
+
+    # Batch is never shed for a full queue, only after its own wait budget
+    queue_waiters(controller, INTERACTIVE, 2)
+    with pytest.raises(Overloaded) as excinfo:
+        controller.acquire(BATCH)
+    assert excinfo.value.reason == 'queue_timeout'
+
+
+def test_timed_out_waiter_leaves_the_queue():
+    controller = busy_controller(max_queue_time=0.05)
+
+    with pytest.raises(Overloaded):
+        controller.acquire(REPORT)
+
+    assert controller.waiting == 0
+
+
+def test_rate_limit_allows_a_burst_then_rejects():
+    controller = AdmissionController(client_rate=0.5, client_burst=2)
+
+    controller.check_rate('10.0.0.1')
+    controller.check_rate('10.0.0.1')
+    with pytest.raises(Overloaded) as excinfo:
+        controller.check_rate('10.0.0.1')
+
+    assert excinfo.value.status == 429
+    assert excinfo.value.reason == 'rate_limited'
+    assert excinfo.value.retry_after >= 1
+    # Buckets are per client
+    controller.check_rate('10.0.0.2')
+
+
+def test_rate_limit_off_by_default():
+    controller = AdmissionController()
+
+    for _ in range(100):
+        controller.check_rate('10.0.0.1')
@@ -0,0 +1,176 @@
+"""
+Tests for resumable upload sessions: offsets, checksums, finalizing and expiry
+"""
+
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+from utils.upload_sessions import UploadSessions, UploadSessionError
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    store = UploadSessions()
+    store.configure(str(tmp_path / 'sessions'), max_file_size=len(DATA) * 2, chunk_size=4096)
+    return store
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def write(sessions, upload_id, offset, data, length=None, checksum=None):
+    return sessions.write_chunk(upload_id, offset, io.BytesIO(data),
+                                len(data) if length is None else length, checksum)
+
+
+def part_size(sessions, upload_id) -> int:
+    return os.path.getsize(os.path.join(sessions.session_dir, f"{upload_id}.part"))
+
+
+def upload(sessions, data=DATA, sha=None) -> str:
+    upload_id = sessions.create('beans.jpg', len(data), sha)['upload_id']
+    for offset in range(0, len(data), sessions.chunk_size):
+        write(sessions, upload_id, offset, data[offset:offset + sessions.chunk_size])
+    return upload_id
+
+
+def test_chunks_append_at_the_offset(sessions):
+    upload_id = sessions.create('beans.jpg', len(DATA))['upload_id']
+
+    session = write(sessions, upload_id, 0, DATA[:4096], checksum=sha256(DATA[:4096]))
+    assert session['offset'] == 4096
+    session = write(sessions, upload_id, 4096, DATA[4096:8192])
+    assert session['offset'] == 8192
+    assert part_size(sessions, upload_id) == 8192
+
+
+def test_offset_mismatch_reports_the_stored_offset(sessions):
+    upload_id = sessions.create('beans.jpg', len(DATA))['upload_id']
+    write(sessions, upload_id, 0, DATA[:4096])
+
+    # A client that lost the response resends the same chunk
+    with pytest.raises(UploadSessionError) as excinfo:
+        write(sessions, upload_id, 0, DATA[:4096])
+
+    assert excinfo.value.status == 409
+    assert excinfo.value.offset == 4096
+    assert sessions.get(upload_id)['offset'] == 4096
+
+
+def test_checksum_mismatch_rolls_the_chunk_back(sessions):
+    upload_id = sessions.create('beans.jpg', len(DATA))['upload_id']
+    write(sessions, upload_id, 0, DATA[:4096])
+
+    with pytest.raises(UploadSessionError) as excinfo:
+        write(sessions, upload_id, 4096, DATA[4096:8192], checksum=sha256(b'something else'))
+
+    assert excinfo.value.status == 400
+    assert excinfo.value.offset == 4096
+    assert part_size(sessions, upload_id) == 4096
+    # The same chunk can be sent again
+    assert write(sessions, upload_id, 4096, DATA[4096:8192])['offset'] == 8192
+
+
+def test_short_chunk_rolls_back(sessions):
+    upload_id = sessions.create('beans.jpg', len(DATA))['upload_id']
+
+    # Connection dropped: fewer bytes arrived than Content-Length announced
+    with pytest.raises(UploadSessionError) as excinfo:
+        write(sessions, upload_id, 0, DATA[:1000], length=4096)
+
+    assert excinfo.value.status == 400
+    assert part_size(sessions, upload_id) == 0
+    assert sessions.get(upload_id)['offset'] == 0
+
+
+def test_chunk_limits(sessions):
+    upload_id = sessions.create('beans.jpg', len(DATA))['upload_id']
+
+    with pytest.raises(UploadSessionError) as excinfo:
+        write(sessions, upload_id, 0, DATA[:4097])
+    assert excinfo.value.status == 413
+
+    with pytest.raises(UploadSessionError) as excinfo:
+        sessions.create('beans.jpg', sessions.max_file_size + 1)
+    assert excinfo.value.status == 413
+
+
+def test_finalizing_moves_the_file_once(sessions, tmp_path):
+    upload_folder = tmp_path / 'uploads'
+    upload_folder.mkdir()
+    upload_id = upload(sessions, sha=sha256(DATA))
+
+    with sessions.finalizing(upload_id, str(upload_folder)) as session:
+        stored = session['stored_filename']
+        sessions.record_result(session, 200, {'success': True})
+    assert (upload_folder / stored).read_bytes() == DATA
+
+    # A repeat gets the same file and the recorded outcome
+    with sessions.finalizing(upload_id, str(upload_folder)) as session:
+        assert session['stored_filename'] == stored
+        assert session['result'] == {'status': 200, 'body': {'success': True}}
+
+
+def test_finalizing_rejects_incomplete_uploads(sessions, tmp_path):
+    upload_id = sessions.create('beans.jpg', len(DATA))['upload_id']
+    write(sessions, upload_id, 0, DATA[:4096])
+
+    with pytest.raises(UploadSessionError) as excinfo:
+        with sessions.finalizing(upload_id, str(tmp_path)):
+            pass
+
+    assert excinfo.value.status == 409
+    assert excinfo.value.offset == 4096
+
+
+def test_finalizing_deletes_a_corrupt_upload(sessions, tmp_path):
+    upload_id = upload(sessions, sha=sha256(b'another file'))
+
+    with pytest.raises(UploadSessionError) as excinfo:
+        with sessions.finalizing(upload_id, str(tmp_path)):
+            pass
+
+    assert excinfo.value.status == 422
+    with pytest.raises(UploadSessionError):
+        sessions.get(upload_id)
+
+
+def test_concurrent_requests_for_a_session_are_refused(sessions, tmp_path):
+    upload_id = upload(sessions)
+
+    with sessions.finalizing(upload_id, str(tmp_path)):
+        with pytest.raises(UploadSessionError) as excinfo:
+            write(sessions, upload_id, len(DATA), b'x')
+    assert excinfo.value.status == 409
+
+
+def test_idle_sessions_expire(sessions):
+    sessions.ttl_seconds = 0.05
+    upload_id = sessions.create('beans.jpg', len(DATA))['upload_id']
+    time.sleep(0.1)
+
+    with pytest.raises(UploadSessionError) as excinfo:
+        sessions.get(upload_id)
+
+    assert excinfo.value.status == 404
+    assert os.listdir(sessions.session_dir) == []
+
+
+def test_cleanup_removes_expired_sessions(sessions):
+    stale = sessions.create('old.jpg', len(DATA))['upload_id']
+    fresh = sessions.create('new.jpg', len(DATA))['upload_id']
+    old = time.time() - sessions.ttl_seconds - 60
+    for suffix in ('.json', '.part'):
+        os.utime(os.path.join(sessions.session_dir, stale + suffix), (old, old))
+
+    assert sessions.cleanup() == 1
+    assert sessions.get(fresh)['upload_id'] == fresh
+    with pytest.raises(UploadSessionError):
+        sessions.get(stale)
@@ -0,0 +1,372 @@
+"""
+Admission Control Utility
+Bounded, priority-aware inference queue, queueing deadline and per-client rate limiting
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from utils.metrics import metrics, QUEUE_DEPTH, DEFAULT_BUCKETS
+from utils.logger import get_logger
+from utils.deadline import get_deadline, RequestCancelled
+
+logger = get_logger('admission')
+
+ADMISSION_REJECTED = metrics.counter(
+    'qoffea_admission_rejected_total',
+    'Inference requests rejected by admission control',
+    ('reason', 'priority')
+)
+CLASS_QUEUE_DEPTH = metrics.gauge(
+    'qoffea_inference_queue_depth_by_priority',
+    'Requests waiting for the model per priority class',
+    ('priority',)
+)
+QUEUE_WAIT = metrics.histogram(
+    'qoffea_inference_queue_wait_seconds',
+    'Time spent waiting for an inference slot',
+    ('priority',),
+    buckets=(0.001,) + DEFAULT_BUCKETS
+)
+INFERENCE_ACTIVE = metrics.gauge(
+    'qoffea_inference_active',
+    'Inference slots currently in use'
+)
+
+# Idle client buckets kept for rate limiting before the oldest is dropped
+MAX_TRACKED_CLIENTS = 10000
+
+# How often a queued request wakes up to check its deadline and client
+CANCEL_POLL_INTERVAL = 0.1
+
+# Priority classes, most latency-sensitive first
+INTERACTIVE = 'interactive'
+REPORT = 'report'
+BATCH = 'batch'
+PRIORITIES = (INTERACTIVE, REPORT, BATCH)
+DEFAULT_WEIGHTS = {INTERACTIVE: 8, REPORT: 3, BATCH: 1}
+
+
+def parse_weights(spec: str) -> dict:
+    """
+    Parse "interactive=8,report=3,batch=1" into a weight per class
+
+    Missing or invalid entries keep their default weight.
+    """
+    weights = dict(DEFAULT_WEIGHTS)
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, value = item.partition('=')
+        name = name.strip()
+        if name in weights:
+            try:
+                weights[name] = max(0.01, float(value))
+            except ValueError:
+                logger.warning("Ignoring invalid priority weight", extra={'entry': item})
+    return weights
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted for inference"""
+
+    def __init__(self, status: int, reason: str, retry_after: int, message: str):
+        """
+        Args:
+            status: HTTP status to answer with (429 or 503)
+            reason: Metric label ('rate_limited', 'queue_full', 'queue_timeout', 'draining')
+            retry_after: Seconds the client should wait before retrying
+            message: Human readable error
+        """
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def to_response(self):
+        """Build the JSON error response with a Retry-After header"""
+        from flask import jsonify
+        response = jsonify({
+            'success': False,
+            'error': str(self),
+            'reason': self.reason,
+            'retry_after': self.retry_after
+        })
+        response.status_code = self.status
+        response.headers['Retry-After'] = str(self.retry_after)
+        return response
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float):
+        """
+        Args:
+            rate: Tokens added per second
+            burst: Bucket capacity
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Take one token
+
+        Returns:
+            0 if a token was taken, otherwise seconds until one is available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ('event', 'granted', 'priority')
+
+    def __init__(self, priority: str):
+        self.event = threading.Event()
+        self.granted = False
+        self.priority = priority
+
+
+class AdmissionController:
+    """
+    Gate in front of the model
+
+    At most `concurrency` predictions run at once; up to `max_queue_depth`
+    more wait for at most `max_queue_time` seconds. Anything beyond that is
+    rejected immediately with a Retry-After estimate instead of piling up
+    behind the model until every request times out.
+
+    Waiters are queued per priority class and slots are handed out by stride
+    scheduling: each class advances a virtual clock by 1/weight per grant
+    and the class with the lowest clock goes next, so under contention the
+    classes share the model in proportion to their weights. Bulk callers
+    acquire one slot per image, which makes them preemptible at image
+    boundaries; their waiters do not count towards max_queue_depth and are
+    only turned away after batch_queue_time, so a burst of uploads slows a
+    lot report down instead of aborting it.
+    """
+
+    def __init__(self, max_queue_depth: int = 16, max_queue_time: float = 10.0, concurrency: int = 1,
+                 client_rate: float = 0, client_burst: float = 5, weights: dict = None,
+                 batch_queue_time: float = 300.0):
+        self._lock = threading.Lock()
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._pass = {priority: 0.0 for priority in PRIORITIES}
+        self._virtual_time = 0.0
+        self._active = 0
+        self._buckets = OrderedDict()
+        # Moving average of how long a slot is held, for Retry-After
+        self._service_time = 0.5
+        # Moving average of queue wait for latency-sensitive classes, for QoS
+        self._recent_wait = 0.0
+        self.configure(max_queue_depth, max_queue_time, concurrency, client_rate, client_burst,
+                       weights, batch_queue_time)
+
+    def configure(self, max_queue_depth: int = 16, max_queue_time: float = 10.0, concurrency: int = 1,
+                  client_rate: float = 0, client_burst: float = 5, weights: dict = None,
+                  batch_queue_time: float = 300.0):
+        """
+        Apply limits
+
+        Args:
+            max_queue_depth: Interactive and report requests allowed to wait for the model
+            max_queue_time: Longest an interactive or report request may wait before it is rejected
+            concurrency: Predictions allowed to run at once
+            client_rate: Inference requests per second per client (0 = unlimited)
+            client_burst: Requests a client may make back to back
+            weights: Share of the model per priority class (default DEFAULT_WEIGHTS)
+            batch_queue_time: Longest a batch image may wait; bulk jobs are
+                expected to queue behind interactive traffic
+        """
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_time = max_queue_time
+        self.concurrency = max(1, concurrency)
+        self.client_rate = client_rate
+        self.client_burst = max(1, client_burst)
+        self.weights = dict(weights or DEFAULT_WEIGHTS)
+        self.batch_queue_time = batch_queue_time
+
+    @property
+    def waiting(self) -> int:
+        """Requests currently queued across all classes"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def load_signal(self) -> tuple:
+        """
+        Current load as seen by latency-sensitive requests
+
+        Batch waiters are left out: bulk work queues by design.
+
+        Returns:
+            Tuple of (queued interactive/report requests, recent queue wait in seconds)
+        """
+        return self.waiting - len(self._queues[BATCH]), self._recent_wait
+
+    def _record_wait(self, seconds: float, priority: str):
+        QUEUE_WAIT.observe(seconds, priority=priority)
+        if priority != BATCH:
+            self._recent_wait = 0.8 * self._recent_wait + 0.2 * seconds
+
+    def _retry_after(self, waiting: int) -> int:
+        return max(1, math.ceil(self._service_time * (waiting + 1) / self.concurrency))
+
+    def _reject(self, status: int, reason: str, retry_after: int, message: str, priority: str = INTERACTIVE):
+        ADMISSION_REJECTED.inc(reason=reason, priority=priority)
+        logger.warning("Inference request rejected",
+                       extra={'reason': reason, 'priority': priority, 'retry_after': retry_after})
+        raise Overloaded(status, reason, retry_after, message)
+
+    def check_rate(self, client_id: str):
+        """
+        Take a token from the client's bucket
+
+        Args:
+            client_id: Client identifier (usually the remote address)
+
+        Raises:
+            Overloaded: 429 when the client is over its rate
+        """
+        if self.client_rate <= 0:
+            return
+        with self._lock:
+            bucket = self._buckets.pop(client_id, None) or TokenBucket(self.client_rate, self.client_burst)
+            self._buckets[client_id] = bucket
+            if len(self._buckets) > MAX_TRACKED_CLIENTS:
+                self._buckets.popitem(last=False)
+            wait = bucket.take()
+        if wait:
+            self._reject(429, 'rate_limited', max(1, math.ceil(wait)), 'Too many requests, slow down')
+
+    def _update_depth(self):
+        # Caller holds the lock
+        QUEUE_DEPTH.set(self.waiting)
+        for priority, queue in self._queues.items():
+            CLASS_QUEUE_DEPTH.set(len(queue), priority=priority)
+        INFERENCE_ACTIVE.set(self._active)
+
+    def _charge(self, priority: str):
+        # Caller holds the lock; a class that was idle does not bank credit
+        start = max(self._pass[priority], self._virtual_time)
+        self._virtual_time = start
+        self._pass[priority] = start + 1.0 / self.weights.get(priority, 1)
+
+    def _grant_next(self):
+        # Caller holds the lock
+        while self._active < self.concurrency:
+            ready = [priority for priority in PRIORITIES if self._queues[priority]]
+            if not ready:
+                break
+            priority = min(ready, key=lambda name: max(self._pass[name], self._virtual_time))
+            waiter = self._queues[priority].popleft()
+            self._charge(priority)
+            waiter.granted = True
+            self._active += 1
+            waiter.event.set()
+        self._update_depth()
+
+    def acquire(self, priority: str = INTERACTIVE):
+        """
+        Wait for an inference slot
+
+        Args:
+            priority: 'interactive', 'report' or 'batch'
+
+        Raises:
+            Overloaded: 503 when the queue is full (interactive and report
+                only) or the wait exceeds the class deadline
+            RequestCancelled: When the request's deadline passes or its client
+                disconnects while queued; the work never reaches the model
+        """
+        if priority not in self._queues:
+            priority = INTERACTIVE
+        start = time.perf_counter()
+        with self._lock:
+            if self._active < self.concurrency and not self.waiting:
+                self._active += 1
+                self._charge(priority)
+                INFERENCE_ACTIVE.set(self._active)
+                self._record_wait(0.0, priority)
+                return
+            # Batch waiters have their own budget (batch_queue_time) and never
+            # take queue places from, or get shed by, interactive bursts
+            waiting = self.waiting - len(self._queues[BATCH])
+            if priority != BATCH and waiting >= self.max_queue_depth:
+                retry_after = self._retry_after(waiting)
+                full = True
+            else:
+                full = False
+                waiter = _Waiter(priority)
+                self._queues[priority].append(waiter)
+                self._update_depth()
+        if full:
+            self._reject(503, 'queue_full', retry_after, 'Server is busy, please retry shortly', priority)
+
+        timeout = self.batch_queue_time if priority == BATCH else self.max_queue_time
+        give_up_at = time.monotonic() + timeout
+        deadline = get_deadline()
+        cancelled = None
+        while not waiter.event.is_set():
+            left = give_up_at - time.monotonic()
+            if left <= 0:
+                break
+            # Wake up periodically so abandoned requests leave the queue
+            if waiter.event.wait(min(left, CANCEL_POLL_INTERVAL) if deadline else left):
+                break
+            if deadline is not None:
+                try:
+                    deadline.check('queue')
+                except RequestCancelled as e:
+                    cancelled = e
+                    break
+
+        if not waiter.granted:
+            with self._lock:
+                if not waiter.granted:
+                    self._queues[priority].remove(waiter)
+                    self._update_depth()
+                    retry_after = self._retry_after(self.waiting)
+        if cancelled is not None:
+            if waiter.granted:
+                self.release()
+            raise cancelled
+        if not waiter.granted:
+            self._record_wait(timeout, priority)
+            self._reject(503, 'queue_timeout', retry_after, 'Server is busy, please retry shortly', priority)
+        self._record_wait(time.perf_counter() - start, priority)
+
+    def release(self, held: float = None):
+        """
+        Free an inference slot
+
+        Args:
+            held: Seconds the slot was held, used for Retry-After estimates
+        """
+        with self._lock:
+            if held is not None:
+                self._service_time = 0.8 * self._service_time + 0.2 * held
+            self._active -= 1
+            self._grant_next()
+
+
+def get_client_id(request) -> str:
+    """
+    Identify the client for rate limiting
+
+    Proxies append the address they received the request from to
+    X-Forwarded-For, after whatever the client sent, so only the entries
+    added by trusted proxies can be believed. create_app wraps the app in
+    ProxyFix with TRUSTED_PROXY_HOPS, which sets remote_addr to the entry
+    the outermost trusted proxy added (the last one behind Cloud Run).
+    """
+    return request.remote_addr or '-'
+
+
+# Process-wide controller shared by every caller of the model
+admission = AdmissionController()
@@ -0,0 +1,153 @@
+"""
+Deadline Utility
+Per-request deadlines and client-disconnect detection for cooperative cancellation
+"""
+
+import socket
+import time
+from contextvars import ContextVar
+from utils.metrics import metrics
+from utils.logger import get_logger
+
+logger = get_logger('deadline')
+
+REQUESTS_CANCELLED = metrics.counter(
+    'qoffea_requests_cancelled_total',
+    'Requests abandoned before finishing, by reason and the stage that noticed',
+    ('reason', 'stage')
+)
+
+# Deadline of the request handled by the current thread
+_current = ContextVar('deadline', default=None)
+
+# Status sent when the client is gone; nobody reads it, but logs and metrics do
+CLIENT_CLOSED_REQUEST = 499
+
+
+class RequestCancelled(Exception):
+    """Raised at a stage boundary once the request is no longer worth finishing"""
+
+    def __init__(self, reason: str, stage: str):
+        """
+        Args:
+            reason: 'deadline' or 'disconnected'
+            stage: Pipeline stage about to start when the cancellation was noticed
+        """
+        super().__init__(f"Request cancelled ({reason}) before {stage}")
+        self.reason = reason
+        self.stage = stage
+
+    def to_response(self):
+        """Build the JSON error response (504 on deadline, 499 on disconnect)"""
+        from flask import jsonify
+        response = jsonify({
+            'success': False,
+            'error': 'Request took too long' if self.reason == 'deadline' else 'Client disconnected',
+            'reason': self.reason
+        })
+        response.status_code = 504 if self.reason == 'deadline' else CLIENT_CLOSED_REQUEST
+        return response
+
+
+class Deadline:
+
+    def __init__(self, timeout: float, client_socket=None, disconnected=None):
+        """
+        Args:
+            timeout: Seconds the request may take in total
+            client_socket: Connection socket used to detect disconnects (optional)
+            disconnected: threading.Event set by the server on disconnect (optional, ASGI)
+        """
+        self.expires_at = time.monotonic() + timeout
+        self.client_socket = client_socket
+        self.disconnected = disconnected
+        self.cancelled = None
+
+    def remaining(self) -> float:
+        """Seconds left before the deadline (never negative)"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def client_disconnected(self) -> bool:
+        """
+        Check whether the client closed its side of the connection
+
+        Peeks at the socket without consuming data: an orderly shutdown reads
+        as b'' and a reset raises. Pipelined bytes or nothing to read both
+        mean the client is still there.
+        """
+        if self.disconnected is not None:
+            return self.disconnected.is_set()
+        if self.client_socket is None:
+            return False
+        try:
+            return self.client_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except (BlockingIOError, InterruptedError):
+            return False
+        except (ConnectionError, OSError):
+            return True
+
+    def check(self, stage: str):
+        """
+        Raise if the request should stop before starting a stage
+
+        Args:
+            stage: Stage about to start
+
+        Raises:
+            RequestCancelled: When the deadline passed or the client disconnected
+        """
+        if self.cancelled is None:
+            if time.monotonic() >= self.expires_at:
+                self.cancelled = 'deadline'
+            elif self.client_disconnected():
+                self.cancelled = 'disconnected'
+            else:
+                return
+            REQUESTS_CANCELLED.inc(reason=self.cancelled, stage=stage)
+            logger.info("Request cancelled", extra={'reason': self.cancelled, 'stage': stage})
+        raise RequestCancelled(self.cancelled, stage)
+
+
+def start_deadline(timeout: float, environ: dict = None) -> Deadline:
+    """
+    Bind a deadline to the current request
+
+    Args:
+        timeout: Seconds the request may take
+        environ: WSGI environ, used to find the client socket
+            (gunicorn and the werkzeug dev server both expose it) or the
+            disconnect event set by the ASGI entry point
+
+    Returns:
+        The new Deadline
+    """
+    environ = environ or {}
+    client_socket = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    deadline = Deadline(timeout, client_socket, environ.get('qoffea.disconnected'))
+    _current.set(deadline)
+    return deadline
+
+
+def clear_deadline():
+    """Unbind the deadline from the current context"""
+    _current.set(None)
+
+
+def get_deadline():
+    """Get the current request's deadline, or None outside a request"""
+    return _current.get()
+
+
+def check_deadline(stage: str):
+    """
+    Stage-boundary check; a no-op when no deadline is bound
+
+    Args:
+        stage: Stage about to start
+
+    Raises:
+        RequestCancelled: When the request should stop
+    """
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check(stage)
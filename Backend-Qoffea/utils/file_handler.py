@@ -8,6 +8,9 @@ import uuid
 from pathlib import Path
 from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
+from utils.logger import get_logger
+
+logger = get_logger('file_handler')
 
 
 class FileHandler:
@@ -52,7 +55,7 @@ class FileHandler:
                 return True
             return False
         except Exception as e:
-            print(f"Error deleting file {filepath}: {e}")
+            logger.warning("Error deleting file", extra={'path': filepath, 'error': str(e)})
             return False
     
     @staticmethod
@@ -72,18 +75,35 @@ class FileHandler:
         for filename in os.listdir(folder):
             filepath = os.path.join(folder, filename)
             
-            # Skip .gitkeep files
-            if filename == '.gitkeep':
+            # Skip .gitkeep files and subfolders
+            if filename == '.gitkeep' or os.path.isdir(filepath):
                 continue
             
             try:
                 file_time = datetime.fromtimestamp(os.path.getmtime(filepath))
                 if file_time < cutoff_time:
                     os.remove(filepath)
-                    print(f"🗑️ Cleaned up old file: {filename}")
+                    logger.info("Cleaned up old file", extra={'file': filename})
             except Exception as e:
-                print(f"Error cleaning up {filename}: {e}")
+                logger.warning("Error cleaning up file", extra={'file': filename, 'error': str(e)})
     
+    @staticmethod
+    def find_upload(upload_folder: str, analysis_id: str):
+        """
+        Find the original uploaded image for an analysis
+
+        Args:
+            upload_folder: Folder containing uploads
+            analysis_id: ID of analysis (filename without extension)
+
+        Returns:
+            Filename of the uploaded image, or None if not found
+        """
+        for filename in os.listdir(upload_folder):
+            if filename.startswith(analysis_id) and not filename.startswith('annotated_'):
+                return filename
+        return None
+
     @staticmethod
     def get_file_size(filepath: str) -> int:
         """
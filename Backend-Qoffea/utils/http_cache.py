@@ -0,0 +1,134 @@
+"""
+HTTP Cache Utility
+Content-hash ETags, conditional request checks and a cache of analysis results
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from utils.metrics import metrics
+
+ANALYSIS_CACHE_REQUESTS = metrics.counter(
+    'qoffea_analysis_cache_requests_total',
+    'Re-analysis requests, by result (not_modified, hit, miss)',
+    ('result',)
+)
+
+# Cache-Control per artifact type
+# Uploads are user photos, deleted after 24 hours: browser cache only
+UPLOAD_CACHE_CONTROL = 'private, max-age=86400'
+# Annotated images only change when the render settings do; like uploads they are user data
+ANNOTATED_CACHE_CONTROL = 'private, max-age=86400'
+# Reports are regenerated in place; analyses change with the model. Both revalidate.
+REPORT_CACHE_CONTROL = 'no-cache'
+ANALYSIS_CACHE_CONTROL = 'private, no-cache'
+
+# Content hashes kept, keyed by path, mtime and size
+MAX_HASHED_FILES = 4096
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_hash_lock = threading.Lock()
+_content_hashes = OrderedDict()
+
+
+def content_hash(path: str) -> str:
+    """
+    SHA-256 of a file, remembered until the file changes
+
+    Args:
+        path: File path
+
+    Returns:
+        Hex digest
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _hash_lock:
+        digest = _content_hashes.get(key)
+        if digest is not None:
+            _content_hashes.move_to_end(key)
+            return digest
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    with _hash_lock:
+        _content_hashes[key] = digest
+        if len(_content_hashes) > MAX_HASHED_FILES:
+            _content_hashes.popitem(last=False)
+    return digest
+
+
+def file_etag(path: str) -> str:
+    """Strong ETag (without quotes) from a file's content"""
+    return content_hash(path)[:32]
+
+
+def make_etag(*parts) -> str:
+    """Strong ETag (without quotes) from the values a response is derived from"""
+    return hashlib.sha256('|'.join(str(part) for part in parts).encode()).hexdigest()[:32]
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Whether an If-None-Match header matches an ETag
+
+    Args:
+        if_none_match: Header value (may list several tags, or be '*')
+        etag: ETag without quotes
+
+    Returns:
+        True if the client's copy is current
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    return any(tag.strip().replace('W/', '', 1).strip('"') == etag for tag in if_none_match.split(','))
+
+
+class AnalysisCache:
+    """
+    Results of re-analysing stored uploads, keyed by their ETag
+
+    The key covers the model version, the detection parameters and the
+    upload's content hash, so an entry stays valid until one of them changes.
+    Least recently used entries are dropped past max_entries.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.max_entries = max_entries
+
+    def configure(self, max_entries: int):
+        """Set the number of results kept (0 disables the cache)"""
+        with self._lock:
+            self.max_entries = max_entries
+            while len(self._entries) > max(max_entries, 0):
+                self._entries.popitem(last=False)
+
+    def get(self, key: str):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key: str, result: dict):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# Configured by create_app
+analysis_cache = AnalysisCache()
@@ -0,0 +1,233 @@
+"""
+Logger Utility
+Structured logging with request IDs, JSON output and sampled hot-path logs
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+
+
+ROOT_LOGGER_NAME = 'qoffea'
+
+# ID of the request being handled by the current thread
+_request_id = ContextVar('request_id', default='-')
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {
+    'message', 'asctime', 'request_id'
+}
+
+_listener = None
+
+# Defaults for SampledLogger instances that do not set their own
+_sampling = {'sample_rate': 0.01, 'max_per_second': 10}
+
+
+def set_request_id(request_id: str):
+    """Bind a request ID to the current context"""
+    _request_id.set(request_id)
+
+
+def get_request_id() -> str:
+    """Get the request ID bound to the current context"""
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """Attach the current request ID to every record"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that keeps tracebacks separate from the message"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with fields Cloud Logging understands"""
+
+    def format(self, record):
+        payload = {
+            'timestamp': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}Z',
+            'severity': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', '-'),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                payload[key] = value
+        if record.exc_info:
+            payload['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload['exception'] = record.exc_text
+        return json.dumps(payload, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human readable format for local development"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)-7s [%(request_id)s] %(name)s: %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        extras = {k: v for k, v in record.__dict__.items() if k not in _RECORD_ATTRIBUTES}
+        if extras:
+            text += ' ' + ' '.join(f'{k}={v}' for k, v in extras.items())
+        return text
+
+
+def _stop_listener():
+    """Flush and stop the background log writer, if running"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def configure_logging(level: str = 'INFO', fmt: str = 'json', module_levels: str = '',
+                      sample_rate: float = 0.01, max_per_second: float = 10, asynchronous: bool = True):
+    """
+    Configure the qoffea logger hierarchy
+
+    Args:
+        level: Default level name (DEBUG, INFO, WARNING, ...)
+        fmt: 'json' for structured output, 'text' for development
+        module_levels: Per-logger overrides, e.g. "analyzer=DEBUG,model_loader=WARNING"
+        sample_rate: Default fraction of sampled hot-path logs kept
+        max_per_second: Default cap on sampled hot-path logs per second
+        asynchronous: Format and write records on a background thread
+    """
+    global _listener
+
+    _sampling['sample_rate'] = sample_rate
+    _sampling['max_per_second'] = max_per_second
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(level.upper())
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    _stop_listener()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    if asynchronous:
+        # Request threads only enqueue; a listener thread does the I/O
+        log_queue = queue.SimpleQueue()
+        queue_handler = _QueueHandler(log_queue)
+        queue_handler.addFilter(RequestIdFilter())
+        root.addHandler(queue_handler)
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        _listener.start()
+    else:
+        stream_handler.addFilter(RequestIdFilter())
+        root.addHandler(stream_handler)
+
+    for override in filter(None, (item.strip() for item in module_levels.split(','))):
+        name, _, module_level = override.partition('=')
+        if module_level:
+            get_logger(name.strip()).setLevel(module_level.strip().upper())
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Get a logger in the qoffea hierarchy
+
+    Args:
+        name: Short module name, e.g. 'analyzer'
+
+    Returns:
+        Logger named qoffea.<name>
+    """
+    return logging.getLogger(f'{ROOT_LOGGER_NAME}.{name}')
+
+
+class SampledLogger:
+    """
+    Sampled and rate-limited logging for per-item loops
+
+    Call `enabled(level)` once before a loop; when it is False the loop
+    should skip logging entirely so the hot path pays a single check.
+    """
+
+    def __init__(self, logger: logging.Logger, sample_rate: float = None, max_per_second: float = None):
+        """
+        Args:
+            logger: Underlying logger
+            sample_rate: Fraction of calls that are considered for output
+                (default: value given to configure_logging)
+            max_per_second: Hard cap on emitted records per second
+                (default: value given to configure_logging)
+        """
+        self.logger = logger
+        self._sample_rate = sample_rate
+        self._max_per_second = max_per_second
+        self._lock = threading.Lock()
+        self._window_start = 0.0
+        self._window_count = 0
+        self.suppressed = 0
+
+    @property
+    def sample_rate(self) -> float:
+        return self._sample_rate if self._sample_rate is not None else _sampling['sample_rate']
+
+    @property
+    def max_per_second(self) -> float:
+        return self._max_per_second if self._max_per_second is not None else _sampling['max_per_second']
+
+    def enabled(self, level: int = logging.DEBUG) -> bool:
+        """Check whether anything would be emitted at this level"""
+        return self.logger.isEnabledFor(level)
+
+    def _allow(self) -> bool:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.suppressed += 1
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_start >= 1.0:
+                self._window_start = now
+                self._window_count = 0
+            if self._window_count >= self.max_per_second:
+                self.suppressed += 1
+                return False
+            self._window_count += 1
+        return True
+
+    def log(self, level: int, msg: str, *args, **kwargs):
+        """Log at level if the record survives sampling and rate limiting"""
+        if self.logger.isEnabledFor(level) and self._allow():
+            kwargs.setdefault('stacklevel', 2)
+            self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg: str, *args, **kwargs):
+        """Sampled debug log"""
+        kwargs.setdefault('stacklevel', 3)
+        self.log(logging.DEBUG, msg, *args, **kwargs)
@@ -0,0 +1,308 @@
+"""
+Metrics Utility
+Lightweight counters, gauges and histograms exposed in Prometheus text format
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# Default latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Stage durations of the current request, used for the Server-Timing header
+_request_timings = ContextVar('request_timings', default=None)
+
+
+def _format_labels(labelnames: tuple, key: tuple, extra: str = '') -> str:
+    """Format a label set as {a="x",b="y"}"""
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, key)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value the way Prometheus expects"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value)
+                    for key, value in self._values.items()]
+
+    def render(self) -> list:
+        """Render metric as Prometheus text lines"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, labels, value in self._samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+
+    metric_type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase counter by amount"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        """Get current counter value"""
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+
+    metric_type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), callback=None):
+        """
+        Args:
+            callback: Optional function returning the value at scrape time
+        """
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        """Set gauge to value"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        """Increase gauge by amount"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        """Decrease gauge by amount"""
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        """Get current gauge value"""
+        if self.callback is not None:
+            return self.callback()
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        if self.callback is not None:
+            return [(self.name, '', self.callback())]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        """Record one observation"""
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts + overflow, sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def mean(self, **labels) -> float:
+        """Get the mean of all observations (0 when there are none)"""
+        state = self._values.get(self._key(labels))
+        return state[1] / state[2] if state and state[2] else 0.0
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            snapshot = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(float(bound))}"'
+                samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, le), cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        """Initialize empty registry"""
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        """Get or create a counter"""
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = (), callback=None) -> Gauge:
+        """Get or create a gauge"""
+        return self._register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """Get or create a histogram"""
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """
+        Render all metrics in Prometheus text exposition format
+
+        Returns:
+            Text body for the /metrics endpoint
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def get_rss_bytes() -> int:
+    """
+    Get resident set size of the current process
+
+    Returns:
+        RSS in bytes (peak RSS where /proc is unavailable)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is bytes on macOS, kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Process-wide registry and the pipeline metrics shared across modules
+metrics = MetricsRegistry()
+
+STAGE_DURATION = metrics.histogram(
+    'qoffea_stage_duration_seconds',
+    'Duration of pipeline stages (receive, validate, decode, predict, analyze, draw, encode, serialize, pdf)',
+    ('stage',)
+)
+MODEL_SPEED = metrics.histogram(
+    'qoffea_model_phase_duration_seconds',
+    'Ultralytics preprocess/inference/postprocess time reported in Results.speed',
+    ('phase',)
+)
+REQUEST_DURATION = metrics.histogram(
+    'qoffea_http_request_duration_seconds',
+    'HTTP request latency',
+    ('method', 'endpoint')
+)
+REQUESTS_TOTAL = metrics.counter(
+    'qoffea_http_requests_total',
+    'HTTP requests served',
+    ('method', 'endpoint', 'status')
+)
+IN_FLIGHT = metrics.gauge(
+    'qoffea_http_requests_in_flight',
+    'HTTP requests currently being handled'
+)
+QUEUE_DEPTH = metrics.gauge(
+    'qoffea_inference_queue_depth',
+    'Requests waiting for the model'
+)
+MODEL_REPLICAS = metrics.gauge(
+    'qoffea_model_replicas',
+    'Model instances loaded in this process'
+)
+RSS_BYTES = metrics.gauge(
+    'qoffea_process_resident_memory_bytes',
+    'Resident set size of this worker process',
+    callback=get_rss_bytes
+)
+
+
+def start_request_timings():
+    """Start collecting stage durations for the current request"""
+    _request_timings.set([])
+
+
+def get_request_timings() -> list:
+    """
+    Get stage durations recorded during the current request
+
+    Returns:
+        List of (stage, seconds) tuples
+    """
+    return _request_timings.get() or []
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """
+    Time a pipeline stage into the stage histogram
+
+    Args:
+        stage: Stage name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def record_model_speed(results):
+    """
+    Record the per-phase speeds ultralytics reports for a prediction
+
+    Args:
+        results: YOLO prediction results
+    """
+    for result in results:
+        speed = getattr(result, 'speed', None) or {}
+        for phase, milliseconds in speed.items():
+            if milliseconds is not None:
+                MODEL_SPEED.observe(milliseconds / 1000.0, phase=phase)
@@ -0,0 +1,152 @@
+"""
+PDF Concatenation Utility
+Joins ReportLab-generated PDF parts into one file without holding them all in memory
+"""
+
+import re
+from datetime import datetime
+
+# Object 1 is the joined page tree, 2 the catalog, 3 the document info
+PAGES_OBJECT = 1
+CATALOG_OBJECT = 2
+INFO_OBJECT = 3
+
+REFERENCE_PATTERN = re.compile(rb'(\d+) 0 R')
+OBJECT_HEADER_PATTERN = re.compile(rb'\s*(\d+) 0 obj\s*')
+STREAM_PATTERN = re.compile(rb'>>\s*stream\r?\n')
+TYPE_PATTERN = re.compile(rb'/Type\s*/(\w+)')
+KIDS_PATTERN = re.compile(rb'/Kids\s*\[([^\]]*)\]')
+TRAILER_REF_PATTERN = rb'/%s\s+(\d+) 0 R'
+
+
+def _pdf_text(value: str) -> bytes:
+    """Encode a string as a UTF-16 PDF text string"""
+    return b'<FEFF' + value.encode('utf-16-be').hex().upper().encode('ascii') + b'>'
+
+
+def _read_part(path: str):
+    """
+    Split a ReportLab PDF into its objects
+
+    ReportLab writes a classic xref table and one level of pages, which
+    is all this reader understands; it is not a general PDF parser.
+
+    Returns:
+        Tuple of ({number: (head, stream)}, root number, info number), where
+        head is the object's dictionary (or value) and stream the raw bytes
+        from 'stream' to the end of the object, or b'' for plain objects
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    xref_offset = int(data[data.rindex(b'startxref') + len(b'startxref'):].split()[0])
+    trailer = data[data.index(b'trailer', xref_offset):]
+    root = int(re.search(TRAILER_REF_PATTERN % b'Root', trailer).group(1))
+    info_match = re.search(TRAILER_REF_PATTERN % b'Info', trailer)
+
+    lines = data[xref_offset:data.index(b'trailer', xref_offset)].split(b'\n')
+    first, count = (int(value) for value in lines[1].split())
+    offsets = {}
+    for number, line in enumerate(lines[2:2 + count], start=first):
+        fields = line.split()
+        if len(fields) == 3 and fields[2] == b'n':
+            offsets[number] = int(fields[0])
+
+    # Each object runs up to the next one, which avoids scanning binary streams
+    ordered = sorted(offsets.items(), key=lambda item: item[1])
+    objects = {}
+    for position, (number, start) in enumerate(ordered):
+        end = ordered[position + 1][1] if position + 1 < len(ordered) else xref_offset
+        body = data[start:end]
+        header = OBJECT_HEADER_PATTERN.match(body)
+        if header is None or int(header.group(1)) != number:
+            raise ValueError(f"Unexpected PDF object layout in {path}")
+        body = body[header.end():body.rindex(b'endobj')].rstrip()
+        stream = STREAM_PATTERN.search(body)
+        if stream:
+            objects[number] = (body[:stream.start() + 2], body[stream.start() + 2:])
+        else:
+            objects[number] = (body, b'')
+    return objects, root, int(info_match.group(1)) if info_match else None
+
+
+def concatenate_pdfs(part_paths: list, output_path: str, title: str = None) -> int:
+    """
+    Write the pages of several PDFs, in order, into one PDF
+
+    Parts are read one at a time and their objects written straight to
+    the output, so memory depends on the largest part rather than the
+    whole document. Meant for parts produced by ReportLab's canvas.
+
+    Args:
+        part_paths: PDF files to join
+        output_path: Path of the joined PDF
+        title: Document title
+
+    Returns:
+        Number of pages written
+    """
+    offsets = {}
+    pages = []
+    next_number = INFO_OBJECT + 1
+
+    with open(output_path, 'wb') as out:
+        out.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+        def write_object(number: int, head: bytes, stream: bytes = b''):
+            offsets[number] = out.tell()
+            out.write(b'%d 0 obj\n' % number)
+            out.write(head)
+            out.write(stream)
+            out.write(b'\nendobj\n')
+
+        for path in part_paths:
+            objects, root, info = _read_part(path)
+            catalog = objects[root][0]
+            part_pages = int(re.search(rb'/Pages\s+(\d+) 0 R', catalog).group(1))
+
+            # Renumber everything but the part's catalog, info and page tree,
+            # and point its pages at the joined tree
+            numbers = {part_pages: PAGES_OBJECT}
+            for number in sorted(objects):
+                if number not in (root, info, part_pages):
+                    numbers[number] = next_number
+                    next_number += 1
+
+            def renumber(match):
+                number = int(match.group(1))
+                if number not in numbers:
+                    raise ValueError(f"PDF part {path} refers to an object that is not copied: {number}")
+                return b'%d 0 R' % numbers[number]
+
+            kids = KIDS_PATTERN.search(objects[part_pages][0]).group(1)
+            for number in (int(kid) for kid in REFERENCE_PATTERN.findall(kids)):
+                if TYPE_PATTERN.search(objects[number][0]).group(1) != b'Page':
+                    raise ValueError(f"Nested page trees are not supported: {path}")
+                pages.append(numbers[number])
+
+            for number, new_number in numbers.items():
+                if new_number == PAGES_OBJECT:
+                    continue
+                head, stream = objects[number]
+                write_object(new_number, REFERENCE_PATTERN.sub(renumber, head), stream)
+            del objects
+
+        kids = b' '.join(b'%d 0 R' % number for number in pages)
+        write_object(PAGES_OBJECT, b'<< /Type /Pages /Count %d /Kids [ %s ] >>' % (len(pages), kids))
+        write_object(CATALOG_OBJECT, b'<< /Type /Catalog /Pages %d 0 R /PageMode /UseNone >>' % PAGES_OBJECT)
+        info = b'/Producer %s /CreationDate (D:%s)' % (
+            _pdf_text('QOFFEA'), datetime.now().strftime('%Y%m%d%H%M%S').encode('ascii'))
+        if title:
+            info += b' /Title ' + _pdf_text(title)
+        write_object(INFO_OBJECT, b'<< ' + info + b' >>')
+
+        xref_offset = out.tell()
+        out.write(b'xref\n0 %d\n' % next_number)
+        out.write(b'0000000000 65535 f \n')
+        for number in range(1, next_number):
+            out.write(b'%010d 00000 n \n' % offsets[number])
+        out.write(b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\n' % (next_number, CATALOG_OBJECT, INFO_OBJECT))
+        out.write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+
+    return len(pages)
@@ -0,0 +1,281 @@
+"""
+Profiler Utility
+On-demand cProfile / statistical sampling and slow-request profile capture
+"""
+
+import cProfile
+import hmac
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from utils.logger import get_logger
+
+logger = get_logger('profiler')
+
+# Deepest stack recorded by the sampler
+MAX_STACK_DEPTH = 64
+
+
+def _fold_stack(frame) -> str:
+    """
+    Fold a frame chain into one 'outer;...;inner' line (flamegraph format)
+
+    Args:
+        frame: Innermost frame
+
+    Returns:
+        Folded stack string
+    """
+    parts = []
+    while frame is not None and len(parts) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    parts.reverse()
+    return ';'.join(parts)
+
+
+def _render_folded(stacks: Counter) -> bytes:
+    """Render folded stacks as text, one 'stack count' per line"""
+    return '\n'.join(f"{stack} {count}" for stack, count in stacks.most_common()).encode('utf-8')
+
+
+class ProfileStore:
+    """Bounded ring of captured profiles; the oldest is dropped first"""
+
+    def __init__(self, max_profiles: int = 20):
+        self._profiles = deque(maxlen=max_profiles)
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, fmt: str, data: bytes, profile_id: str = None, **info) -> str:
+        """
+        Store a profile
+
+        Args:
+            kind: 'request', 'slow' or 'window'
+            fmt: 'pstats' (marshalled cProfile stats) or 'folded' (sampled stacks)
+            data: Profile payload
+            profile_id: ID to store under (generated if omitted)
+            **info: Extra metadata (path, duration_ms, ...)
+
+        Returns:
+            Profile ID
+        """
+        profile_id = profile_id or uuid.uuid4().hex[:12]
+        entry = {
+            'id': profile_id,
+            'kind': kind,
+            'format': fmt,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'size_bytes': len(data),
+            **info
+        }
+        with self._lock:
+            self._profiles.append((entry, data))
+        logger.info("Profile captured", extra={'profile_id': profile_id, 'kind': kind, 'format': fmt})
+        return profile_id
+
+    def list(self) -> list:
+        """List metadata of stored profiles, newest first"""
+        with self._lock:
+            return [entry for entry, _ in reversed(self._profiles)]
+
+    def get(self, profile_id: str):
+        """
+        Get a stored profile
+
+        Returns:
+            Tuple of (metadata, data) or None
+        """
+        with self._lock:
+            for entry, data in self._profiles:
+                if entry['id'] == profile_id:
+                    return entry, data
+        return None
+
+
+class StackSampler:
+    """
+    Statistical profiler sampling the Python stacks of watched threads
+
+    Only threads registered with watch() are sampled, so idle workers and
+    requests that are not being profiled cost nothing but the sampler tick.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """
+        Args:
+            interval: Seconds between samples
+        """
+        self.interval = interval
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._thread = None
+
+    def _ensure_running(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+
+    def watch(self, ident: int):
+        """Start sampling a thread"""
+        with self._lock:
+            self._targets[ident] = Counter()
+            self._active.set()
+            self._ensure_running()
+
+    def unwatch(self, ident: int) -> Counter:
+        """
+        Stop sampling a thread
+
+        Returns:
+            Folded stack counts collected for the thread
+        """
+        with self._lock:
+            stacks = self._targets.pop(ident, Counter())
+            if not self._targets:
+                self._active.clear()
+            return stacks
+
+    def _run(self):
+        while True:
+            # Park while nothing is watched instead of ticking
+            self._active.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                frames = sys._current_frames()
+                for ident, stacks in self._targets.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[_fold_stack(frame)] += 1
+
+
+class Profiler:
+
+    def __init__(self, token: str, slow_threshold_ms: float = 0, sample_interval_ms: float = 5,
+                 max_profiles: int = 20, max_window_seconds: float = 60):
+        """
+        Initialize profiler
+
+        Args:
+            token: Shared secret required to trigger or download profiles
+            slow_threshold_ms: Capture a sampled profile for requests slower than this (0 = off)
+            sample_interval_ms: Stack sampling interval
+            max_profiles: Number of profiles kept in the ring
+            max_window_seconds: Longest allowed time-window capture
+        """
+        self.token = token
+        self.slow_threshold = slow_threshold_ms / 1000.0
+        self.max_window_seconds = max_window_seconds
+        self.store = ProfileStore(max_profiles)
+        self.sampler = StackSampler(sample_interval_ms / 1000.0)
+
+    def check_token(self, supplied: str) -> bool:
+        """Constant-time token comparison"""
+        return bool(self.token) and bool(supplied) and hmac.compare_digest(self.token, supplied)
+
+    def start_request(self, mode: str = None):
+        """
+        Begin profiling the current request
+
+        Args:
+            mode: 'cprofile' or 'sample' when explicitly requested, None for slow-request capture
+
+        Returns:
+            Opaque state to pass to finish_request, or None if nothing is recorded
+        """
+        if mode == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            return ('cprofile', profile, time.perf_counter())
+        if mode == 'sample' or self.slow_threshold > 0:
+            self.sampler.watch(threading.get_ident())
+            return ('sample' if mode == 'sample' else 'slow', None, time.perf_counter())
+        return None
+
+    def finish_request(self, state, path: str) -> str:
+        """
+        Finish profiling the current request and store the result if wanted
+
+        Returns:
+            Profile ID, or None if the profile was discarded
+        """
+        kind, profile, start = state
+        duration = time.perf_counter() - start
+        info = {'path': path, 'duration_ms': round(duration * 1000, 1)}
+
+        if kind == 'cprofile':
+            profile.disable()
+            profile.create_stats()
+            return self.store.add('request', 'pstats', marshal.dumps(profile.stats), **info)
+
+        stacks = self.sampler.unwatch(threading.get_ident())
+        if kind == 'slow' and duration < self.slow_threshold:
+            return None
+        return self.store.add('request' if kind == 'sample' else 'slow', 'folded',
+                              _render_folded(stacks), samples=sum(stacks.values()), **info)
+
+    def capture_window(self, seconds: float) -> str:
+        """
+        Sample every thread in the process for a time window, in the background
+
+        cProfile only sees the thread that enables it, so windows always use
+        the stack sampler.
+
+        Args:
+            seconds: Window length (capped at max_window_seconds)
+
+        Returns:
+            ID the profile will be stored under once the window closes
+        """
+        seconds = max(0.1, min(float(seconds), self.max_window_seconds))
+        profile_id = uuid.uuid4().hex[:12]
+
+        def run():
+            stacks = Counter()
+            own_ident = threading.get_ident()
+            names = {}
+            start = time.perf_counter()
+            deadline = start + seconds
+            while time.perf_counter() < deadline:
+                time.sleep(self.sampler.interval)
+                if len(names) != threading.active_count():
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != own_ident:
+                        stacks[f"{names.get(ident, ident)};{_fold_stack(frame)}"] += 1
+            self.store.add('window', 'folded', _render_folded(stacks), profile_id=profile_id,
+                           samples=sum(stacks.values()),
+                           duration_ms=round((time.perf_counter() - start) * 1000, 1))
+
+        threading.Thread(target=run, name='profile-window', daemon=True).start()
+        return profile_id
+
+    @staticmethod
+    def render_text(data: bytes, limit: int = 50) -> str:
+        """
+        Render marshalled cProfile stats as a pstats table
+
+        Args:
+            data: Marshalled stats from a 'pstats' profile
+            limit: Number of functions to show
+
+        Returns:
+            Text sorted by cumulative time
+        """
+        class _Loaded:
+            stats = marshal.loads(data)
+
+            def create_stats(self):
+                pass
+
+        output = io.StringIO()
+        pstats.Stats(_Loaded(), stream=output).sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
@@ -0,0 +1,168 @@
+"""
+QoS Utility
+Picks a cheaper prediction tier when the inference queue backs up
+"""
+
+import threading
+import time
+from utils.metrics import metrics
+from utils.admission import admission, BATCH
+from utils.logger import get_logger
+
+logger = get_logger('qos')
+
+QOS_TIER = metrics.gauge(
+    'qoffea_qos_tier',
+    'Index of the QoS tier currently selected (0 = full quality)'
+)
+QOS_SELECTED = metrics.counter(
+    'qoffea_qos_selected_total',
+    'Predictions per QoS tier selected',
+    ('tier',)
+)
+QOS_SERVED = metrics.counter(
+    'qoffea_qos_served_total',
+    'Predictions per QoS tier that actually ran, by selected tier',
+    ('tier', 'selected')
+)
+
+
+class QosPolicy:
+    """
+    Select a QoS tier from live load
+
+    Tiers are ordered from full quality to cheapest. A tier applies when the
+    number of queued requests reaches its `min_queue_depth` or the recent
+    queue wait reaches its `min_queue_wait_ms`; the cheapest applicable tier
+    wins. Stepping down is immediate, stepping back up waits
+    `recovery_seconds` so the tier does not flap on every request.
+    """
+
+    def __init__(self, tiers: list, recovery_seconds: float = 10.0, enabled: bool = True):
+        self._current = 0
+        self._degraded_at = 0.0
+        self._lock = threading.Lock()
+        self.configure(tiers, recovery_seconds, enabled)
+
+    def configure(self, tiers: list, recovery_seconds: float = 10.0, enabled: bool = True):
+        """
+        Apply tier settings
+
+        Args:
+            tiers: List of tier dicts ('name', thresholds and prediction overrides)
+            recovery_seconds: Time load must stay low before a better tier is used again
+            enabled: Always return the first tier when False
+        """
+        self.tiers = tiers
+        self.recovery_seconds = recovery_seconds
+        self.enabled = enabled
+        self._current = 0
+        # Tiers already warned about by served()
+        self._unapplied = set()
+
+    def _target(self, queue_depth: int, queue_wait: float) -> int:
+        target = 0
+        for index, tier in enumerate(self.tiers[1:], start=1):
+            depth = tier.get('min_queue_depth')
+            wait_ms = tier.get('min_queue_wait_ms')
+            if (depth is not None and queue_depth >= depth) or \
+                    (wait_ms is not None and queue_wait * 1000 >= wait_ms):
+                target = index
+        return target
+
+    def select(self, queue_depth: int, queue_wait: float) -> dict:
+        """
+        Pick the tier for a new prediction
+
+        Args:
+            queue_depth: Requests currently waiting for the model
+            queue_wait: Recent average queue wait in seconds
+
+        Returns:
+            Tier dict
+        """
+        if not self.enabled or len(self.tiers) < 2:
+            tier = self.tiers[0]
+            QOS_SELECTED.inc(tier=tier['name'])
+            return tier
+
+        now = time.monotonic()
+        target = self._target(queue_depth, queue_wait)
+        with self._lock:
+            previous = self._current
+            if target > self._current:
+                self._current = target
+                self._degraded_at = now
+            elif target < self._current and now - self._degraded_at >= self.recovery_seconds:
+                # Recover one step at a time
+                self._current -= 1
+                self._degraded_at = now
+            current = self._current
+
+        if current != previous:
+            logger.warning("QoS tier changed", extra={
+                'tier': self.tiers[current]['name'],
+                'previous': self.tiers[previous]['name'],
+                'queue_depth': queue_depth,
+                'queue_wait_ms': round(queue_wait * 1000, 1)
+            })
+        QOS_TIER.set(current)
+        tier = self.tiers[current]
+        QOS_SELECTED.inc(tier=tier['name'])
+        return tier
+
+    def served(self, tier: dict, inference: dict = None) -> dict:
+        """
+        Find the tier a finished prediction actually ran at
+
+        A tier's overrides can fail to apply: its model variant may not be
+        loaded, or a prepared model may only take one input size. The
+        result is the cheapest tier, no cheaper than the selected one,
+        whose model and input size match what ran.
+
+        Args:
+            tier: Tier returned by select()
+            inference: 'variant' and 'imgsz' recorded by ModelLoader.predict
+
+        Returns:
+            Tier dict
+        """
+        if inference is None or tier not in self.tiers:
+            return tier
+        served = self.tiers[0]
+        for candidate in self.tiers[:self.tiers.index(tier) + 1]:
+            size = candidate.get('imgsz')
+            if candidate.get('model_path') == inference.get('variant') or not candidate.get('model_path'):
+                if not size or (inference.get('imgsz') and inference['imgsz'] <= size):
+                    served = candidate
+        QOS_SERVED.inc(tier=served['name'], selected=tier['name'])
+        if served is not tier:
+            with self._lock:
+                warn = tier['name'] not in self._unapplied
+                self._unapplied.add(tier['name'])
+            if warn:
+                logger.warning("QoS tier did not apply; prediction ran with other settings", extra={
+                    'tier': tier['name'], 'served': served['name'], 'inference': inference
+                })
+        return served
+
+# Process-wide policy; create_app applies Config.QOS_TIERS
+qos = QosPolicy([{'name': 'full'}])
+
+
+def select_tier(priority: str) -> dict:
+    """
+    Pick the QoS tier for a prediction
+
+    Batch work always runs at full quality; it already yields to
+    interactive requests through the scheduler.
+
+    Args:
+        priority: Scheduling class of the prediction
+
+    Returns:
+        Tier dict
+    """
+    if priority == BATCH:
+        return qos.tiers[0]
+    return qos.select(*admission.load_signal())
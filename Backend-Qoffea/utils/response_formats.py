@@ -0,0 +1,210 @@
+"""
+Response Formats Utility
+Content negotiation for analysis results: JSON, columnar MessagePack or raw float32, optionally compressed
+"""
+
+import gzip
+import json
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+from utils.metrics import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RESPONSE_BYTES = metrics.histogram(
+    'qoffea_analysis_response_bytes',
+    'Size of analysis responses as sent, by format and content encoding',
+    ('format', 'encoding'),
+    buckets=(1024, 4096, 16384, 65536, 262144, 1048576)
+)
+
+JSON_TYPE = 'application/json'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+FLOAT32_TYPE = 'application/vnd.qoffea.detections+float32'
+# Columns of each row in the float32 format
+FLOAT32_LAYOUT = 'x1,y1,x2,y2,confidence,class_id'
+# Smaller bodies are not worth a compressor call
+MIN_COMPRESS_BYTES = 1024
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+
+def dumps_json(obj, default=None) -> bytes:
+    """
+    Serialize to compact JSON, with orjson when it is installed
+
+    Args:
+        obj: Object to serialize
+        default: Called for objects neither serializer handles
+    """
+    if orjson is not None:
+        # class_names is keyed by class index
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=default, separators=(',', ':')).encode()
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (installed by create_app when available)"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps_json(obj, self.default).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_json(obj, self.default), mimetype=self.mimetype)
+
+
+def _plain(value):
+    """Python value of a numpy scalar or array, for the standard json encoder"""
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _accepted(header: str) -> dict:
+    """Parse an Accept or Accept-Encoding header into {token: q}"""
+    accepted = {}
+    for item in (header or '').split(','):
+        token, *params = [part.strip() for part in item.split(';')]
+        if not token:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[token.lower()] = q
+    return accepted
+
+
+def choose_format(accept: str) -> str:
+    """
+    Pick the analysis representation for an Accept header
+
+    Args:
+        accept: Accept request header
+
+    Returns:
+        'msgpack', 'float32' or 'json' (the default, and the fallback when
+        msgpack is asked for but not installed)
+    """
+    accepted = _accepted(accept)
+    candidates = [(accepted.get(FLOAT32_TYPE, 0), 'float32')]
+    if msgpack is not None:
+        candidates.append((max(accepted.get(media_type, 0) for media_type in MSGPACK_TYPES), 'msgpack'))
+    q, fmt = max(candidates)
+    # JSON wins ties, so plain browsers and */* clients keep getting JSON
+    json_q = max(accepted.get(JSON_TYPE, 0), accepted.get('*/*', 0), accepted.get('application/*', 0))
+    return fmt if q > 0 and q > json_q else 'json'
+
+
+def choose_encoding(accept_encoding: str) -> str:
+    """
+    Pick the content encoding for an Accept-Encoding header
+
+    Returns:
+        'zstd' (when zstandard is installed), 'gzip' or 'identity'
+    """
+    accepted = _accepted(accept_encoding)
+    if zstandard is not None and accepted.get('zstd', 0) > 0:
+        return 'zstd'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return 'identity'
+
+
+def variant_etag(etag: str, fmt: str, encoding: str) -> str:
+    """ETag of one representation of a result (JSON without encoding keeps the plain ETag)"""
+    suffix = '-'.join(part for part in (fmt if fmt != 'json' else '', encoding if encoding != 'identity' else '')
+                      if part)
+    return f"{etag}-{suffix}" if suffix else etag
+
+
+def detection_columns(detections: list) -> tuple:
+    """
+    Convert detection dicts to arrays
+
+    Returns:
+        Tuple of (bbox float32 (N, 4), confidence float32 (N,), class_id uint16 (N,))
+    """
+    count = len(detections)
+    bbox = np.array([d['bbox'] for d in detections], dtype='<f4').reshape(count, 4)
+    confidence = np.fromiter((d['confidence'] for d in detections), dtype='<f4', count=count)
+    class_id = np.fromiter((d['class_id'] for d in detections), dtype='<u2', count=count)
+    return bbox, confidence, class_id
+
+
+def render_analysis(analysis_result: dict, fmt: str) -> tuple:
+    """
+    Serialize an analysis result
+
+    json: the result as it is. msgpack: detections become columns of
+    little-endian binary arrays ('bbox' float32 N*4, 'confidence' float32,
+    'class_id' uint16) instead of one map per detection. float32: the body is
+    an N x 6 little-endian float32 matrix (FLOAT32_LAYOUT) and the rest of
+    the result travels as ASCII-only JSON in the X-Analysis-Summary header.
+
+    Args:
+        analysis_result: Result of CoffeeAnalyzer.analyze_image
+        fmt: Format from choose_format
+
+    Returns:
+        Tuple of (body bytes, content type, extra headers dict)
+    """
+    if fmt == 'json':
+        return dumps_json(analysis_result), JSON_TYPE, {}
+
+    detections = analysis_result.get('detections') or []
+    summary = {key: value for key, value in analysis_result.items() if key != 'detections'}
+    bbox, confidence, class_id = detection_columns(detections)
+
+    if fmt == 'msgpack':
+        summary['detections'] = {
+            'count': len(detections),
+            'bbox': bbox.tobytes(),
+            'confidence': confidence.tobytes(),
+            'class_id': class_id.tobytes()
+        }
+        return msgpack.packb(summary, use_bin_type=True), MSGPACK_TYPES[0], {}
+
+    matrix = np.empty((len(detections), 6), dtype='<f4')
+    matrix[:, :4] = bbox
+    matrix[:, 4] = confidence
+    matrix[:, 5] = class_id
+    headers = {
+        'X-Detection-Layout': FLOAT32_LAYOUT,
+        'X-Detection-Count': str(len(detections)),
+        # Header values must stay ASCII; labels and file names may not be
+        'X-Analysis-Summary': json.dumps(summary, ensure_ascii=True, separators=(',', ':'), default=_plain)
+    }
+    return matrix.tobytes(), FLOAT32_TYPE, headers
+
+
+def compress(body: bytes, encoding: str) -> tuple:
+    """
+    Compress a response body
+
+    Returns:
+        Tuple of (body, encoding actually applied)
+    """
+    if encoding == 'identity' or len(body) < MIN_COMPRESS_BYTES:
+        return body, 'identity'
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body), 'zstd'
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), 'gzip'
@@ -0,0 +1,226 @@
+"""
+Static Assets Utility
+Serves the frontend from memory: fingerprinted, precompressed and validated with strong ETags
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from utils.metrics import metrics
+from utils.logger import get_logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = get_logger('static_assets')
+
+STATIC_RESPONSES = metrics.counter(
+    'qoffea_static_responses_total',
+    'Frontend files served from memory, by status and content encoding',
+    ('status', 'encoding')
+)
+STATIC_BYTES = metrics.gauge(
+    'qoffea_static_assets_bytes',
+    'Memory held by loaded frontend files, including compressed copies'
+)
+
+# Content types worth compressing; images are already compressed
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+# Fingerprinted URLs never change content
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Plain URLs (pages, links built in scripts) are revalidated with the ETag on every use
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+# Local src/href references in pages; absolute URLs, anchors and mailto: links are left alone
+REFERENCE_PATTERN = re.compile(r'\b(src|href)="([^":#?]+)(\?[^"]*)?"')
+
+
+class StaticAsset:
+    """One frontend file and its precompressed variants"""
+
+    def __init__(self, path: str, body: bytes, content_type: str):
+        self.path = path
+        self.content_type = content_type
+        self.etag = hashlib.sha256(body).hexdigest()[:20]
+        # encoding -> body; only variants smaller than the original are kept
+        self.variants = {'identity': body}
+        self.fingerprinted_path = None
+
+    def compress(self):
+        """Add gzip and (when available) brotli variants of compressible files"""
+        if not self.content_type.startswith(COMPRESSIBLE_TYPES):
+            return
+        body = self.variants['identity']
+        candidates = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            candidates['br'] = brotli.compress(body, quality=11)
+        for encoding, compressed in candidates.items():
+            if len(compressed) < len(body):
+                self.variants[encoding] = compressed
+
+    def size(self) -> int:
+        return sum(len(body) for body in self.variants.values())
+
+
+class StaticAssets:
+    """
+    In-memory frontend files
+
+    load() reads the frontend folder once at startup. Every non-HTML file
+    gets a fingerprinted alias (name.<hash>.ext) and gzip/brotli copies of
+    text files are made up front, so serving is a dictionary lookup and a
+    memory copy. Local src/href references in HTML pages are rewritten to
+    the fingerprinted names, which are served with an immutable one-year
+    Cache-Control; pages and plain names are revalidated with their strong
+    ETag and answered with 304 when unchanged. Changes to the frontend
+    folder are picked up on the next start.
+    """
+
+    def __init__(self):
+        self.root = None
+        self._assets = {}
+
+    def load(self, root: str):
+        """
+        Read, fingerprint and precompress all files under root
+
+        Args:
+            root: Frontend folder
+        """
+        self.root = os.path.abspath(root)
+        assets = {}
+        pages = []
+        for folder, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                full_path = os.path.join(folder, filename)
+                path = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                with open(full_path, 'rb') as f:
+                    body = f.read()
+                content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+                if content_type.startswith('text/') or content_type == 'application/javascript':
+                    content_type += '; charset=utf-8'
+                asset = StaticAsset(path, body, content_type)
+                assets[path] = asset
+                if filename.endswith('.html'):
+                    pages.append(asset)
+                else:
+                    stem, ext = os.path.splitext(path)
+                    asset.fingerprinted_path = f"{stem}.{asset.etag[:8]}{ext}"
+
+        for asset in list(assets.values()):
+            if asset.fingerprinted_path:
+                assets[asset.fingerprinted_path] = asset
+        # Pages are rewritten before hashing so their ETag covers the new references
+        for page in pages:
+            html = page.variants['identity'].decode('utf-8')
+            rewritten = StaticAsset(page.path, self._rewrite(html, page.path, assets).encode('utf-8'),
+                                    page.content_type)
+            assets[page.path] = rewritten
+
+        for asset in set(assets.values()):
+            asset.compress()
+        self._assets = assets
+        STATIC_BYTES.set(sum(asset.size() for asset in set(assets.values())))
+        logger.info("Static assets loaded", extra={
+            'root': self.root, 'files': len(set(assets.values())), 'brotli': brotli is not None
+        })
+
+    @staticmethod
+    def _rewrite(html: str, page_path: str, assets: dict) -> str:
+        """Point local references of a page at fingerprinted names"""
+        base = os.path.dirname(page_path)
+
+        def replace(match):
+            target = os.path.normpath(os.path.join(base, match.group(2))).replace(os.sep, '/')
+            asset = assets.get(target)
+            if asset is None or not asset.fingerprinted_path:
+                return match.group(0)
+            reference = os.path.relpath(asset.fingerprinted_path, base or '.').replace(os.sep, '/')
+            return f'{match.group(1)}="{reference}"'
+
+        return REFERENCE_PATTERN.sub(replace, html)
+
+    def lookup(self, url_path: str):
+        """
+        Find the file for a URL path
+
+        Args:
+            url_path: Request path, e.g. '/aksi', '/css/app.css' or '/assets/logo.png'
+
+        Returns:
+            Tuple of (StaticAsset, whether the path is fingerprinted), or None
+        """
+        path = url_path.lstrip('/')
+        # Assets are reachable under either case, as before
+        if path.startswith('assets/'):
+            path = 'Assets/' + path[len('assets/'):]
+        asset = self._assets.get(path)
+        if asset is None and path and '.' not in path.rsplit('/', 1)[-1]:
+            # Pages are also served without their extension
+            path += '.html'
+            asset = self._assets.get(path)
+        if asset is None:
+            return None
+        return asset, path == asset.fingerprinted_path
+
+    def respond(self, asset: StaticAsset, fingerprinted: bool, if_none_match: str = None,
+                accept_encoding: str = None) -> tuple:
+        """
+        Build the response for a file
+
+        Args:
+            asset: File from lookup()
+            fingerprinted: Whether it was requested by its fingerprinted name
+            if_none_match: If-None-Match request header
+            accept_encoding: Accept-Encoding request header
+
+        Returns:
+            Tuple of (status code, headers list, body bytes)
+        """
+        encoding = self._choose_encoding(asset, accept_encoding)
+        etag = f'"{asset.etag}"' if encoding == 'identity' else f'"{asset.etag}-{encoding}"'
+        headers = [
+            ('ETag', etag),
+            ('Cache-Control', IMMUTABLE_CACHE_CONTROL if fingerprinted else REVALIDATE_CACHE_CONTROL),
+        ]
+        if len(asset.variants) > 1:
+            headers.append(('Vary', 'Accept-Encoding'))
+
+        if if_none_match and (if_none_match.strip() == '*' or etag in
+                              [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]):
+            STATIC_RESPONSES.inc(status=304, encoding=encoding)
+            return 304, headers, b''
+
+        body = asset.variants[encoding]
+        headers.append(('Content-Type', asset.content_type))
+        headers.append(('Content-Length', str(len(body))))
+        if encoding != 'identity':
+            headers.append(('Content-Encoding', encoding))
+        STATIC_RESPONSES.inc(status=200, encoding=encoding)
+        return 200, headers, body
+
+    @staticmethod
+    def _choose_encoding(asset: StaticAsset, accept_encoding: str) -> str:
+        """Best variant the client accepts (brotli, then gzip, then identity)"""
+        if not accept_encoding or len(asset.variants) == 1:
+            return 'identity'
+        accepted = set()
+        for item in accept_encoding.split(','):
+            name, _, params = item.strip().partition(';')
+            if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            accepted.add(name.strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in asset.variants and (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
+
+
+# Loaded by create_app
+static_assets = StaticAssets()
@@ -0,0 +1,376 @@
+"""
+Upload Sessions Utility
+Resumable chunked uploads: chunks are appended to disk at the offset the client reports
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from utils.metrics import metrics
+from utils.logger import get_logger
+
+logger = get_logger('upload_sessions')
+
+UPLOAD_SESSIONS = metrics.counter(
+    'qoffea_upload_sessions_total',
+    'Resumable upload sessions, by event (created, completed, aborted, expired)',
+    ('event',)
+)
+UPLOAD_CHUNKS = metrics.counter(
+    'qoffea_upload_chunks_total',
+    'Resumable upload chunks, by result (accepted, offset_mismatch, checksum_mismatch, incomplete)',
+    ('result',)
+)
+
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# Bytes copied from the request to disk at a time
+COPY_BLOCK_SIZE = 64 * 1024
+# Expired sessions are looked for at most this often (seconds)
+SWEEP_INTERVAL = 300
+
+
+class UploadSessionError(Exception):
+    """Raised when a session operation cannot be carried out"""
+
+    def __init__(self, status: int, message: str, offset: int = None):
+        """
+        Args:
+            status: HTTP status to answer with
+            message: Human readable error
+            offset: Bytes the server holds, so the client can resume from there
+        """
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+    def to_response(self):
+        """Build the JSON error response (with Upload-Offset when known)"""
+        from flask import jsonify
+        body = {'success': False, 'error': str(self)}
+        if self.offset is not None:
+            body['offset'] = self.offset
+        response = jsonify(body)
+        response.status_code = self.status
+        if self.offset is not None:
+            response.headers['Upload-Offset'] = str(self.offset)
+        return response
+
+
+class UploadSessions:
+    """
+    Resumable uploads kept on disk
+
+    A session is a metadata file (<id>.json) and the bytes received so far
+    (<id>.part). Each chunk names the offset it starts at; it is accepted
+    only at the current end of the file, streamed to disk block by block
+    and checked against its SHA-256 when the client sends one. A chunk
+    that fails its checksum or is cut short is cut off again, so the
+    stored offset always covers verified bytes and a client that lost a
+    response can ask for the offset and continue. Finalizing moves the
+    file into the upload folder but keeps the session, so finalize can be
+    retried. Sessions idle for longer than ttl_seconds are deleted.
+
+    Sessions live in the filesystem so any worker can continue them; with
+    several instances session_dir must be shared (or requests pinned).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._busy = set()
+        self._last_sweep = 0.0
+        self.configure(os.path.join(tempfile.gettempdir(), 'qoffea-upload-sessions'))
+
+    def configure(self, session_dir: str, max_file_size: int = 10485760, chunk_size: int = 4194304,
+                  ttl_seconds: float = 21600, max_sessions: int = 100):
+        """
+        Apply session settings
+
+        Args:
+            session_dir: Folder for session files
+            max_file_size: Largest upload accepted
+            chunk_size: Largest chunk accepted (and suggested to clients)
+            ttl_seconds: Idle time after which a session is deleted
+            max_sessions: Sessions open at once before new ones are refused
+        """
+        self.session_dir = os.path.abspath(session_dir)
+        self.max_file_size = max_file_size
+        self.chunk_size = chunk_size
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+
+    def _path(self, upload_id: str, suffix: str) -> str:
+        return os.path.join(self.session_dir, f"{upload_id}{suffix}")
+
+    def _save(self, session: dict):
+        """Replace the metadata file, so a crash never leaves it half-written"""
+        path = self._path(session['upload_id'], '.json')
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.session_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(session, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def create(self, filename: str, size: int, sha256: str = None, params: dict = None) -> dict:
+        """
+        Open a session
+
+        Args:
+            filename: Original file name (its extension is kept)
+            size: Total upload size in bytes
+            sha256: Hex digest of the whole file, checked on completion
+            params: Values to keep until completion (e.g. detection parameters)
+
+        Returns:
+            Session dict
+        """
+        if size <= 0 or size > self.max_file_size:
+            raise UploadSessionError(
+                413 if size > 0 else 400,
+                f"File size must be between 1 byte and {self.max_file_size / (1024 * 1024)}MB"
+            )
+        os.makedirs(self.session_dir, exist_ok=True)
+        self.maybe_cleanup()
+        if len(self._session_ids()) >= self.max_sessions:
+            raise UploadSessionError(503, 'Too many uploads in progress, try again later')
+
+        now = time.time()
+        session = {
+            'upload_id': uuid.uuid4().hex,
+            'filename': filename,
+            'size': size,
+            'sha256': sha256.lower() if sha256 else None,
+            'offset': 0,
+            'params': params or {},
+            'created_at': now,
+            'updated_at': now
+        }
+        open(self._path(session['upload_id'], '.part'), 'wb').close()
+        self._save(session)
+        UPLOAD_SESSIONS.inc(event='created')
+        return session
+
+    def get(self, upload_id: str) -> dict:
+        """
+        Load a session
+
+        Raises:
+            UploadSessionError: 404 if the session does not exist or has expired
+        """
+        if not SESSION_ID_PATTERN.match(upload_id or ''):
+            raise UploadSessionError(404, 'Upload not found')
+        try:
+            with open(self._path(upload_id, '.json')) as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            raise UploadSessionError(404, 'Upload not found or expired')
+        if time.time() - session['updated_at'] > self.ttl_seconds:
+            self._delete(upload_id)
+            UPLOAD_SESSIONS.inc(event='expired')
+            raise UploadSessionError(404, 'Upload not found or expired')
+        return session
+
+    def _claim(self, upload_id: str):
+        """Allow one request at a time per session; a concurrent one is told to retry"""
+        with self._lock:
+            if upload_id in self._busy:
+                raise UploadSessionError(409, 'Another request is writing to this upload')
+            self._busy.add(upload_id)
+
+    def _release(self, upload_id: str):
+        with self._lock:
+            self._busy.discard(upload_id)
+
+    def write_chunk(self, upload_id: str, offset: int, stream, length: int, sha256: str = None) -> dict:
+        """
+        Append a chunk read from a stream
+
+        Args:
+            upload_id: Session ID
+            offset: Position of the chunk's first byte in the file
+            stream: Readable request body
+            length: Chunk size in bytes (Content-Length)
+            sha256: Hex digest of the chunk
+
+        Returns:
+            Updated session dict
+        """
+        self._claim(upload_id)
+        try:
+            session = self.get(upload_id)
+            if offset != session['offset']:
+                UPLOAD_CHUNKS.inc(result='offset_mismatch')
+                raise UploadSessionError(409, 'Offset does not match the bytes received', session['offset'])
+            if length is None:
+                raise UploadSessionError(411, 'Content-Length required', session['offset'])
+            if length <= 0 or length > self.chunk_size:
+                raise UploadSessionError(413, f"Chunks must be between 1 and {self.chunk_size} bytes",
+                                         session['offset'])
+            if offset + length > session['size']:
+                raise UploadSessionError(400, 'Chunk goes past the declared file size', session['offset'])
+
+            digest = hashlib.sha256()
+            with open(self._path(upload_id, '.part'), 'r+b') as f:
+                # Anything past the offset is left over from an interrupted chunk
+                f.truncate(offset)
+                f.seek(offset)
+                remaining = length
+                while remaining:
+                    block = stream.read(min(COPY_BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    f.write(block)
+                    digest.update(block)
+                    remaining -= len(block)
+
+                if remaining:
+                    f.truncate(offset)
+                    UPLOAD_CHUNKS.inc(result='incomplete')
+                    raise UploadSessionError(400, 'Chunk ended early', offset)
+                if sha256 and digest.hexdigest() != sha256.lower():
+                    f.truncate(offset)
+                    UPLOAD_CHUNKS.inc(result='checksum_mismatch')
+                    raise UploadSessionError(400, 'Chunk checksum mismatch', offset)
+
+            session['offset'] = offset + length
+            session['updated_at'] = time.time()
+            self._save(session)
+            UPLOAD_CHUNKS.inc(result='accepted')
+            return session
+        finally:
+            self._release(upload_id)
+
+    @contextmanager
+    def finalizing(self, upload_id: str, upload_folder: str):
+        """
+        Hold a fully received upload while it is analyzed
+
+        The first call checks the file digest and moves the file into the
+        upload folder; the session stays until it expires, so a finalize
+        that is shed, times out or loses its connection can be repeated.
+        Once record_result() has stored an outcome, repeats get that
+        outcome instead of a second analysis. Other requests for the
+        session get 409 while the block runs.
+
+        Args:
+            upload_id: Session ID
+            upload_folder: Folder to move the file to
+
+        Yields:
+            Session dict with 'stored_filename' and 'filepath', and
+            'result' once an outcome has been recorded
+        """
+        self._claim(upload_id)
+        try:
+            session = self.get(upload_id)
+            if session['offset'] != session['size']:
+                raise UploadSessionError(409, 'Upload is not complete', session['offset'])
+
+            if not session.get('stored_filename'):
+                part_path = self._path(upload_id, '.part')
+                if session['sha256']:
+                    digest = hashlib.sha256()
+                    with open(part_path, 'rb') as f:
+                        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+                            digest.update(block)
+                    if digest.hexdigest() != session['sha256']:
+                        # The chunks were fine individually, so the file has to be sent again
+                        self._delete(upload_id)
+                        UPLOAD_SESSIONS.inc(event='aborted')
+                        raise UploadSessionError(422, 'File checksum mismatch, upload it again')
+
+                ext = os.path.splitext(session['filename'])[1].lower()
+                session['stored_filename'] = f"{uuid.uuid4().hex}{ext}"
+                session['filepath'] = os.path.join(upload_folder, session['stored_filename'])
+                # A rename when both folders are on the same filesystem
+                shutil.move(part_path, session['filepath'])
+                session['updated_at'] = time.time()
+                self._save(session)
+
+            yield session
+        finally:
+            self._release(upload_id)
+
+    def record_result(self, session: dict, status: int, body: dict):
+        """
+        Keep the outcome of a finalize for repeated requests
+
+        Args:
+            session: Session dict from finalizing()
+            status: HTTP status of the outcome
+            body: JSON body of the outcome
+        """
+        session['result'] = {'status': status, 'body': body}
+        session['updated_at'] = time.time()
+        self._save(session)
+        UPLOAD_SESSIONS.inc(event='completed')
+
+    def abort(self, upload_id: str):
+        """Delete a session and its bytes"""
+        self._claim(upload_id)
+        try:
+            self.get(upload_id)
+            self._delete(upload_id)
+            UPLOAD_SESSIONS.inc(event='aborted')
+        finally:
+            self._release(upload_id)
+
+    def _delete(self, upload_id: str):
+        for suffix in ('.part', '.json'):
+            path = self._path(upload_id, suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _session_ids(self) -> set:
+        return {name[:-len('.json')] for name in os.listdir(self.session_dir) if name.endswith('.json')
+                and not name.startswith('.')}
+
+    def cleanup(self) -> int:
+        """
+        Delete sessions idle for longer than the TTL
+
+        Returns:
+            Number of sessions deleted
+        """
+        if not os.path.isdir(self.session_dir):
+            return 0
+        cutoff = time.time() - self.ttl_seconds
+        removed = 0
+        for entry in os.scandir(self.session_dir):
+            upload_id = entry.name.split('.', 1)[0]
+            if upload_id in self._busy:
+                continue
+            try:
+                # mtime is the last write, to the part file or the metadata
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += entry.name.endswith('.json')
+            except OSError:
+                continue
+        if removed:
+            UPLOAD_SESSIONS.inc(removed, event='expired')
+            logger.info("Expired upload sessions removed", extra={'sessions': removed})
+        return removed
+
+    def maybe_cleanup(self):
+        """Run cleanup() if it has not run for SWEEP_INTERVAL seconds"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+        self.cleanup()
+
+
+# Configured by create_app
+upload_sessions = UploadSessions()
@@ -0,0 +1,167 @@
+"""
+Memory Watchdog Utility
+Tracks worker RSS and recycles the worker gracefully when it grows too large
+"""
+
+import ctypes
+import gc
+import os
+import signal
+import sys
+import threading
+import time
+from utils.metrics import metrics, get_rss_bytes, IN_FLIGHT
+from utils.logger import get_logger
+
+logger = get_logger('watchdog')
+
+PEAK_RSS_BYTES = metrics.gauge(
+    'qoffea_process_peak_resident_memory_bytes',
+    'Highest RSS sampled by the memory watchdog'
+)
+WORKER_REQUESTS = metrics.gauge(
+    'qoffea_worker_requests_served',
+    'Requests served by this worker since it started'
+)
+WORKER_DRAINING = metrics.gauge(
+    'qoffea_worker_draining',
+    '1 while the worker is draining before a recycle'
+)
+
+
+def _trim_heap():
+    """Return freed memory to the OS (glibc only)"""
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class MemoryWatchdog:
+    """
+    Samples RSS in the background and recycles the worker past a limit
+
+    Recycling marks the worker as draining, waits for in-flight requests to
+    finish and then sends SIGTERM to the worker itself. Gunicorn treats that
+    as a normal graceful exit and boots a fresh worker, which loads and warms
+    the model before it accepts connections. While draining, health checks
+    fail and the app answers new inference requests with 503 and
+    Retry-After, so the in-flight count can reach zero.
+
+    Recycling without downtime needs another worker (gunicorn --workers 2
+    or more) or a load balancer that routes on the health check. With the
+    default single worker on Cloud Run, inference is refused for the drain
+    and the model cold-starts before the next request is served.
+    """
+
+    def __init__(self, max_rss_mb: float = 0, max_requests: int = 0, interval: float = 5.0,
+                 drain_timeout: float = 120.0, retry_after: int = 10):
+        """
+        Args:
+            max_rss_mb: Recycle once RSS stays above this after a heap trim (0 = off)
+            max_requests: Recycle after this many requests (0 = off)
+            interval: Seconds between RSS samples
+            drain_timeout: Longest wait for in-flight requests before recycling anyway
+            retry_after: Seconds clients refused during a drain are told to wait
+        """
+        self.max_rss = max_rss_mb * 1048576
+        self.max_requests = max_requests
+        self.interval = interval
+        self.drain_timeout = drain_timeout
+        self.retry_after = retry_after
+        self.requests_served = 0
+        self.peak_rss = 0
+        self.draining = False
+        self._lock = threading.Lock()
+        self._thread = None
+        # Only a process manager will replace a worker that exits
+        self.can_recycle = 'gunicorn' in sys.modules
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rss > 0 or self.max_requests > 0
+
+    def start(self):
+        """Start the background sampler"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='memory-watchdog', daemon=True)
+            self._thread.start()
+            logger.info("Memory watchdog started", extra={
+                'max_rss_mb': self.max_rss / 1048576,
+                'max_requests': self.max_requests,
+                'can_recycle': self.can_recycle
+            })
+
+    def sample(self) -> int:
+        """
+        Sample RSS and update the peak
+
+        Returns:
+            Current RSS in bytes
+        """
+        rss = get_rss_bytes()
+        if rss > self.peak_rss:
+            self.peak_rss = rss
+            PEAK_RSS_BYTES.set(rss)
+        return rss
+
+    def request_finished(self):
+        """Count a served request and recycle once the request budget is used"""
+        with self._lock:
+            self.requests_served += 1
+            served = self.requests_served
+        WORKER_REQUESTS.set(served)
+        if self.max_requests and served >= self.max_requests:
+            self.recycle('max_requests')
+
+    def status(self) -> dict:
+        """Watchdog state for the health endpoint"""
+        return {
+            'rss_mb': round(get_rss_bytes() / 1048576, 1),
+            'peak_rss_mb': round(self.peak_rss / 1048576, 1),
+            'requests_served': self.requests_served,
+            'draining': self.draining
+        }
+
+    def _run(self):
+        while not self.draining:
+            rss = self.sample()
+            if self.max_rss and rss > self.max_rss:
+                # Cached allocator pages are often reclaimable; only recycle real growth
+                _trim_heap()
+                rss = self.sample()
+                if rss > self.max_rss:
+                    self.recycle('max_rss')
+            time.sleep(self.interval)
+
+    def recycle(self, reason: str):
+        """
+        Drain in-flight requests, then ask the process manager for a fresh worker
+
+        Args:
+            reason: Why the worker is recycled ('max_rss' or 'max_requests')
+        """
+        with self._lock:
+            if self.draining:
+                return
+            if not self.can_recycle:
+                logger.warning("Recycle threshold reached but no process manager would restart the worker",
+                               extra={'reason': reason, 'rss_mb': round(get_rss_bytes() / 1048576, 1)})
+                self.max_rss = self.max_requests = 0
+                return
+            self.draining = True
+        WORKER_DRAINING.set(1)
+        logger.warning("Recycling worker", extra={
+            'reason': reason,
+            'rss_mb': round(get_rss_bytes() / 1048576, 1),
+            'requests_served': self.requests_served
+        })
+        threading.Thread(target=self._drain_and_exit, name='worker-drain', daemon=True).start()
+
+    def _drain_and_exit(self):
+        deadline = time.monotonic() + self.drain_timeout
+        while IN_FLIGHT.get() > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        logger.info("Worker drained, exiting", extra={'in_flight': IN_FLIGHT.get()})
+        os.kill(os.getpid(), signal.SIGTERM)
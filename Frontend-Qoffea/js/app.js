@@ -5,12 +5,20 @@
 
 // API Configuration
 const API_BASE_URL = 'https://qoffea.cloud/api';
+// Failed chunk uploads retried (with backoff) before giving up
+const UPLOAD_MAX_RETRIES = 5;
+// Files up to this size go in one plain POST (same as the server's UPLOAD_CHUNK_SIZE);
+// larger ones use resumable chunks
+const UPLOAD_SINGLE_REQUEST_MAX = 4 * 1024 * 1024;
+const OPENSEADRAGON_IMAGES_URL = 'https://cdn.jsdelivr.net/npm/openseadragon@4.1.1/build/openseadragon/images/';
 
 // Global state
 let currentAnalysisId = null;
 let uploadedImage = null;
 let cameraStream = null;
 let videoElement = null;
+let currentDerivatives = null;
+let zoomViewer = null;
 
 // Initialize app
 document.addEventListener('DOMContentLoaded', function() {
@@ -52,6 +60,12 @@ function initializeEventListeners() {
     if (analyzeAgainBtn) {
         analyzeAgainBtn.addEventListener('click', resetAnalysis);
     }
+    
+    // Zoom button
+    const zoomBtn = document.getElementById('zoomBtn');
+    if (zoomBtn) {
+        zoomBtn.addEventListener('click', openZoomViewer);
+    }
 }
 
 /**
@@ -292,19 +306,12 @@ function displayPreview(file) {
  * Upload image and analyze
  */
 async function uploadAndAnalyze(file) {
-    showLoading('Menganalisis gambar...');
+    showLoading('Mengunggah gambar...');
     
     try {
-        const formData = new FormData();
-        formData.append('file', file);
-        formData.append('source', 'gallery');
-        
-        const response = await fetch(`${API_BASE_URL}/upload`, {
-            method: 'POST',
-            body: formData
-        });
-        
-        const result = await response.json();
+        const result = file.size <= UPLOAD_SINGLE_REQUEST_MAX
+            ? await uploadSingle(file)
+            : await uploadResumable(file);
         
         if (result.success) {
             currentAnalysisId = result.analysis_id;
@@ -321,6 +328,134 @@ async function uploadAndAnalyze(file) {
     }
 }
 
+/**
+ * Upload and analyze a small file in one request
+ * 
+ * A multipart POST without custom headers needs no CORS preflight, so a
+ * typical phone photo costs one round trip. If the connection drops, the
+ * upload is retried as a resumable one.
+ */
+async function uploadSingle(file) {
+    const formData = new FormData();
+    formData.append('file', file);
+    formData.append('source', 'gallery');
+    
+    for (let attempt = 0; ; attempt++) {
+        let response;
+        try {
+            response = await fetch(`${API_BASE_URL}/upload`, {
+                method: 'POST',
+                body: formData
+            });
+        } catch (error) {
+            return uploadResumable(file);
+        }
+        
+        const result = await response.json().catch(() => null);
+        if (!result) {
+            throw new Error('Analisis gagal');
+        }
+        // 503 while the server is busy or restarting; wait as long as it asks
+        if (response.status !== 503 || !result.retry_after || attempt >= UPLOAD_MAX_RETRIES) {
+            return result;
+        }
+        showLoading('Server sedang sibuk, mencoba lagi...');
+        await new Promise(resolve => setTimeout(resolve, result.retry_after * 1000));
+    }
+}
+
+/**
+ * Upload a file in chunks, continuing after dropped connections, then analyze it
+ */
+async function uploadResumable(file) {
+    const initResponse = await fetch(`${API_BASE_URL}/uploads`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    const session = await initResponse.json();
+    if (!session.success) {
+        throw new Error(session.error || 'Upload gagal');
+    }
+    
+    const uploadUrl = `${API_BASE_URL}/uploads/${session.upload_id}`;
+    let offset = session.offset;
+    let failures = 0;
+    
+    while (offset < file.size) {
+        const chunk = file.slice(offset, offset + session.chunk_size);
+        const headers = { 'Upload-Offset': String(offset) };
+        const checksum = await sha256Hex(chunk);
+        if (checksum) {
+            headers['X-Chunk-SHA256'] = checksum;
+        }
+        
+        try {
+            const response = await fetch(uploadUrl, { method: 'PUT', headers, body: chunk });
+            const status = await response.json();
+            // 409 means the server holds a different offset; continue from there
+            if (typeof status.offset === 'number' && (response.ok || response.status === 409)) {
+                offset = status.offset;
+                failures = 0;
+                showLoading(`Mengunggah gambar... ${Math.round(offset / file.size * 100)}%`);
+                continue;
+            }
+            if (response.status === 404 || response.status === 413) {
+                throw Object.assign(new Error(status.error || 'Upload gagal'), { fatal: true });
+            }
+            throw new Error(status.error || 'Upload gagal');
+        } catch (error) {
+            if (error.fatal || ++failures > UPLOAD_MAX_RETRIES) {
+                throw error;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** failures));
+            // Ask how much arrived before the connection dropped
+            try {
+                const status = await (await fetch(uploadUrl)).json();
+                if (status.success) {
+                    offset = status.offset;
+                }
+            } catch (statusError) {
+                // Still offline; the next attempt retries the same chunk
+            }
+        }
+    }
+    
+    showLoading('Menganalisis gambar...');
+    // Finalize can be repeated; the server keeps the file until the analysis succeeds
+    for (let attempt = 0; ; attempt++) {
+        let retryAfter = null;
+        try {
+            const response = await fetch(`${uploadUrl}/finalize`, { method: 'POST' });
+            const result = await response.json().catch(() => null);
+            const retryable = response.status === 409 || response.status === 429 || response.status >= 500;
+            if (result && !retryable) {
+                return result;
+            }
+            if (!retryable || attempt >= UPLOAD_MAX_RETRIES) {
+                throw Object.assign(new Error((result && result.error) || 'Analisis gagal'), { fatal: true });
+            }
+            retryAfter = result && result.retry_after;
+        } catch (error) {
+            if (error.fatal || attempt >= UPLOAD_MAX_RETRIES) {
+                throw error;
+            }
+        }
+        await new Promise(resolve => setTimeout(resolve, retryAfter ? retryAfter * 1000 : 1000 * 2 ** (attempt + 1)));
+    }
+}
+
+/**
+ * SHA-256 of a blob as hex (null where Web Crypto is unavailable)
+ */
+async function sha256Hex(blob) {
+    if (!window.crypto || !window.crypto.subtle) {
+        return null;
+    }
+    const digest = await window.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
 /**
  * Display analysis results
  */
@@ -335,7 +470,7 @@ function displayResults(result) {
     
     // Display annotated image if available
     if (result.annotated_filename) {
-        displayAnnotatedImage(result.annotated_filename);
+        displayAnnotatedImage(result.annotated_filename, result.derivatives);
     }
     
     // Show results section
@@ -410,9 +545,18 @@ function updateStatistics(analysis) {
 /**
  * Display annotated image
  */
-function displayAnnotatedImage(filename) {
-    // Use backend API URL for annotated image
-    const imageUrl = `${API_BASE_URL.replace('/api', '')}/uploads/${filename}`;
+function displayAnnotatedImage(filename, derivatives) {
+    // Use backend API URL for annotated image; the medium preview is enough
+    // here, the zoom viewer loads full-resolution tiles only where needed
+    const baseUrl = API_BASE_URL.replace('/api', '');
+    const imageUrl = derivatives ? `${baseUrl}${derivatives.preview}` : `${baseUrl}/uploads/${filename}`;
+    currentDerivatives = derivatives || null;
+    closeZoomViewer();
+    
+    const zoomBtn = document.getElementById('zoomBtn');
+    if (zoomBtn) {
+        zoomBtn.style.display = currentDerivatives && window.OpenSeadragon ? 'inline-block' : 'none';
+    }
     
     const analysisImage = document.querySelector('.analysis-image-section img');
     if (analysisImage) {
@@ -433,6 +577,42 @@ function displayAnnotatedImage(filename) {
     }
 }
 
+/**
+ * Open the deep zoom viewer on the annotated image
+ */
+function openZoomViewer() {
+    if (!currentDerivatives || !window.OpenSeadragon) {
+        return;
+    }
+    
+    const tileSource = `${API_BASE_URL.replace('/api', '')}${currentDerivatives.dzi}`;
+    document.getElementById('zoomViewer').style.display = 'block';
+    
+    if (zoomViewer) {
+        zoomViewer.open(tileSource);
+    } else {
+        zoomViewer = OpenSeadragon({
+            id: 'zoomViewer',
+            prefixUrl: OPENSEADRAGON_IMAGES_URL,
+            tileSources: tileSource,
+            showNavigator: true
+        });
+    }
+}
+
+/**
+ * Close the deep zoom viewer
+ */
+function closeZoomViewer() {
+    const container = document.getElementById('zoomViewer');
+    if (container) {
+        container.style.display = 'none';
+    }
+    if (zoomViewer) {
+        zoomViewer.close();
+    }
+}
+
 /**
  * Download PDF report
  */
@@ -477,6 +657,8 @@ async function downloadPDF() {
 function resetAnalysis() {
     currentAnalysisId = null;
     uploadedImage = null;
+    currentDerivatives = null;
+    closeZoomViewer();
     hideResultsSection();
     
     // Reset preview image